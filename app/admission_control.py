@@ -0,0 +1,319 @@
+import asyncio
+import hashlib
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import config as app_config
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries the suggested Retry-After in seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _ClientState:
+    """
+    Fairness state of an API key, or of one of its sub-buckets (X-Client-Id values). Keys
+    hold their sub-buckets; requests wait in the sub-buckets.
+    """
+
+    __slots__ = ("active", "waiters", "queued", "virtual_finish", "bucket_clock", "buckets", "admitted", "rejected",
+                 "weight", "background")
+
+    def __init__(self, virtual_finish: float = 0.0):
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.queued = 0
+        # Weighted virtual time consumed by this client; the client with the smallest value
+        # among those waiting is served next. New clients start at the current virtual
+        # clock so idle time is not banked.
+        self.virtual_finish = virtual_finish
+        # Virtual clock of the key's sub-buckets, which share the key's turns equally
+        self.bucket_clock = 0.0
+        self.buckets: Dict[str, "_ClientState"] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.weight: Optional[float] = None
+        self.background = False
+
+
+class AdmissionTicket:
+    """Held for the lifetime of an admitted request. release() is idempotent."""
+
+    __slots__ = ("_controller", "client_id", "wait_seconds", "admitted_at", "_released")
+
+    def __init__(self, controller: "AdmissionController", client_id: str, wait_seconds: float):
+        self._controller = controller
+        self.client_id = client_id
+        self.wait_seconds = wait_seconds
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.client_id, time.monotonic() - self.admitted_at)
+
+
+def client_id_for(api_key: Optional[str], client_hint: Optional[str] = None) -> str:
+    """
+    Identifies a client for fairness: "key-<hash of the API key>", followed by
+    "/<X-Client-Id>" when the header is sent. The header only splits the key's share
+    between the clients that use it; limits and weights apply to the key.
+    """
+    key_hash = hashlib.blake2b((api_key or "").encode("utf-8"), digest_size=6).hexdigest()
+    if client_hint:
+        return f"key-{key_hash}/{client_hint[:64]}"
+    return f"key-{key_hash}"
+
+
+class AdmissionController:
+    """
+    Bounds concurrent chat completions globally (ADMISSION_MAX_CONCURRENCY) and per API key
+    (ADMISSION_MAX_PER_CLIENT). Requests over the limit wait in a bounded queue
+    (ADMISSION_MAX_QUEUE) and are admitted by weighted fair scheduling: each key is
+    charged 1 / weight of virtual time per admitted request, and the waiting key with the
+    least virtual time goes next; within a key, its sub-buckets take turns the same way.
+    A full queue or a wait longer than ADMISSION_QUEUE_TIMEOUT_SECONDS fails fast with
+    AdmissionRejected.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, _ClientState] = {}
+        self._active = 0
+        self._queued = 0
+        self._virtual_clock = 0.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        # Exponential moving average of how long admitted requests hold their slot.
+        self._avg_service_seconds = 5.0
+
+    @property
+    def max_concurrency(self) -> int:
+        return app_config.ADMISSION_MAX_CONCURRENCY
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    @property
+    def max_per_client(self) -> int:
+        return app_config.ADMISSION_MAX_PER_CLIENT
+
+    @property
+    def max_queue(self) -> int:
+        return app_config.ADMISSION_MAX_QUEUE
+
+    @property
+    def queue_timeout_seconds(self) -> float:
+        return app_config.ADMISSION_QUEUE_TIMEOUT_SECONDS
+
+    def _weight(self, client_id: str, state: Optional[_ClientState] = None) -> float:
+        if state is not None and state.weight is not None:
+            return max(0.01, state.weight)
+        weights = app_config.ADMISSION_CLIENT_WEIGHTS
+        if isinstance(weights, dict):
+            try:
+                return max(0.01, float(weights.get(client_id, 1.0)))
+            except (TypeError, ValueError):
+                pass
+        return 1.0
+
+    def _client(self, client_id: str):
+        """Returns the key and sub-bucket states for client_id, creating them as needed."""
+        key_id, _, bucket_id = client_id.partition("/")
+        state = self._clients.get(key_id)
+        if state is None:
+            state = self._clients[key_id] = _ClientState(self._virtual_clock)
+        bucket = state.buckets.get(bucket_id)
+        if bucket is None:
+            bucket = state.buckets[bucket_id] = _ClientState(state.bucket_clock)
+        return key_id, state, bucket
+
+    def _has_capacity(self, state: _ClientState) -> bool:
+        if self._active >= self.max_concurrency:
+            return False
+        max_per_client = self.max_per_client
+        return max_per_client <= 0 or state.active < max_per_client
+
+    def _admit(self, key_id: str, state: _ClientState, bucket: _ClientState):
+        self._active += 1
+        state.active += 1
+        state.admitted += 1
+        bucket.active += 1
+        bucket.admitted += 1
+        self.admitted_total += 1
+        start = max(state.virtual_finish, self._virtual_clock)
+        state.virtual_finish = start + 1.0 / self._weight(key_id, state)
+        self._virtual_clock = start
+        bucket_start = max(bucket.virtual_finish, state.bucket_clock)
+        bucket.virtual_finish = bucket_start + 1.0
+        state.bucket_clock = bucket_start
+
+    def retry_after_seconds(self) -> int:
+        concurrency = max(1, self.max_concurrency)
+        estimate = (self._queued + 1) * self._avg_service_seconds / concurrency
+        return max(1, int(math.ceil(estimate)))
+
+    async def acquire(self, client_id: str, weight: Optional[float] = None, background: bool = False) -> AdmissionTicket:
+        """
+        Admits a request of client_id, waiting for a slot if needed. weight overrides
+        ADMISSION_CLIENT_WEIGHTS for the client. Background clients (batch jobs) wait without
+        a timeout and outside ADMISSION_MAX_QUEUE, so they never get interactive requests
+        rejected.
+        """
+        key_id, state, bucket = self._client(client_id)
+        state.weight = weight
+        state.background = background
+        if not state.queued and self._has_capacity(state):
+            self._admit(key_id, state, bucket)
+            return self._ticket(client_id, 0.0)
+
+        if not background and self._queued >= self.max_queue:
+            state.rejected += 1
+            bucket.rejected += 1
+            self.rejected_total += 1
+            self._forget_if_idle(key_id, state, client_id)
+            raise AdmissionRejected("Server is at capacity and the admission queue is full.", self.retry_after_seconds())
+
+        future = asyncio.get_running_loop().create_future()
+        bucket.waiters.append(future)
+        state.queued += 1
+        if not background:
+            self._queued += 1
+        enqueued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=None if background else self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Admitted in the same tick the timeout fired; keep the slot.
+                return self._ticket(client_id, time.monotonic() - enqueued_at)
+            self._drop_waiter(state, bucket, future)
+            state.rejected += 1
+            bucket.rejected += 1
+            self.rejected_total += 1
+            self._forget_if_idle(key_id, state, client_id)
+            raise AdmissionRejected("Timed out waiting in the admission queue.", self.retry_after_seconds())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(client_id)
+            else:
+                self._drop_waiter(state, bucket, future)
+                self._forget_if_idle(key_id, state, client_id)
+            raise
+        return self._ticket(client_id, time.monotonic() - enqueued_at)
+
+    def _ticket(self, client_id: str, wait_seconds: float) -> AdmissionTicket:
+        self.wait_seconds_total += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        return AdmissionTicket(self, client_id, wait_seconds)
+
+    def _drop_waiter(self, state: _ClientState, bucket: _ClientState, future: asyncio.Future):
+        try:
+            bucket.waiters.remove(future)
+            state.queued -= 1
+            if not state.background:
+                self._queued -= 1
+        except ValueError:
+            pass
+        if not future.done():
+            future.cancel()
+
+    def _forget_if_idle(self, key_id: str, state: _ClientState, client_id: str):
+        # Idle clients are forgotten to keep the table small; they rejoin at the current
+        # virtual clock, which is where an idle client would be placed anyway.
+        bucket_id = client_id.partition("/")[2]
+        bucket = state.buckets.get(bucket_id)
+        if bucket is not None and bucket.active == 0 and not bucket.waiters:
+            del state.buckets[bucket_id]
+        if state.active == 0 and not state.buckets:
+            self._clients.pop(key_id, None)
+
+    def _release(self, client_id: str, service_seconds: Optional[float] = None):
+        if service_seconds is not None:
+            self._avg_service_seconds = 0.9 * self._avg_service_seconds + 0.1 * service_seconds
+        key_id, _, bucket_id = client_id.partition("/")
+        state = self._clients.get(key_id)
+        if state is None:
+            return
+        self._active = max(0, self._active - 1)
+        state.active = max(0, state.active - 1)
+        bucket = state.buckets.get(bucket_id)
+        if bucket is not None:
+            bucket.active = max(0, bucket.active - 1)
+        self._dispatch()
+        self._forget_if_idle(key_id, state, client_id)
+
+    def _dispatch(self):
+        """Admits waiting requests, least virtual time first, while there is capacity."""
+        while self._active < self.max_concurrency:
+            next_key_id = None
+            next_state = None
+            for key_id, state in self._clients.items():
+                if not state.queued or not self._has_capacity(state):
+                    continue
+                if next_state is None or state.virtual_finish < next_state.virtual_finish:
+                    next_key_id, next_state = key_id, state
+            if next_state is None:
+                return
+            next_bucket = min(
+                (bucket for bucket in next_state.buckets.values() if bucket.waiters),
+                key=lambda bucket: bucket.virtual_finish,
+            )
+            future = next_bucket.waiters.popleft()
+            next_state.queued -= 1
+            if not next_state.background:
+                self._queued -= 1
+            if future.done():
+                continue
+            self._admit(next_key_id, next_state, next_bucket)
+            future.set_result(True)
+
+    def stats(self) -> Dict[str, Any]:
+        admitted = self.admitted_total
+        return {
+            "enabled": self.enabled,
+            "max_concurrency": self.max_concurrency,
+            "max_per_client": self.max_per_client,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": self._queued,
+            "admitted_total": admitted,
+            "rejected_total": self.rejected_total,
+            "avg_wait_ms": round(self.wait_seconds_total / admitted * 1000, 1) if admitted else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 1),
+            "avg_service_ms": round(self._avg_service_seconds * 1000, 1),
+            "clients": {
+                key_id: {
+                    "active": state.active,
+                    "queued": state.queued,
+                    "weight": self._weight(key_id, state),
+                    "admitted": state.admitted,
+                    "rejected": state.rejected,
+                    "buckets": {
+                        bucket_id: {"active": bucket.active, "queued": len(bucket.waiters), "admitted": bucket.admitted}
+                        for bucket_id, bucket in state.buckets.items() if bucket_id
+                    },
+                }
+                for key_id, state in self._clients.items()
+            },
+        }
+
+
+# Global singleton
+_admission_controller_instance: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """Returns the process-wide admission controller."""
+    global _admission_controller_instance
+    if _admission_controller_instance is None:
+        _admission_controller_instance = AdmissionController()
+    return _admission_controller_instance
@@ -2,23 +2,63 @@ import json
 import time
 import math
 import asyncio
-from typing import List, Dict, Any, Callable, Union, Optional, Awaitable
+import hashlib
+import marshal
+from collections import OrderedDict
+from functools import lru_cache
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Dict, Any, Callable, Union, Optional, Awaitable, Mapping, Tuple
 
 from fastapi.responses import JSONResponse, StreamingResponse
-from google.auth.transport.requests import Request as AuthRequest
 from google.genai import types
-from openai import AsyncOpenAI 
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
 from models import OpenAIRequest, OpenAIMessage
 from message_processing import (
     convert_to_openai_format,
     convert_chunk_to_openai,
+    create_stream_flush_chunk,
+    StreamState,
     extract_reasoning_by_tags,
     _create_safety_ratings_html
 )
+from context_cache import get_context_cache_manager, is_cache_miss_error
+import metrics
+import tracing
 import config as app_config
 from config import VERTEX_REASONING_TAG
+from app_logging import get_logger
+
+logger = get_logger("gemini")
+
+
+def _patch_aiohttp_stream_reader():
+    """
+    The genai SDK reads responses through aiohttp, whose StreamReader limit (64KB) is too
+    small for lines carrying 4K base64 images. aiohttp is imported by the SDK, so the patch
+    lives next to the first module that loads it on the request path.
+    """
+    import aiohttp
+
+    if not (hasattr(aiohttp, 'streams') and hasattr(aiohttp.streams, 'StreamReader')):
+        logger.warning("Could not patch aiohttp.streams.StreamReader. Large images might fail.")
+        return
+    original_init = aiohttp.streams.StreamReader.__init__
+    if getattr(original_init, "_voutb_patched", False):
+        return
+
+    def _patched_stream_reader_init(self, protocol, limit, *args, **kwargs):
+        # Force limit to 100MB regardless of what is passed
+        original_init(self, protocol, 100 * 1024 * 1024, *args, **kwargs)
+
+    _patched_stream_reader_init._voutb_patched = True
+    aiohttp.streams.StreamReader.__init__ = _patched_stream_reader_init
+    logger.debug("Patched aiohttp.streams.StreamReader to enforce 100MB limit.")
+
+
+_patch_aiohttp_stream_reader()
 
 class StreamingReasoningProcessor:
     def __init__(self, tag_name: str = VERTEX_REASONING_TAG):
@@ -111,6 +151,8 @@ def get_http_options(custom_base_url: Optional[str] = None) -> Optional[types.Ht
     Get http options from config, handling proxy settings and optional base_url.
     Returns types.HttpOptions or None if no config is needed (and no base_url).
     """
+    if custom_base_url is None and app_config.UPSTREAM_BASE_URL != app_config.DEFAULTS["UPSTREAM_BASE_URL"]:
+        custom_base_url = app_config.UPSTREAM_BASE_URL
     if app_config.PROXY_URL:
         # Using client_args/async_client_args with 'proxy' key for httpx
         return types.HttpOptions(
@@ -124,22 +166,125 @@ def get_http_options(custom_base_url: Optional[str] = None) -> Optional[types.Ht
         
     return None
 
+# Safety settings are identical for every Gemini request, so they are built once at import
+# time and shared by every generation config template.
+_SAFETY_THRESHOLD = "BLOCK_NONE"
+_SAFETY_SETTINGS: Tuple[types.SafetySetting, ...] = tuple(
+    types.SafetySetting(category=category, threshold=_SAFETY_THRESHOLD)
+    for category in (
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_HARASSMENT",
+        "HARM_CATEGORY_CIVIC_INTEGRITY",
+        "HARM_CATEGORY_UNSPECIFIED",
+        "HARM_CATEGORY_IMAGE_HATE",
+        "HARM_CATEGORY_IMAGE_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_IMAGE_HARASSMENT",
+        "HARM_CATEGORY_IMAGE_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_JAILBREAK",
+    )
+)
+
+# Maximum number of distinct `tools` arrays whose converted Gemini tool is memoised.
+_FUNCTION_TOOL_CACHE_SIZE = 128
+_function_tool_cache: "OrderedDict[str, Optional[types.Tool]]" = OrderedDict()
+
+
+def _get_image_size_for_model(model_name: str) -> Optional[str]:
+    """Returns the image size requested by a -2k/-4k model suffix, or None."""
+    if model_name.endswith('-2k'):
+        return "2k"
+    if model_name.endswith('-4k'):
+        return "4k"
+    return None
+
+
+@lru_cache(maxsize=None)
+def _get_generation_config_template(image_size: Optional[str]) -> Mapping[str, Any]:
+    """
+    Builds the frozen per-route base of a generation config. Only the parts that do not
+    depend on the request body live here; sampling parameters are overlaid per request.
+    """
+    template: Dict[str, Any] = {}
+    if image_size:
+        # Add image generation config for the requested resolution
+        template["responseModalities"] = ("TEXT", "IMAGE")
+        template["imageConfig"] = MappingProxyType({"imageSize": image_size})
+    template["safety_settings"] = _SAFETY_SETTINGS
+    return MappingProxyType(template)
+
+
+def _tools_content_hash(tools: List[Dict[str, Any]]) -> Optional[str]:
+    # marshal is several times cheaper than json.dumps for parsed JSON and is injective for
+    # the dict/list/str/number types a request body can contain.
+    try:
+        serialized = marshal.dumps(tools)
+    except ValueError:
+        return None
+    return hashlib.blake2b(serialized, digest_size=16).hexdigest()
+
+
+def _build_function_declarations(tools: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], ...]:
+    function_declarations = []
+    for tool in tools:
+        if tool.get("type") == "function":
+            # func_def = tool.get("function")
+            func_def = tool
+            if func_def:
+                # Extract only the fields accepted by the Gemini API
+                declaration = {
+                    "name": func_def.get("name"),
+                    "description": func_def.get("description"),
+                }
+                # Get parameters and remove the $schema field if it exists
+                parameters = func_def.get("parameters")
+                if isinstance(parameters, dict) and "$schema" in parameters:
+                    parameters = parameters.copy()
+                    del parameters["$schema"]
+                if parameters is not None:
+                    declaration["parameters"] = parameters
+
+                # Remove keys with None values to keep the payload clean
+                declaration = {k: v for k, v in declaration.items() if v is not None}
+                if declaration.get("name"):  # Ensure name exists
+                    function_declarations.append(declaration)
+    return tuple(function_declarations)
+
+
+def _get_function_tool(tools: List[Dict[str, Any]]) -> Optional[types.Tool]:
+    """
+    Converts OpenAI tool definitions into a validated Gemini `types.Tool`, memoised by a
+    content hash of the `tools` array. Validating the declaration schemas is by far the most
+    expensive part of building a config, so agents resending the same schema every turn
+    reuse the already-validated object.
+    """
+    tools_hash = _tools_content_hash(tools)
+    if tools_hash is not None and tools_hash in _function_tool_cache:
+        _function_tool_cache.move_to_end(tools_hash)
+        return _function_tool_cache[tools_hash]
+
+    function_declarations = _build_function_declarations(tools)
+    function_tool = types.Tool(function_declarations=list(function_declarations)) if function_declarations else None
+    if tools_hash is not None:
+        _function_tool_cache[tools_hash] = function_tool
+        if len(_function_tool_cache) > _FUNCTION_TOOL_CACHE_SIZE:
+            _function_tool_cache.popitem(last=False)
+    return function_tool
+
+
 def create_generation_config(request: OpenAIRequest) -> Dict[str, Any]:
-    config: Dict[str, Any] = {}
-    
     # Check for -2k or -4k suffix to add image generation capabilities
-    model_name = request.model
-    if model_name.endswith('-2k'):
-        # Add image generation config for 2k resolution
-        config["responseModalities"] = ["TEXT", "IMAGE"]
-        config["imageConfig"] = {"imageSize": "2k"}
-        print(f"Detected -2k suffix, adding image generation config with 2k resolution")
-    elif model_name.endswith('-4k'):
-        # Add image generation config for 4k resolution
-        config["responseModalities"] = ["TEXT", "IMAGE"]
-        config["imageConfig"] = {"imageSize": "4k"}
-        print(f"Detected -4k suffix, adding image generation config with 4k resolution")
-    
+    image_size = _get_image_size_for_model(request.model)
+    template = _get_generation_config_template(image_size)
+
+    # Copy the frozen template; containers are re-created so callers can mutate the result.
+    config: Dict[str, Any] = {}
+    if image_size:
+        config["responseModalities"] = list(template["responseModalities"])
+        config["imageConfig"] = dict(template["imageConfig"])
+        logger.debug("Detected -%s suffix, adding image generation config with %s resolution", image_size, image_size)
+
     if request.temperature is not None: config["temperature"] = request.temperature
     if request.max_tokens is not None: config["max_output_tokens"] = request.max_tokens
     if request.top_p is not None: config["top_p"] = request.top_p
@@ -147,51 +292,15 @@ def create_generation_config(request: OpenAIRequest) -> Dict[str, Any]:
     if request.stop is not None: config["stop_sequences"] = request.stop
     if request.seed is not None: config["seed"] = request.seed
     if request.n is not None: config["candidate_count"] = request.n
-    
-    safety_threshold = "BLOCK_NONE"
-    config["safety_settings"] = [
-            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_CIVIC_INTEGRITY", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_UNSPECIFIED", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_IMAGE_HATE", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_IMAGE_DANGEROUS_CONTENT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_IMAGE_HARASSMENT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_IMAGE_SEXUALLY_EXPLICIT", threshold=safety_threshold),
-            types.SafetySetting(category="HARM_CATEGORY_JAILBREAK", threshold=safety_threshold)
-    ]
+
+    config["safety_settings"] = list(template["safety_settings"])
     # config["thinking_config"] = {"include_thoughts": True}
 
     # 1. Add tools (function declarations)
-    function_declarations = []
     if request.tools:
-        for tool in request.tools:
-            if tool.get("type") == "function":
-                # func_def = tool.get("function")
-                func_def = tool
-                if func_def:
-                    # Extract only the fields accepted by the Gemini API
-                    declaration = {
-                        "name": func_def.get("name"),
-                        "description": func_def.get("description"),
-                    }
-                    # Get parameters and remove the $schema field if it exists
-                    parameters = func_def.get("parameters")
-                    if isinstance(parameters, dict) and "$schema" in parameters:
-                        parameters = parameters.copy()
-                        del parameters["$schema"]
-                    if parameters is not None:
-                        declaration["parameters"] = parameters
-
-                    # Remove keys with None values to keep the payload clean
-                    declaration = {k: v for k, v in declaration.items() if v is not None}
-                    if declaration.get("name"):  # Ensure name exists
-                        function_declarations.append(declaration)
-
-    if function_declarations:
-        config["tools"] = [{"function_declarations": function_declarations}]
+        function_tool = _get_function_tool(request.tools)
+        if function_tool is not None:
+            config["tools"] = [function_tool]
 
     # 2. Add tool_config (based on tool_choice)
     tool_config = None
@@ -297,11 +406,109 @@ async def _chunk_openai_response_dict_for_sse(
                         yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': {'content': content_to_chunk[i:i+chunk_size]}, 'finish_reason': None}]}, ensure_ascii=False)}\n\n"
                         if len(content_to_chunk) > chunk_size: await asyncio.sleep(0.05)
         
-        yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': {}, 'finish_reason': final_finish_reason}]}, ensure_ascii=False)}\n\n"
+        final_choice = {'index': choice_idx, 'delta': {}, 'finish_reason': final_finish_reason}
+        if app_config.SAFETY_SCORE and choice.get("safety_ratings"):
+            final_choice["safety_ratings"] = choice["safety_ratings"]
+        yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [final_choice]}, ensure_ascii=False)}\n\n"
 
     yield "data: [DONE]\n\n"
 
 
+async def _generate_content_with_context_cache(
+    client: Any,
+    model: str,
+    contents: List[types.Content],
+    gen_config_dict: Dict[str, Any],
+):
+    """
+    generate_content that references an automatic context cache when one covers the prompt
+    prefix. If upstream no longer knows the cache, the full prompt is sent once instead.
+    """
+    context_cache = get_context_cache_manager()
+    call_contents, call_config, cache_name = await context_cache.apply(client, model, contents, gen_config_dict)
+    upstream_span = tracing.start_span("upstream.generate_content", tracing.SPAN_KIND_CLIENT, {
+        "gen_ai.system": "vertex_ai", "gen_ai.request.model": model, "voutb.context_cache": cache_name or "",
+    })
+    try:
+        response = await client.aio.models.generate_content(
+            model=model,
+            contents=call_contents,
+            config=call_config # Pass the dictionary directly
+        )
+    except Exception as e:
+        if cache_name is None or not is_cache_miss_error(e):
+            metrics.record_upstream_result(metrics.status_code_from_error(e))
+            upstream_span.record_exception(e)
+            upstream_span.end()
+            raise
+        # One logical call: only the outcome of the full-prompt retry is recorded
+        context_cache.invalidate(cache_name)
+        try:
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=gen_config_dict
+            )
+        except Exception as e_retry:
+            metrics.record_upstream_result(metrics.status_code_from_error(e_retry))
+            upstream_span.record_exception(e_retry)
+            upstream_span.end()
+            raise
+    metrics.record_upstream_result("200")
+    usage_metadata = getattr(response, "usage_metadata", None)
+    if usage_metadata is not None:
+        upstream_span.set_attribute("gen_ai.usage.input_tokens", usage_metadata.prompt_token_count or 0)
+        upstream_span.set_attribute("gen_ai.usage.output_tokens", usage_metadata.candidates_token_count or 0)
+    upstream_span.end()
+    return response
+
+
+async def _generate_content_stream_with_context_cache(
+    client: Any,
+    model: str,
+    contents: List[types.Content],
+    gen_config_dict: Dict[str, Any],
+):
+    """
+    Streaming counterpart of _generate_content_with_context_cache. A missing cache only
+    surfaces once the stream is read, so the first chunk is fetched before deciding whether
+    to fall back to the full prompt.
+    """
+    context_cache = get_context_cache_manager()
+    call_contents, call_config, cache_name = await context_cache.apply(client, model, contents, gen_config_dict)
+    if cache_name is None:
+        return await client.aio.models.generate_content_stream(model=model, contents=call_contents, config=call_config)
+
+    try:
+        stream = await client.aio.models.generate_content_stream(model=model, contents=call_contents, config=call_config)
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except Exception as e:
+        if not is_cache_miss_error(e):
+            raise
+        context_cache.invalidate(cache_name)
+        return await client.aio.models.generate_content_stream(model=model, contents=contents, config=gen_config_dict)
+
+    async def _replay_first_chunk():
+        if first_chunk is None:
+            return
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    return _replay_first_chunk()
+
+
+async def _trace_first_chunk(stream, span):
+    """Passes a stream through, marking the first chunk (time to first token) on the span."""
+    first_chunk = True
+    async for chunk in stream:
+        if first_chunk:
+            span.add_event("gen_ai.first_token")
+            first_chunk = False
+        yield chunk
+
+
 async def gemini_fake_stream_generator( 
     gemini_client_instance: Any, 
     model_for_api_call: str, 
@@ -311,13 +518,14 @@ async def gemini_fake_stream_generator(
     is_auto_attempt: bool
 ):
     model_name_for_log = getattr(gemini_client_instance, 'model_name', 'unknown_gemini_model_object')
-    print(f"FAKE STREAMING (Gemini): Prep for '{request_obj.model}' (API model string: '{model_for_api_call}', client obj: '{model_name_for_log}')")
+    logger.debug("FAKE STREAMING (Gemini): Prep for '%s' (API model string: '%s', client obj: '%s')", request_obj.model, model_for_api_call, model_name_for_log)
     
     api_call_task = asyncio.create_task(
-        gemini_client_instance.aio.models.generate_content(
-            model=model_for_api_call, 
-            contents=prompt_for_api_call, 
-            config=gen_config_dict_for_api_call # Pass the dictionary directly
+        _generate_content_with_context_cache(
+            gemini_client_instance,
+            model_for_api_call,
+            prompt_for_api_call,
+            gen_config_dict_for_api_call
         )
     )
 
@@ -330,7 +538,7 @@ async def gemini_fake_stream_generator(
     
     try:
         raw_gemini_response = await api_call_task 
-        openai_response_dict = convert_to_openai_format(raw_gemini_response, request_obj.model)
+        openai_response_dict = await convert_to_openai_format(raw_gemini_response, request_obj.model)
         
         if hasattr(raw_gemini_response, 'prompt_feedback') and \
            hasattr(raw_gemini_response.prompt_feedback, 'block_reason') and \
@@ -348,7 +556,7 @@ async def gemini_fake_stream_generator(
 
     except Exception as e_outer_gemini:
         err_msg_detail = f"Error in gemini_fake_stream_generator (model: '{request_obj.model}'): {type(e_outer_gemini).__name__} - {str(e_outer_gemini)}"
-        print(f"ERROR: {err_msg_detail}")
+        logger.error(err_msg_detail)
         sse_err_msg_display = str(e_outer_gemini)
         if len(sse_err_msg_display) > 512: sse_err_msg_display = sse_err_msg_display[:512] + "..."
         err_resp_sse = create_openai_error_response(500, sse_err_msg_display, "server_error")
@@ -360,14 +568,14 @@ async def gemini_fake_stream_generator(
 
 
 async def openai_fake_stream_generator( 
-    openai_client: Union[AsyncOpenAI, Any], 
+    openai_client: Union["AsyncOpenAI", Any], 
     openai_params: Dict[str, Any],
     openai_extra_body: Dict[str, Any],
     request_obj: OpenAIRequest,
     is_auto_attempt: bool
 ):
     api_model_name = openai_params.get("model", "unknown-openai-model")
-    print(f"FAKE STREAMING (OpenAI Direct): Prep for '{request_obj.model}' (API model: '{api_model_name}')")
+    logger.debug("FAKE STREAMING (OpenAI Direct): Prep for '%s' (API model: '%s')", request_obj.model, api_model_name)
     response_id = f"chatcmpl-openaidirectfake-{int(time.time())}"
     
     async def _openai_api_call_task():
@@ -387,7 +595,8 @@ async def openai_fake_stream_generator(
         raw_response_obj = await api_call_task 
         openai_response_dict = raw_response_obj.model_dump(exclude_unset=True, exclude_none=True)
 
-        if app_config.SAFETY_SCORE and hasattr(raw_response_obj, "choices") and raw_response_obj.choices:
+        # With SAFETY_SCORE_FORMAT "json" the ratings stay in choices[].safety_ratings as returned
+        if app_config.SAFETY_SCORE and str(app_config.SAFETY_SCORE_FORMAT).lower() != "json" and hasattr(raw_response_obj, "choices") and raw_response_obj.choices:
             for i, choice_obj in enumerate(raw_response_obj.choices):
                 if hasattr(choice_obj, "safety_ratings") and choice_obj.safety_ratings:
                     safety_html = _create_safety_ratings_html(choice_obj.safety_ratings)
@@ -421,7 +630,7 @@ async def openai_fake_stream_generator(
             
     except Exception as e_outer: 
         err_msg_detail = f"Error in openai_fake_stream_generator (model: '{request_obj.model}'): {type(e_outer).__name__} - {str(e_outer)}"
-        print(f"ERROR: {err_msg_detail}")
+        logger.error(err_msg_detail)
         sse_err_msg_display = str(e_outer)
         if len(sse_err_msg_display) > 512: sse_err_msg_display = sse_err_msg_display[:512] + "..."
         err_resp_sse = create_openai_error_response(500, sse_err_msg_display, "server_error")
@@ -432,6 +641,39 @@ async def openai_fake_stream_generator(
         if is_auto_attempt: raise
 
 
+def _raise_for_invalid_response(response_obj_call: Any, model_to_call: str):
+    """Raises ValueError if a non-streaming response was blocked or carries no usable content."""
+    if hasattr(response_obj_call, 'prompt_feedback') and \
+       hasattr(response_obj_call.prompt_feedback, 'block_reason') and \
+       response_obj_call.prompt_feedback.block_reason:
+        block_msg = f"Blocked (Gemini): {response_obj_call.prompt_feedback.block_reason}"
+        if hasattr(response_obj_call.prompt_feedback,'block_reason_message') and \
+           response_obj_call.prompt_feedback.block_reason_message: 
+            block_msg+=f" ({response_obj_call.prompt_feedback.block_reason_message})"
+        raise ValueError(block_msg)
+    
+    if not is_gemini_response_valid(response_obj_call):
+        error_details = f"Invalid non-streaming Gemini response for model string '{model_to_call}'. "
+        if hasattr(response_obj_call, 'candidates'):
+            error_details += f"Candidates: {len(response_obj_call.candidates) if response_obj_call.candidates else 0}. "
+            if response_obj_call.candidates and len(response_obj_call.candidates) > 0:
+                candidate = response_obj_call.candidates if isinstance(response_obj_call.candidates, list) else response_obj_call.candidates
+                if hasattr(candidate, 'content'):
+                    error_details += "Has content. "
+                    if hasattr(candidate.content, 'parts'):
+                        error_details += f"Parts: {len(candidate.content.parts) if candidate.content.parts else 0}. "
+                        if candidate.content.parts and len(candidate.content.parts) > 0:
+                            part = candidate.content.parts if isinstance(candidate.content.parts, list) else candidate.content.parts
+                            if hasattr(part, 'text'):
+                                text_preview = str(getattr(part, 'text', ''))[:100]
+                                error_details += f"First part text: '{text_preview}'"
+                            elif hasattr(part, 'function_call'):
+                                error_details += f"First part is function_call: {part.function_call.name}"
+        else:
+            error_details += f"Response type: {type(response_obj_call).__name__}"
+        raise ValueError(error_details)
+
+
 async def execute_gemini_call(
     current_client: Any,
     model_to_call: str,
@@ -441,9 +683,12 @@ async def execute_gemini_call(
     is_auto_attempt: bool = False,
     location_manager: Any = None
 ):
-    actual_prompt_for_call = await prompt_func(request_obj.messages)
+    conversion_started_at = time.perf_counter()
+    with tracing.use_span("prompt.convert", attributes={"voutb.prompt.strategy": prompt_func.__name__, "voutb.prompt.messages": len(request_obj.messages)}):
+        actual_prompt_for_call = await prompt_func(request_obj.messages)
+    metrics.PROMPT_CONVERSION_DURATION.observe(time.perf_counter() - conversion_started_at, prompt_func.__name__)
     client_model_name_for_log = getattr(current_client, 'model_name', 'unknown_direct_client_object')
-    print(f"INFO: execute_gemini_call for requested API model '{model_to_call}', using client object with internal name '{client_model_name_for_log}'. Original request model: '{request_obj.model}'")
+    logger.info("execute_gemini_call for requested API model '%s', using client object with internal name '%s'. Original request model: '%s'", model_to_call, client_model_name_for_log, request_obj.model)
     
     if request_obj.stream:
         if app_config.FAKE_STREAMING_ENABLED:
@@ -457,16 +702,18 @@ async def execute_gemini_call(
         else: # True Streaming
             response_id_for_stream = f"chatcmpl-realstream-{int(time.time())}"
             async def _gemini_real_stream_generator_inner():
+                stream_state = StreamState()
+                upstream_span = tracing.start_span("upstream.generate_content_stream", tracing.SPAN_KIND_CLIENT, {
+                    "gen_ai.system": "vertex_ai", "gen_ai.request.model": model_to_call,
+                })
                 try:
-                    stream_gen_obj = await current_client.aio.models.generate_content_stream(
-                        model=model_to_call,
-                        contents=actual_prompt_for_call,
-                        config=gen_config_dict # Pass the dictionary directly
-                    )
+                    stream_gen_obj = _trace_first_chunk(await _generate_content_stream_with_context_cache(
+                        current_client, model_to_call, actual_prompt_for_call, gen_config_dict
+                    ), upstream_span)
                     
                     if "image" not in request_obj.model:
                         async for chunk_item_call in stream_gen_obj:
-                            yield convert_chunk_to_openai(chunk_item_call, request_obj.model, response_id_for_stream, 0)
+                            yield await convert_chunk_to_openai(chunk_item_call, request_obj.model, response_id_for_stream, 0, stream_state)
                     else:
                         # For image models, use a queue to handle keep-alive timeouts
                         queue = asyncio.Queue()
@@ -494,11 +741,11 @@ async def execute_gemini_call(
                                     if isinstance(item, Exception):
                                         raise item
                                         
-                                    yield convert_chunk_to_openai(item, request_obj.model, response_id_for_stream, 0)
+                                    yield await convert_chunk_to_openai(item, request_obj.model, response_id_for_stream, 0, stream_state)
                                     
                                 except asyncio.TimeoutError:
                                     # Send keep-alive space
-                                    print(f"DEBUG: Sending keep-alive space for model '{request_obj.model}'")
+                                    logger.debug("Sending keep-alive space for model '%s'", request_obj.model)
                                     keep_alive_chunk = {
                                         "id": response_id_for_stream,
                                         "object": "chat.completion.chunk",
@@ -510,14 +757,22 @@ async def execute_gemini_call(
                         finally:
                             producer_task.cancel()
 
+                    metrics.record_upstream_result("200")
+                    upstream_span.end()
+                    flush_chunk = create_stream_flush_chunk(stream_state, request_obj.model, response_id_for_stream)
+                    if flush_chunk:
+                        yield flush_chunk
                     yield "data: [DONE]\n\n"
                 except Exception as e_stream_call:
+                    metrics.record_upstream_result(metrics.status_code_from_error(e_stream_call))
+                    upstream_span.record_exception(e_stream_call)
+                    upstream_span.end()
                     err_str = str(e_stream_call)
                     if location_manager and ("429" in err_str or "ResourceExhausted" in err_str):
                         location_manager.report_error(429)
                     
                     err_msg_detail_stream = f"Streaming Error (Gemini API, model string: '{model_to_call}'): {type(e_stream_call).__name__} - {str(e_stream_call)}"
-                    print(f"ERROR: {err_msg_detail_stream}")
+                    logger.error(err_msg_detail_stream)
                     s_err = str(e_stream_call); s_err = s_err[:1024]+"..." if len(s_err)>1024 else s_err
                     err_resp = create_openai_error_response(500,s_err,"server_error")
                     j_err = json.dumps(err_resp, ensure_ascii=False)
@@ -530,45 +785,244 @@ async def execute_gemini_call(
             return StreamingResponse(_gemini_real_stream_generator_inner(), media_type="text/event-stream")
     else: # Non-streaming
         try:
-            response_obj_call = await current_client.aio.models.generate_content(
-                model=model_to_call,
-                contents=actual_prompt_for_call,
-                config=gen_config_dict # Pass the dictionary directly
+            response_obj_call = await _generate_content_with_context_cache(
+                current_client, model_to_call, actual_prompt_for_call, gen_config_dict
             )
         except Exception as e_non_stream:
             err_str = str(e_non_stream)
             if location_manager and ("429" in err_str or "ResourceExhausted" in err_str):
                 location_manager.report_error(429)
             raise e_non_stream
-        if hasattr(response_obj_call, 'prompt_feedback') and \
-           hasattr(response_obj_call.prompt_feedback, 'block_reason') and \
-           response_obj_call.prompt_feedback.block_reason:
-            block_msg = f"Blocked (Gemini): {response_obj_call.prompt_feedback.block_reason}"
-            if hasattr(response_obj_call.prompt_feedback,'block_reason_message') and \
-               response_obj_call.prompt_feedback.block_reason_message: 
-                block_msg+=f" ({response_obj_call.prompt_feedback.block_reason_message})"
-            raise ValueError(block_msg)
+        _raise_for_invalid_response(response_obj_call, model_to_call)
         
-        if not is_gemini_response_valid(response_obj_call):
-            error_details = f"Invalid non-streaming Gemini response for model string '{model_to_call}'. "
-            if hasattr(response_obj_call, 'candidates'):
-                error_details += f"Candidates: {len(response_obj_call.candidates) if response_obj_call.candidates else 0}. "
-                if response_obj_call.candidates and len(response_obj_call.candidates) > 0:
-                    candidate = response_obj_call.candidates if isinstance(response_obj_call.candidates, list) else response_obj_call.candidates
-                    if hasattr(candidate, 'content'):
-                        error_details += "Has content. "
-                        if hasattr(candidate.content, 'parts'):
-                            error_details += f"Parts: {len(candidate.content.parts) if candidate.content.parts else 0}. "
-                            if candidate.content.parts and len(candidate.content.parts) > 0:
-                                part = candidate.content.parts if isinstance(candidate.content.parts, list) else candidate.content.parts
-                                if hasattr(part, 'text'):
-                                    text_preview = str(getattr(part, 'text', ''))[:100]
-                                    error_details += f"First part text: '{text_preview}'"
-                                elif hasattr(part, 'function_call'):
-                                    error_details += f"First part is function_call: {part.function_call.name}"
+        openai_response_content = await convert_to_openai_format(response_obj_call, request_obj.model)
+        return JSONResponse(content=openai_response_content)
+
+def _report_quota_error(location_manager: Any, error: BaseException):
+    err_str = str(error)
+    if location_manager and ("429" in err_str or "ResourceExhausted" in err_str):
+        location_manager.report_error(429)
+
+
+def _aggregate_usage(usages: List[Dict[str, int]]) -> Dict[str, int]:
+    """Sums the usage of every fan-out call; each call is billed for the full prompt."""
+    total = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for usage in usages:
+        for field in total:
+            total[field] += usage.get(field) or 0
+    return total
+
+
+def _usage_from_metadata(usage_metadata: Any) -> Dict[str, int]:
+    prompt_tokens = getattr(usage_metadata, 'prompt_token_count', None) or 0
+    completion_tokens = getattr(usage_metadata, 'candidates_token_count', None) or 0
+    total_tokens = getattr(usage_metadata, 'total_token_count', None) or (prompt_tokens + completion_tokens)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": total_tokens}
+
+
+def _fanout_call_configs(gen_config_dict: Dict[str, Any], n: int, calls: int) -> List[Dict[str, Any]]:
+    """Generation config of each fan-out call, splitting the n candidates as evenly as possible."""
+    base_config = {key: value for key, value in gen_config_dict.items() if key != "candidate_count"}
+    call_configs = []
+    for index in range(calls):
+        candidate_count = n // calls + (1 if index < n % calls else 0)
+        call_configs.append({**base_config, "candidate_count": candidate_count} if candidate_count > 1 else base_config)
+    return call_configs
+
+
+async def _gemini_fanout_response_dict(
+    clients: List[Any],
+    model_to_call: str,
+    prompt: List[types.Content],
+    call_configs: List[Dict[str, Any]],
+    request_obj: OpenAIRequest,
+    location_manager: Any = None
+) -> Dict[str, Any]:
+    results = await asyncio.gather(
+        *(_generate_content_with_context_cache(client, model_to_call, prompt, call_config) for client, call_config in zip(clients, call_configs)),
+        return_exceptions=True
+    )
+    choices = []
+    usages = []
+    errors = []
+    for result in results:
+        if isinstance(result, BaseException):
+            _report_quota_error(location_manager, result)
+            errors.append(result)
+            continue
+        try:
+            _raise_for_invalid_response(result, model_to_call)
+        except ValueError as e:
+            errors.append(e)
+            continue
+        response_dict = await convert_to_openai_format(result, request_obj.model)
+        for choice in response_dict["choices"]:
+            choice["index"] = len(choices)
+            choices.append(choice)
+        usages.append(response_dict["usage"])
+    if not choices:
+        raise errors[0]
+    if errors:
+        logger.warning("Fan-out for model '%s': %d of %d calls failed; returning %d choices. First error: %s", request_obj.model, len(errors), len(clients), len(choices), errors[0])
+    response_timestamp = int(time.time())
+    return {
+        "id": f"chatcmpl-{response_timestamp}-fanout", "object": "chat.completion", "created": response_timestamp,
+        "model": request_obj.model, "choices": choices, "usage": _aggregate_usage(usages)
+    }
+
+
+async def _gemini_fanout_fake_stream_generator(
+    clients: List[Any],
+    model_to_call: str,
+    prompt: List[types.Content],
+    call_configs: List[Dict[str, Any]],
+    request_obj: OpenAIRequest,
+    location_manager: Any = None
+):
+    api_call_task = asyncio.create_task(
+        _gemini_fanout_response_dict(clients, model_to_call, prompt, call_configs, request_obj, location_manager)
+    )
+    outer_keep_alive_interval = app_config.FAKE_STREAMING_INTERVAL_SECONDS
+    if outer_keep_alive_interval > 0:
+        while not api_call_task.done():
+            keep_alive_data = {"id": "chatcmpl-keepalive", "object": "chat.completion.chunk", "created": int(time.time()), "model": request_obj.model, "choices": [{"delta": {"content": ""}, "index": 0, "finish_reason": None}]}
+            yield f"data: {json.dumps(keep_alive_data, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(outer_keep_alive_interval)
+    try:
+        openai_response_dict = await api_call_task
+        async for chunk_sse in _chunk_openai_response_dict_for_sse(openai_response_dict=openai_response_dict):
+            yield chunk_sse
+    except Exception as e_fanout:
+        logger.error("Error in fan-out fake stream (model: '%s'): %s - %s", request_obj.model, type(e_fanout).__name__, e_fanout)
+        sse_err_msg_display = str(e_fanout)
+        if len(sse_err_msg_display) > 512: sse_err_msg_display = sse_err_msg_display[:512] + "..."
+        yield f"data: {json.dumps(create_openai_error_response(500, sse_err_msg_display, 'server_error'), ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+async def _gemini_fanout_stream_generator(
+    clients: List[Any],
+    model_to_call: str,
+    prompt: List[types.Content],
+    call_configs: List[Dict[str, Any]],
+    request_obj: OpenAIRequest,
+    location_manager: Any = None
+):
+    """
+    Runs one stream per client and interleaves their chunks as they arrive, each stream
+    feeding the next candidate_count choices. A failed stream ends its choices with
+    finish_reason 'error'; the request only fails if every stream does.
+    """
+    first_choice_index = [0]
+    for call_config in call_configs[:-1]:
+        first_choice_index.append(first_choice_index[-1] + call_config.get("candidate_count", 1))
+    response_id = f"chatcmpl-realstream-{int(time.time())}"
+    queue: asyncio.Queue = asyncio.Queue()
+    usage_by_index: Dict[int, Dict[str, int]] = {}
+    stream_state = StreamState()
+
+    async def pump(index: int, client: Any, call_config: Dict[str, Any]):
+        upstream_span = tracing.start_span("upstream.generate_content_stream", tracing.SPAN_KIND_CLIENT, {
+            "gen_ai.system": "vertex_ai", "gen_ai.request.model": model_to_call, "voutb.fanout.index": index,
+        })
+        try:
+            stream = _trace_first_chunk(await _generate_content_stream_with_context_cache(
+                client, model_to_call, prompt, call_config
+            ), upstream_span)
+            async for chunk in stream:
+                await queue.put((index, chunk))
+            metrics.record_upstream_result("200")
+            upstream_span.end()
+        except Exception as e:
+            metrics.record_upstream_result(metrics.status_code_from_error(e))
+            upstream_span.record_exception(e)
+            upstream_span.end()
+            _report_quota_error(location_manager, e)
+            await queue.put((index, e))
+        finally:
+            await queue.put((index, None))
+
+    tasks = [asyncio.create_task(pump(index, client, call_config)) for index, (client, call_config) in enumerate(zip(clients, call_configs))]
+    # Image models can stay silent for a long time; keep the connection alive meanwhile.
+    keep_alive_timeout = 5.0 if "image" in request_obj.model else None
+    remaining = len(tasks)
+    failures: Dict[int, Exception] = {}
+    try:
+        while remaining:
+            try:
+                index, item = await asyncio.wait_for(queue.get(), timeout=keep_alive_timeout)
+            except asyncio.TimeoutError:
+                keep_alive_chunk = {
+                    "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": request_obj.model,
+                    "choices": [{"index": 0, "delta": {"reasoning_content": " "}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(keep_alive_chunk, ensure_ascii=False)}\n\n"
+                continue
+            if item is None:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                logger.error("Fan-out stream %d for model '%s' failed: %s - %s", index, model_to_call, type(item).__name__, item)
+                failures[index] = item
             else:
-                error_details += f"Response type: {type(response_obj_call).__name__}"
-            raise ValueError(error_details)
-        
-        openai_response_content = convert_to_openai_format(response_obj_call, request_obj.model)
-        return JSONResponse(content=openai_response_content)
\ No newline at end of file
+                usage_metadata = getattr(item, 'usage_metadata', None)
+                if usage_metadata is not None:
+                    usage_by_index[index] = _usage_from_metadata(usage_metadata)
+                yield await convert_chunk_to_openai(item, request_obj.model, response_id, first_choice_index[index], stream_state)
+    finally:
+        for task in tasks:
+            task.cancel()
+    flush_chunk = create_stream_flush_chunk(stream_state, request_obj.model, response_id)
+    if flush_chunk:
+        yield flush_chunk
+
+    if len(failures) == len(clients):
+        s_err = str(next(iter(failures.values()))); s_err = s_err[:1024]+"..." if len(s_err)>1024 else s_err
+        yield f"data: {json.dumps(create_openai_error_response(500, s_err, 'server_error'), ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+    if failures:
+        failed_choices = [
+            {"index": first_choice_index[index] + offset, "delta": {}, "finish_reason": "error"}
+            for index in sorted(failures) for offset in range(call_configs[index].get("candidate_count", 1))
+        ]
+        yield f"data: {json.dumps({'id': response_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': request_obj.model, 'choices': failed_choices}, ensure_ascii=False)}\n\n"
+    stream_options = getattr(request_obj, "stream_options", None)
+    if isinstance(stream_options, dict) and stream_options.get("include_usage"):
+        usage_chunk = {
+            "id": response_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": request_obj.model,
+            "choices": [], "usage": _aggregate_usage(list(usage_by_index.values()))
+        }
+        yield f"data: {json.dumps(usage_chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def execute_gemini_fanout_call(
+    clients: List[Any],
+    model_to_call: str,
+    prompt_func: Callable[[List[OpenAIMessage]], Awaitable[List[types.Content]]],
+    gen_config_dict: Dict[str, Any],
+    request_obj: OpenAIRequest,
+    location_manager: Any = None
+):
+    """
+    Serves n>1 as len(clients) calls running concurrently, one per client (each on its own
+    key or credential), instead of one call with candidate_count=n. The n candidates are
+    split between the calls, so best-of-n costs the latency of the largest share.
+    """
+    conversion_started_at = time.perf_counter()
+    with tracing.use_span("prompt.convert", attributes={"voutb.prompt.strategy": prompt_func.__name__, "voutb.prompt.messages": len(request_obj.messages)}):
+        actual_prompt_for_call = await prompt_func(request_obj.messages)
+    metrics.PROMPT_CONVERSION_DURATION.observe(time.perf_counter() - conversion_started_at, prompt_func.__name__)
+    call_configs = _fanout_call_configs(gen_config_dict, request_obj.n or len(clients), len(clients))
+    logger.info("execute_gemini_fanout_call for model '%s': %d concurrent calls. Original request model: '%s'", model_to_call, len(clients), request_obj.model)
+
+    if request_obj.stream:
+        generator = _gemini_fanout_fake_stream_generator if app_config.FAKE_STREAMING_ENABLED else _gemini_fanout_stream_generator
+        return StreamingResponse(
+            generator(clients, model_to_call, actual_prompt_for_call, call_configs, request_obj, location_manager),
+            media_type="text/event-stream"
+        )
+    openai_response_content = await _gemini_fanout_response_dict(
+        clients, model_to_call, actual_prompt_for_call, call_configs, request_obj, location_manager
+    )
+    return JSONResponse(content=openai_response_content)
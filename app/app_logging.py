@@ -0,0 +1,156 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import uuid
+from typing import Optional
+
+import config as app_config
+
+ROOT_LOGGER_NAME = "voutb"
+
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("voutb_request_id", default="-")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(component: str) -> logging.Logger:
+    """Logger for one component; its level can be set per component with LOG_COMPONENTS."""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{component}")
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """Sets the request id for the current context (reusing a client-supplied one) and returns it."""
+    request_id = (incoming or "")[:64] or uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+class _RequestContextFilter(logging.Filter):
+    """Stamps records with the request id and drops a share of DEBUG records when sampling."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG:
+            sample_rate = app_config.LOG_DEBUG_SAMPLE_RATE
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return False
+        record.request_id = _request_id.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread; only make the record safe to hand over.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "component": record.name[len(ROOT_LOGGER_NAME) + 1:] or ROOT_LOGGER_NAME,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        component = record.name[len(ROOT_LOGGER_NAME) + 1:] or ROOT_LOGGER_NAME
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname}: [{component}] [{getattr(record, 'request_id', '-')}] {record.getMessage()}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+def _level(value, default: int) -> int:
+    if isinstance(value, int):
+        return value
+    level = logging.getLevelName(str(value).upper())
+    return level if isinstance(level, int) else default
+
+
+def apply_log_levels():
+    """Applies LOG_LEVEL and the per-component LOG_COMPONENTS overrides (e.g. {"prompt": "DEBUG"})."""
+    root_level = _level(app_config.LOG_LEVEL, logging.INFO)
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(root_level)
+    components = app_config.LOG_COMPONENTS
+    manager = logging.Logger.manager
+    for name, logger in list(manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and name.startswith(ROOT_LOGGER_NAME + "."):
+            logger.setLevel(logging.NOTSET)
+    if isinstance(components, dict):
+        for component, level in components.items():
+            get_logger(component).setLevel(_level(level, root_level))
+
+
+def setup_logging():
+    """
+    Routes all component loggers through a non-blocking queue. A background thread drains
+    it and writes to stdout, so the event loop never waits on stdout.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.propagate = False
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_RequestContextFilter())
+    root.handlers = [queue_handler]
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if str(app_config.LOG_FORMAT).lower() == "json" else TextFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    apply_log_levels()
+
+
+def shutdown_logging():
+    """Flushes queued records; call on application shutdown."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """ASGI middleware that gives every HTTP request an id (X-Request-Id) for log correlation."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")
+                break
+        request_id = new_request_id(incoming)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
@@ -5,6 +5,10 @@ import config as app_config # Import config module dynamically
 import os
 import json
 import base64
+from app_logging import get_logger
+import tracing
+
+logger = get_logger("auth")
 
 # Function to validate API key (moved from config.py)
 def validate_api_key(api_key_to_validate: str) -> bool:
@@ -26,6 +30,10 @@ async def get_api_key(
     authorization: Optional[str] = Header(None),
     x_ip_token: Optional[str] = Header(None, alias="x-ip-token")
 ):
+    with tracing.use_span("auth"):
+        return await _check_api_key(authorization, x_ip_token)
+
+async def _check_api_key(authorization: Optional[str], x_ip_token: Optional[str]):
     # Check if Hugging Face auth is enabled
     if app_config.HUGGINGFACE:  # Use HUGGINGFACE from config dynamically
         if x_ip_token is None:
@@ -46,13 +54,13 @@ async def get_api_key(
             payload = json.loads(decoded_payload_bytes.decode('utf-8'))
         except ValueError as ve:
             # Log server-side for debugging, but return a generic client error
-            print(f"ValueError processing x-ip-token: {ve}")
+            logger.debug("ValueError processing x-ip-token: %s", ve)
             raise HTTPException(status_code=400, detail=f"Invalid JWT format in x-ip-token: {str(ve)}")
         except (json.JSONDecodeError, base64.binascii.Error, UnicodeDecodeError) as e:
-            print(f"Error decoding/parsing x-ip-token payload: {e}")
+            logger.error("Error decoding/parsing x-ip-token payload: %s", e)
             raise HTTPException(status_code=400, detail=f"Malformed x-ip-token payload: {str(e)}")
         except Exception as e: # Catch any other unexpected errors during token processing
-            print(f"Unexpected error processing x-ip-token: {e}")
+            logger.debug("Unexpected error processing x-ip-token: %s", e)
             raise HTTPException(status_code=500, detail="Internal error processing x-ip-token.")
 
         error_in_token = payload.get("error")
@@ -64,7 +72,7 @@ async def get_api_key(
             )
         elif error_in_token is None:  # JSON 'null' is Python's None
             # If error is null, auth is successful. Now check if HUGGINGFACE_API_KEY is configured.
-            print(f"HuggingFace authentication successful via x-ip-token (error field was null).")
+            logger.debug("HuggingFace authentication successful via x-ip-token (error field was null).")
             return app_config.HUGGINGFACE_API_KEY # Return the configured HUGGINGFACE_API_KEY dynamically
         else:
             # Any other non-null, non-"InvalidAccessToken" value in 'error' field
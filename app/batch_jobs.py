@@ -0,0 +1,500 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("batch")
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+TERMINAL_STATUSES = ("failed", "completed", "expired", "cancelled")
+# Statuses a scheduler picks up, including batches left behind by a stopped worker.
+RUNNABLE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+LEASE_SECONDS = 60.0
+IDLE_POLL_SECONDS = 5.0
+MAX_RETRY_DELAY_SECONDS = 30.0
+
+# (status_code, response body) for one request body; chat_api.run_chat_completion in the app.
+BatchExecutor = Callable[[Dict[str, Any]], Awaitable[Tuple[int, Dict[str, Any]]]]
+
+
+class BatchValidationError(ValueError):
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__(errors[0]["message"] if errors else "Invalid batch input")
+        self.errors = errors
+
+
+def _default_batch_dir() -> str:
+    return os.path.join(app_config.BASE_DIR, "batches")
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}{uuid.uuid4().hex[:24]}"
+
+
+class BatchStore:
+    """
+    Files and batch jobs in a SQLite database plus one file per upload under BATCH_DIR.
+    Every finished request is written back immediately, so a restarted scheduler only
+    re-runs the requests that were still pending.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.path = os.path.join(root, "batches.sqlite3")
+        self._local = threading.local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY, filename TEXT NOT NULL, purpose TEXT NOT NULL,
+                bytes INTEGER NOT NULL, created_at INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at INTEGER NOT NULL, data TEXT NOT NULL,
+                lease_owner TEXT, lease_expires_at REAL);
+            CREATE TABLE IF NOT EXISTS batch_requests (
+                batch_id TEXT NOT NULL, line INTEGER NOT NULL, custom_id TEXT NOT NULL, body TEXT NOT NULL,
+                status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT,
+                PRIMARY KEY (batch_id, line));
+            CREATE INDEX IF NOT EXISTS batch_requests_status ON batch_requests (batch_id, status);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    # Files
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def add_file(self, file_id: str, filename: str, purpose: str, size: int) -> Dict[str, Any]:
+        created_at = int(time.time())
+        self._connection().execute(
+            "INSERT INTO files (id, filename, purpose, bytes, created_at) VALUES (?, ?, ?, ?, ?)",
+            (file_id, filename, purpose, size, created_at))
+        return self._file_object((file_id, filename, purpose, size, created_at))
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT id, filename, purpose, bytes, created_at FROM files WHERE id = ?", (file_id,)).fetchone()
+        return self._file_object(row) if row else None
+
+    def list_files(self, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = "SELECT id, filename, purpose, bytes, created_at FROM files"
+        params: Tuple = ()
+        if purpose:
+            query += " WHERE purpose = ?"
+            params = (purpose,)
+        rows = self._connection().execute(query + " ORDER BY created_at DESC", params).fetchall()
+        return [self._file_object(row) for row in rows]
+
+    def delete_file(self, file_id: str) -> bool:
+        deleted = self._connection().execute("DELETE FROM files WHERE id = ?", (file_id,)).rowcount > 0
+        if deleted:
+            try:
+                os.remove(self.file_path(file_id))
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    @staticmethod
+    def _file_object(row) -> Dict[str, Any]:
+        file_id, filename, purpose, size, created_at = row
+        return {"id": file_id, "object": "file", "bytes": size, "created_at": created_at,
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    # Batches
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[Dict[str, str]]) -> Dict[str, Any]:
+        created_at = int(time.time())
+        batch = {
+            "id": _new_id("batch_"), "object": "batch", "endpoint": endpoint, "errors": None,
+            "input_file_id": input_file_id, "completion_window": completion_window, "status": "validating",
+            "output_file_id": None, "error_file_id": None, "created_at": created_at,
+            "in_progress_at": None, "expires_at": created_at + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None, "completed_at": None, "failed_at": None, "expired_at": None,
+            "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self._connection().execute(
+            "INSERT INTO batches (id, status, created_at, data) VALUES (?, ?, ?, ?)",
+            (batch["id"], batch["status"], created_at, json.dumps(batch)))
+        return batch
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if not row:
+            return None
+        batch = json.loads(row[0])
+        if batch["status"] not in TERMINAL_STATUSES:
+            batch["request_counts"] = self.request_counts(batch_id)
+        return batch
+
+    def list_batches(self, limit: int = 20, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        query, params = "SELECT id FROM batches", []
+        if after:
+            query += " WHERE (created_at, id) < (SELECT created_at, id FROM batches WHERE id = ?)"
+            params.append(after)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return [self.get_batch(row[0]) for row in self._connection().execute(query, params).fetchall()]
+
+    def update_batch(self, batch_id: str, **fields) -> Dict[str, Any]:
+        """Applies fields to the stored batch object in one transaction and returns it."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            batch = json.loads(connection.execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()[0])
+            batch.update(fields)
+            connection.execute("UPDATE batches SET status = ?, data = ? WHERE id = ?", (batch["status"], json.dumps(batch), batch_id))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return batch
+
+    def request_cancel(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        batch = self.get_batch(batch_id)
+        if batch is None or batch["status"] in TERMINAL_STATUSES or batch["status"] == "cancelling":
+            return batch
+        return self.update_batch(batch_id, status="cancelling", cancelling_at=int(time.time()))
+
+    def status(self, batch_id: str) -> str:
+        return self._connection().execute("SELECT status FROM batches WHERE id = ?", (batch_id,)).fetchone()[0]
+
+    # Leases keep two workers sharing BATCH_DIR from running the same batch.
+
+    def claim_next_batch(self, owner: str) -> Optional[str]:
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                f"SELECT id, lease_owner, lease_expires_at FROM batches WHERE status IN ({','.join('?' * len(RUNNABLE_STATUSES))}) "
+                "ORDER BY created_at, id", RUNNABLE_STATUSES).fetchall()
+            claimed = None
+            for batch_id, lease_owner, lease_expires_at in rows:
+                if lease_owner in (None, owner) or (lease_expires_at or 0) < now or _lease_owner_is_dead(lease_owner):
+                    connection.execute("UPDATE batches SET lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                                       (owner, now + LEASE_SECONDS, batch_id))
+                    claimed = batch_id
+                    break
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def renew_lease(self, batch_id: str, owner: str):
+        self._connection().execute("UPDATE batches SET lease_expires_at = ? WHERE id = ? AND lease_owner = ?",
+                                   (time.time() + LEASE_SECONDS, batch_id, owner))
+
+    def release_lease(self, batch_id: str, owner: str):
+        self._connection().execute("UPDATE batches SET lease_owner = NULL, lease_expires_at = NULL WHERE id = ? AND lease_owner = ?",
+                                   (batch_id, owner))
+
+    # Requests
+
+    def add_requests(self, batch_id: str, requests: List[Tuple[int, str, str]]):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR IGNORE INTO batch_requests (batch_id, line, custom_id, body, status) VALUES (?, ?, ?, ?, 'pending')",
+                [(batch_id, line, custom_id, body) for line, custom_id, body in requests])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def pending_requests(self, batch_id: str) -> List[Tuple[int, str, str, int]]:
+        return self._connection().execute(
+            "SELECT line, custom_id, body, attempts FROM batch_requests WHERE batch_id = ? AND status = 'pending' ORDER BY line",
+            (batch_id,)).fetchall()
+
+    def record_attempt(self, batch_id: str, line: int, attempts: int):
+        self._connection().execute("UPDATE batch_requests SET attempts = ? WHERE batch_id = ? AND line = ?", (attempts, batch_id, line))
+
+    def record_result(self, batch_id: str, line: int, status: str, result: Dict[str, Any]):
+        self._connection().execute("UPDATE batch_requests SET status = ?, result = ? WHERE batch_id = ? AND line = ?",
+                                   (status, json.dumps(result, ensure_ascii=False), batch_id, line))
+
+    def request_counts(self, batch_id: str) -> Dict[str, int]:
+        counts = dict(self._connection().execute(
+            "SELECT status, COUNT(*) FROM batch_requests WHERE batch_id = ? GROUP BY status", (batch_id,)).fetchall())
+        return {"total": sum(counts.values()), "completed": counts.get("completed", 0), "failed": counts.get("failed", 0)}
+
+    def results(self, batch_id: str, status: str):
+        cursor = self._connection().execute(
+            "SELECT result FROM batch_requests WHERE batch_id = ? AND status = ? ORDER BY line", (batch_id, status))
+        for (result,) in cursor:
+            yield result
+
+
+def _lease_owner_is_dead(owner: str) -> bool:
+    """True if the lease belongs to a process on this host that no longer exists."""
+    host, _, rest = owner.partition(":")
+    pid = rest.partition(":")[0]
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def parse_batch_input(path: str, endpoint: str) -> List[Tuple[int, str, str]]:
+    """Validates an uploaded JSONL file and returns (line, custom_id, body JSON) per request."""
+    requests, errors, custom_ids = [], [], set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, raw_line in enumerate(f, start=1):
+            if not raw_line.strip():
+                continue
+            try:
+                item = json.loads(raw_line)
+            except json.JSONDecodeError as e:
+                errors.append({"code": "invalid_json_line", "message": f"Line {line_no} is not valid JSON: {e}", "line": line_no})
+                continue
+            if not isinstance(item, dict):
+                errors.append({"code": "invalid_request", "message": f"Line {line_no} is not a JSON object.", "line": line_no})
+                continue
+            custom_id = item.get("custom_id")
+            if not isinstance(custom_id, str) or not custom_id:
+                errors.append({"code": "missing_required_parameter", "message": f"Line {line_no} has no custom_id.", "line": line_no})
+            elif custom_id in custom_ids:
+                errors.append({"code": "duplicate_custom_id", "message": f"Line {line_no} repeats custom_id '{custom_id}'.", "line": line_no})
+            if str(item.get("method", "")).upper() != "POST":
+                errors.append({"code": "invalid_method", "message": f"Line {line_no} must use method POST.", "line": line_no})
+            if item.get("url") != endpoint:
+                errors.append({"code": "mismatched_endpoint", "message": f"Line {line_no} url must be '{endpoint}'.", "line": line_no})
+            if not isinstance(item.get("body"), dict):
+                errors.append({"code": "invalid_request", "message": f"Line {line_no} has no request body.", "line": line_no})
+            if errors and errors[-1]["line"] == line_no:
+                continue
+            custom_ids.add(custom_id)
+            requests.append((line_no, custom_id, json.dumps(item["body"], ensure_ascii=False)))
+    if not requests and not errors:
+        errors.append({"code": "empty_file", "message": "The input file contains no requests.", "line": None})
+    if errors:
+        raise BatchValidationError(errors[:100])
+    return requests
+
+
+class BatchScheduler:
+    """
+    Runs stored batches one at a time in a background task. Each batch is worked by a pool
+    sized to the configured Express keys and SA credentials, so it saturates their safe
+    concurrency without crowding out interactive traffic beyond BATCH_MAX_CONCURRENCY.
+    """
+
+    def __init__(self, store: BatchStore):
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._executor: Optional[BatchExecutor] = None
+        self._concurrency: Callable[[], int] = lambda: 1
+
+    def start(self, executor: BatchExecutor, concurrency: Callable[[], int]):
+        if self._task is not None:
+            return
+        self._executor = executor
+        self._concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                batch_id = await asyncio.to_thread(self.store.claim_next_batch, self.owner)
+            except sqlite3.Error as e:
+                logger.error("Failed to claim a batch: %s", e)
+                batch_id = None
+            if batch_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=IDLE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            renew_task = asyncio.create_task(self._renew_lease(batch_id))
+            try:
+                await self._process(batch_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Batch %s failed: %s", batch_id, e)
+                await asyncio.to_thread(self.store.update_batch, batch_id, status="failed", failed_at=int(time.time()),
+                                        errors={"object": "list", "data": [{"code": "server_error", "message": str(e), "line": None}]})
+            finally:
+                renew_task.cancel()
+                await asyncio.to_thread(self.store.release_lease, batch_id, self.owner)
+
+    async def _renew_lease(self, batch_id: str):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            await asyncio.to_thread(self.store.renew_lease, batch_id, self.owner)
+
+    async def _process(self, batch_id: str):
+        batch = await asyncio.to_thread(self.store.get_batch, batch_id)
+        if batch["status"] == "validating":
+            try:
+                requests = await asyncio.to_thread(
+                    parse_batch_input, self.store.file_path(batch["input_file_id"]), batch["endpoint"])
+            except (BatchValidationError, OSError) as e:
+                errors = e.errors if isinstance(e, BatchValidationError) else [{"code": "file_unreadable", "message": str(e), "line": None}]
+                logger.warning("Batch %s failed validation: %s", batch_id, errors[0]["message"])
+                await asyncio.to_thread(self.store.update_batch, batch_id, status="failed", failed_at=int(time.time()),
+                                        errors={"object": "list", "data": errors})
+                return
+            await asyncio.to_thread(self.store.add_requests, batch_id, requests)
+            batch = await asyncio.to_thread(self.store.update_batch, batch_id, status="in_progress", in_progress_at=int(time.time()))
+            logger.info("Batch %s started with %d requests", batch_id, len(requests))
+
+        if batch["status"] == "in_progress":
+            await self._run_requests(batch)
+
+        status = await asyncio.to_thread(self.store.status, batch_id)
+        if status in ("in_progress", "finalizing", "cancelling"):
+            await self._finalize(batch_id, status)
+
+    async def _run_requests(self, batch: Dict[str, Any]):
+        batch_id = batch["id"]
+        queue: asyncio.Queue = asyncio.Queue()
+        for pending in await asyncio.to_thread(self.store.pending_requests, batch_id):
+            queue.put_nowait(pending)
+        if queue.empty():
+            return
+        workers = max(1, min(self._concurrency(), queue.qsize()))
+        logger.info("Batch %s: %d pending requests, %d workers", batch_id, queue.qsize(), workers)
+
+        async def worker():
+            while not queue.empty():
+                # Taken before the status check, which yields; a request left untaken stays pending
+                line, custom_id, body, attempts = queue.get_nowait()
+                if await asyncio.to_thread(self.store.status, batch_id) != "in_progress":
+                    return
+                if time.time() > batch["expires_at"]:
+                    await asyncio.to_thread(self.store.update_batch, batch_id, status="finalizing", expired_at=int(time.time()))
+                    return
+                await self._run_request(batch_id, line, custom_id, json.loads(body), attempts)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    async def _run_request(self, batch_id: str, line: int, custom_id: str, body: Dict[str, Any], attempts: int):
+        request_id = _new_id("batch_req_")
+        while True:
+            attempts += 1
+            await asyncio.to_thread(self.store.record_attempt, batch_id, line, attempts)
+            try:
+                status_code, response_body = await self._executor(body)
+                error = None
+            except Exception as e:
+                status_code, response_body, error = None, None, {"code": "server_error", "message": str(e)}
+            retryable = status_code is None or status_code in RETRYABLE_STATUS_CODES
+            if status_code == 200 or not retryable or attempts >= app_config.BATCH_MAX_ATTEMPTS:
+                break
+            delay = min(MAX_RETRY_DELAY_SECONDS, 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+            logger.debug("Batch %s request %s attempt %d failed (%s); retrying in %.1fs", batch_id, custom_id, attempts, status_code or error["message"], delay)
+            await asyncio.sleep(delay)
+
+        result = {
+            "id": request_id, "custom_id": custom_id,
+            "response": {"status_code": status_code, "request_id": request_id, "body": response_body} if status_code is not None else None,
+            "error": error,
+        }
+        await asyncio.to_thread(self.store.record_result, batch_id, line, "completed" if status_code == 200 else "failed", result)
+
+    async def _finalize(self, batch_id: str, status: str):
+        # A cancelled batch keeps its status while the partial results are written out
+        batch = await asyncio.to_thread(self.store.update_batch, batch_id, status="finalizing" if status != "cancelling" else status,
+                                        finalizing_at=int(time.time()))
+        output_file_id = await asyncio.to_thread(self._write_results, batch_id, "completed", f"{batch_id}_output.jsonl")
+        error_file_id = await asyncio.to_thread(self._write_results, batch_id, "failed", f"{batch_id}_error.jsonl")
+        now = int(time.time())
+        if status == "cancelling":
+            final = {"status": "cancelled", "cancelled_at": now}
+        elif batch.get("expired_at"):
+            final = {"status": "expired"}
+        else:
+            final = {"status": "completed", "completed_at": now}
+        counts = await asyncio.to_thread(self.store.request_counts, batch_id)
+        await asyncio.to_thread(self.store.update_batch, batch_id, output_file_id=output_file_id, error_file_id=error_file_id,
+                                request_counts=counts, **final)
+        logger.info("Batch %s %s: %d completed, %d failed", batch_id, final["status"], counts["completed"], counts["failed"])
+
+    def _write_results(self, batch_id: str, status: str, filename: str) -> Optional[str]:
+        file_id = _new_id("file-")
+        path = self.store.file_path(file_id)
+        size = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for result in self.store.results(batch_id, status):
+                size += f.write(result + "\n")
+        if size == 0:
+            os.remove(path)
+            return None
+        self.store.add_file(file_id, filename, "batch_output", os.path.getsize(path))
+        return file_id
+
+
+# Global singleton
+_batch_store_instance: Optional[BatchStore] = None
+_batch_scheduler_instance: Optional[BatchScheduler] = None
+_batch_store_lock = threading.Lock()
+
+
+def get_batch_store() -> BatchStore:
+    """Returns the batch store, creating BATCH_DIR on first use (blocking; call it off the loop)."""
+    global _batch_store_instance
+    if _batch_store_instance is None:
+        with _batch_store_lock:
+            if _batch_store_instance is None:
+                _batch_store_instance = BatchStore(app_config.BATCH_DIR or _default_batch_dir())
+    return _batch_store_instance
+
+
+def get_batch_scheduler() -> BatchScheduler:
+    global _batch_scheduler_instance
+    if _batch_scheduler_instance is None:
+        _batch_scheduler_instance = BatchScheduler(get_batch_store())
+    return _batch_scheduler_instance
+
+
+async def stop_batch_scheduler():
+    if _batch_scheduler_instance is not None:
+        await _batch_scheduler_instance.stop()
@@ -0,0 +1,343 @@
+"""
+Incremental ingestion of chat request bodies.
+
+The body is read chunk by chunk and every base64 data URL payload of at least
+BODY_SPOOL_MIN_BYTES is written to a per-request spool file, leaving a short reference
+("data:image/png;base64,~voutb-spool~<digest>") in the JSON that is parsed and validated.
+References are only kept in the content of non-tool messages, and are decoded when an
+image part is built for the upstream request; text sent upstream as text gets the original
+payload back. The spool is closed once the response has been sent (see close_after).
+"""
+import binascii
+import contextvars
+import hashlib
+import json
+import re
+import tempfile
+import threading
+from typing import Any, AsyncIterable, Dict, List, Optional, Tuple
+
+from starlette.background import BackgroundTasks
+from starlette.responses import StreamingResponse
+
+import codec
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("body")
+
+REFERENCE_PREFIX = "~voutb-spool~"
+# The digest keeps references stable across requests, so cache keys match for the same image
+REFERENCE_PATTERN = re.compile(re.escape(REFERENCE_PREFIX) + r"([0-9a-f]{32})")
+
+_DATA_URL_HEADER_PATTERN = re.compile(rb"data:[\w.+-]{1,64}/[\w.+-]{1,64};base64,")
+_MAX_DATA_URL_HEADER_BYTES = 160
+# Base64 characters, and "\/" which JSON encoders may write for "/"
+_BASE64_RUN_PATTERN = re.compile(rb"[A-Za-z0-9+/=]*(?:\\/[A-Za-z0-9+/=]*)*")
+# A payload is only replaced when it ends the string or the markdown image it is part of
+_PAYLOAD_TERMINATORS = (b'"', b")")
+_READ_SLICE_CHARS = 4 * 1024 * 1024  # Multiple of 4: each slice is whole base64 groups
+
+_current_spool: contextvars.ContextVar[Optional["BodySpool"]] = contextvars.ContextVar("voutb_body_spool", default=None)
+
+
+class BodySpool:
+    """
+    Anonymous temporary file holding the spooled payloads of one request, by digest. The
+    file is unlinked on creation, so nothing is left behind if close() is never reached.
+    After close() every payload lookup returns None.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self._directory = directory or None
+        self._file = None
+        self._size = 0
+        self._entries: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def write(self, data: bytes) -> int:
+        """Appends data to the spool file and returns the offset it was written at."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="voutb-body-", dir=self._directory)
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+        return offset
+
+    def commit(self, key: str, offset: int):
+        """Records the data written since offset as payload key (kept once per digest)."""
+        if key in self._entries:
+            self.truncate(offset)
+        else:
+            self._entries[key] = (offset, self._size - offset)
+
+    def truncate(self, offset: int) -> bytes:
+        """Drops the data written since offset and returns it."""
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(self._size - offset)
+            self._file.truncate(offset)
+            self._size = offset
+        return data
+
+    def _read(self, offset: int, length: int) -> bytes:
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def payload(self, key: str) -> Optional[bytes]:
+        """The base64 payload spooled under key, or None if this request has no such payload."""
+        entry = self._entries.get(key)
+        return self._read(*entry) if entry is not None else None
+
+    def decode(self, key: str) -> Optional[bytes]:
+        """
+        Decodes the payload spooled under key slice by slice, so the base64 text is never
+        held in memory as a whole.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        try:
+            return b"".join([
+                binascii.a2b_base64(self._read(offset + start, min(_READ_SLICE_CHARS, length - start)))
+                for start in range(0, length, _READ_SLICE_CHARS)
+            ])
+        except binascii.Error:
+            # Padding inside the payload moved a slice boundary off a base64 group
+            return binascii.a2b_base64(self._read(offset, length))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._entries.clear()
+
+
+class _DataUrlSpooler:
+    """
+    Rewrites a JSON body as it streams in, moving base64 data URL payloads of at least
+    min_bytes to the spool. Works on raw bytes without tracking the JSON structure: a data
+    URL header followed by a long base64 run can only occur inside a string.
+    """
+
+    def __init__(self, spool: BodySpool, min_bytes: int):
+        self._spool = spool
+        self._min_bytes = max(1, min_bytes)
+        self._pending = b""
+        self._in_payload = False
+        self._buffer: Optional[bytearray] = None  # Payload not yet spilled to the spool
+        self._offset: Optional[int] = None  # Spool offset of the payload once spilled
+        self._hasher = None
+
+    def feed(self, chunk: bytes) -> bytes:
+        return self._process(self._pending + chunk, False)
+
+    def finish(self) -> bytes:
+        return self._process(self._pending, True)
+
+    def _process(self, data: bytes, final: bool) -> bytes:
+        self._pending = b""
+        out: List[bytes] = []
+        position = 0
+        while position < len(data) or (final and self._in_payload):
+            if self._in_payload:
+                end = _BASE64_RUN_PATTERN.match(data, position).end()
+                if not final and (end == len(data) or (end == len(data) - 1 and data[end:] == b"\\")):
+                    # The payload (or a "\/" escape) continues in the next chunk
+                    self._append(data[position:end])
+                    self._pending = data[end:]
+                    break
+                self._append(data[position:end])
+                out.append(self._end_payload(data[end:end + 1]))
+                position = end
+                continue
+
+            index = data.find(b"data:", position)
+            if index == -1:
+                # Hold back what could be the start of "data:"
+                split = len(data) if final else max(position, len(data) - 4)
+                out.append(data[position:split])
+                self._pending = data[split:]
+                break
+            match = _DATA_URL_HEADER_PATTERN.match(data, index)
+            if match is None:
+                if not final and len(data) - index < _MAX_DATA_URL_HEADER_BYTES:
+                    out.append(data[position:index])
+                    self._pending = data[index:]
+                    break
+                out.append(data[position:index + 5])
+                position = index + 5
+                continue
+            out.append(data[position:match.end()])
+            position = match.end()
+            self._in_payload = True
+            self._buffer = bytearray()
+            self._offset = None
+            self._hasher = hashlib.blake2b(digest_size=16)
+        return b"".join(out)
+
+    def _append(self, piece: bytes):
+        if not piece:
+            return
+        if b"\\" in piece:
+            piece = piece.replace(b"\\/", b"/")
+        self._hasher.update(piece)
+        if self._offset is not None:
+            self._spool.write(piece)
+            return
+        self._buffer += piece
+        if len(self._buffer) >= self._min_bytes:
+            self._offset = self._spool.write(bytes(self._buffer))
+            self._buffer = None
+
+    def _end_payload(self, terminator: bytes) -> bytes:
+        self._in_payload = False
+        if self._offset is None:
+            payload, self._buffer = bytes(self._buffer), None
+            return payload
+        if terminator not in _PAYLOAD_TERMINATORS:
+            # Line-wrapped or otherwise unusual payload: keep it inline as it was
+            return self._spool.truncate(self._offset)
+        key = self._hasher.hexdigest()
+        self._spool.commit(key, self._offset)
+        return (REFERENCE_PREFIX + key).encode("ascii")
+
+
+async def read_json_body(chunks: AsyncIterable[bytes]) -> Any:
+    """
+    Parses a JSON request body from its chunks. With BODY_SPOOL_ENABLED, large data URL
+    payloads are spooled to a temporary file for the current request (see the module
+    docstring); raises json.JSONDecodeError for malformed bodies.
+    """
+    if not app_config.BODY_SPOOL_ENABLED:
+        return json.loads(b"".join([chunk async for chunk in chunks]))
+
+    spool = BodySpool(app_config.BODY_SPOOL_DIR)
+    spooler = _DataUrlSpooler(spool, app_config.BODY_SPOOL_MIN_BYTES)
+    parts = [spooler.feed(chunk) async for chunk in chunks if chunk]
+    parts.append(spooler.finish())
+    body = b"".join(parts)
+    if not len(spool):
+        spool.close()
+        return json.loads(body)
+    logger.debug("Spooled %d data URL payload(s), %d bytes; %d bytes left to parse", len(spool), spool.size, len(body))
+    _current_spool.set(spool)
+    return _restore_outside_message_content(json.loads(body), spool)
+
+
+def _restore_outside_message_content(body: Any, spool: BodySpool) -> Any:
+    """
+    Keeps references only in the content of non-tool messages, where the prompt conversion
+    resolves them as images or restores them as text. Tool results, tool call arguments and
+    every other field get their payloads back straight away.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("messages"), list):
+        return _inline(body, spool)
+    restored = {key: _inline(value, spool) for key, value in body.items() if key != "messages"}
+    restored["messages"] = [
+        {
+            field: value if field == "content" and message.get("role") != "tool" else _inline(value, spool)
+            for field, value in message.items()
+        } if isinstance(message, dict) else _inline(message, spool)
+        for message in body["messages"]
+    ]
+    return restored
+
+
+def _restore(text: str, spool: BodySpool) -> str:
+    def _payload(match: re.Match) -> str:
+        payload = spool.payload(match.group(1))
+        return payload.decode("ascii") if payload is not None else match.group(0)
+    return REFERENCE_PATTERN.sub(_payload, text)
+
+
+def restore_text(text: str) -> str:
+    """Puts the spooled payloads back into text that is sent upstream as text."""
+    spool = _current_spool.get()
+    if spool is None or REFERENCE_PREFIX not in text:
+        return text
+    return _restore(text, spool)
+
+
+async def decode_reference(payload: str) -> Optional[bytes]:
+    """
+    Decodes the image bytes for a data URL payload that is a spool reference, or returns
+    None if it is not one. Raises ValueError for a reference this request did not spool.
+    """
+    if not payload.startswith(REFERENCE_PREFIX):
+        return None
+    match = REFERENCE_PATTERN.fullmatch(payload)
+    spool = _current_spool.get()
+    image_bytes = await codec.run(spool.decode, match.group(1)) if match and spool is not None else None
+    if image_bytes is None:
+        raise ValueError("Data URL refers to a spooled payload that is not part of this request")
+    return image_bytes
+
+
+def _inline(value: Any, spool: BodySpool) -> Any:
+    if isinstance(value, str):
+        return _restore(value, spool) if REFERENCE_PREFIX in value else value
+    if isinstance(value, list):
+        return [_inline(item, spool) for item in value]
+    if isinstance(value, dict):
+        return {key: _inline(item, spool) for key, item in value.items()}
+    return value
+
+
+def close_current():
+    """Closes the current request's spool, if it has one."""
+    spool = _current_spool.get()
+    if spool is not None:
+        spool.close()
+
+
+def close_after(response):
+    """
+    Closes the current request's spool once response has been sent: right away for a
+    regular response, and when the body ends (or the response finishes without
+    iterating it) for a stream.
+    """
+    spool = _current_spool.get()
+    if spool is None:
+        return response
+    if not isinstance(response, StreamingResponse):
+        spool.close()
+        return response
+
+    original_iterator = response.body_iterator
+
+    async def _close_when_done():
+        try:
+            async for chunk in original_iterator:
+                yield chunk
+        finally:
+            spool.close()
+    response.body_iterator = _close_when_done()
+    background = BackgroundTasks()
+    if response.background is not None:
+        background.add_task(response.background)
+    background.add_task(spool.close)
+    response.background = background
+    return response
+
+
+async def inline_references(value: Any) -> Any:
+    """
+    Returns value (JSON-like data, e.g. request messages) with every spool reference
+    replaced by its payload, for upstreams that take the OpenAI request as it is.
+    """
+    spool = _current_spool.get()
+    if spool is None:
+        return value
+    return await codec.run(_inline, value, spool)
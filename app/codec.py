@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, TypeVar
+
+import config as app_config
+
+# binascii holds the GIL for the whole call, so moving a multi-megabyte payload to another
+# thread alone would still stall the event loop. Large payloads are converted in slices,
+# letting the interpreter switch back to the loop between them.
+_DECODE_SLICE_CHARS = 1024 * 1024  # Multiple of 4: each slice is whole base64 groups
+_ENCODE_SLICE_BYTES = 3 * 256 * 1024  # Multiple of 3: no padding inside the output
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, app_config.CODEC_POOL_WORKERS), thread_name_prefix="voutb-codec")
+    return _executor
+
+
+def shutdown_codec_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def parse_data_url(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Splits "data:<mime>;base64,<payload>" into (mime type, payload), or returns None for
+    anything else. Only the short header is inspected; the payload is never scanned.
+    """
+    header, separator, payload = url.partition(",")
+    if not separator or not payload or not header.startswith("data:") or not header.endswith(";base64"):
+        return None
+    mime_type = header[5:-7]
+    if not mime_type or ";" in mime_type:
+        return None
+    return mime_type, payload
+
+
+def _b64decode_sliced(data: str) -> bytes:
+    try:
+        return b"".join([binascii.a2b_base64(data[i:i + _DECODE_SLICE_CHARS]) for i in range(0, len(data), _DECODE_SLICE_CHARS)])
+    except ValueError:
+        # Whitespace or other ignored characters moved a slice boundary off a base64 group;
+        # decode in one call, which also raises the usual error for invalid input.
+        return base64.b64decode(data)
+
+
+def _b64encode_sliced(data: bytes) -> str:
+    view = memoryview(data)
+    return b"".join([binascii.b2a_base64(view[i:i + _ENCODE_SLICE_BYTES], newline=False) for i in range(0, len(view), _ENCODE_SLICE_BYTES)]).decode("ascii")
+
+
+def is_large(size: int) -> bool:
+    return size >= app_config.CODEC_OFFLOAD_MIN_BYTES
+
+
+async def run(func: Callable[..., T], *args) -> T:
+    """Runs CPU-heavy func on the bounded codec pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+
+
+async def b64decode(data: str) -> bytes:
+    """base64.b64decode, run on the codec pool when data is at least CODEC_OFFLOAD_MIN_BYTES."""
+    if not is_large(len(data)):
+        return base64.b64decode(data)
+    return await run(_b64decode_sliced, data)
+
+
+async def b64encode(data: bytes) -> str:
+    """base64.b64encode to str, run on the codec pool when data is at least CODEC_OFFLOAD_MIN_BYTES."""
+    if not is_large(len(data)):
+        return base64.b64encode(data).decode("ascii")
+    return await run(_b64encode_sliced, data)
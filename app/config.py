@@ -1,10 +1,15 @@
 import os
 import json
+import logging
 import time
 
 # Config file path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
+# VOUTB_CONFIG_FILE points the app at another config file (used by the benchmark suite).
+CONFIG_FILE = os.environ.get("VOUTB_CONFIG_FILE") or os.path.join(BASE_DIR, "config.json")
+
+# app_logging imports this module, so the logger is looked up by name (see get_logger)
+logger = logging.getLogger("voutb.config")
 
 class ConfigLoader:
     def __init__(self):
@@ -20,12 +25,13 @@ class ConfigLoader:
             current_mtime = os.stat(self.config_file).st_mtime
             if current_mtime > self._last_mtime:
                 # File changed, reload
-                print(f"DEBUG: Reloading configuration from {self.config_file}")
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     self._cache = json.load(f)
                 self._last_mtime = current_mtime
+                # Logged after the reload: the log filter reads config itself
+                logger.debug("Reloaded configuration from %s", self.config_file)
         except Exception as e:
-            print(f"ERROR: Failed to reload config: {e}")
+            logger.error("Failed to reload config: %s", e)
 
     def get(self, key, default=None):
         self._reload_if_needed()
@@ -63,9 +69,77 @@ DEFAULTS = {
     "API_KEY": "123456",
     "CREDENTIALS_DIR": "/app/credentials",
     "MODELS_CONFIG_URL": "https://raw.githubusercontent.com/gzzhongqi/vertex2openai/refs/heads/main/vertexModels.json",
+    "MODELS_CONFIG_FILE": "",
+    "MODELS_CONFIG_REFRESH_SECONDS": 300,
     "FAKE_STREAMING_INTERVAL": 1.0,
     "MAX_RETRIES_BEFORE_SWITCH": 1,
-    "DEFAULT_LOCATION": "asia-southeast1"
+    "DEFAULT_LOCATION": "asia-southeast1",
+    "PROMPT_CACHE_ENABLED": True,
+    "PROMPT_CACHE_MAX_ENTRIES": 128,
+    "PROMPT_CACHE_MAX_BYTES": 256 * 1024 * 1024,
+    "CONTEXT_CACHE_ENABLED": False,
+    "CONTEXT_CACHE_MIN_TOKENS": 4096,
+    "CONTEXT_CACHE_MIN_HITS": 2,
+    "CONTEXT_CACHE_TTL_SECONDS": 3600,
+    "CONTEXT_CACHE_MAX_ENTRIES": 64,
+    "RESPONSE_CACHE_ENABLED": False,
+    "RESPONSE_CACHE_TTL_SECONDS": 3600,
+    "RESPONSE_CACHE_MAX_ENTRIES": 512,
+    "RESPONSE_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+    "RESPONSE_CACHE_DIR": "",
+    "RESPONSE_CACHE_DISK_MAX_BYTES": 1024 * 1024 * 1024,
+    "COALESCE_ENABLED": False,
+    "COALESCE_REPLAY_MAX_BYTES": 8 * 1024 * 1024,
+    "ADMISSION_MAX_CONCURRENCY": 0,
+    "ADMISSION_MAX_PER_CLIENT": 0,
+    "ADMISSION_MAX_QUEUE": 100,
+    "ADMISSION_QUEUE_TIMEOUT_SECONDS": 30.0,
+    "ADMISSION_CLIENT_WEIGHTS": {},
+    # "html" appends a ratings block to the reply; "json" puts them in choices[].safety_ratings
+    "SAFETY_SCORE_FORMAT": "html",
+    "LOG_LEVEL": "INFO",
+    "LOG_FORMAT": "text",
+    "LOG_COMPONENTS": {},
+    "LOG_DEBUG_SAMPLE_RATE": 1.0,
+    "TRACING_ENABLED": False,
+    "TRACING_SAMPLE_RATE": 1.0,
+    "TRACING_JSONL_PATH": "traces.jsonl",
+    "TRACING_OTLP_ENDPOINT": "",
+    "TRACING_SERVICE_NAME": "voutb",
+    "UPSTREAM_BASE_URL": "https://aiplatform.googleapis.com",
+    "SHARED_STATE_BACKEND": "auto",
+    "SHARED_STATE_PATH": "",
+    "HTTP_POOL_MAX_CONNECTIONS": 100,
+    "HTTP_POOL_MAX_KEEPALIVE": 20,
+    "HTTP_POOL_KEEPALIVE_EXPIRY": 30.0,
+    "HTTP2_ENABLED": True,
+    "FANOUT_ENABLED": False,
+    "FANOUT_MAX_N": 8,
+    "BATCH_ENABLED": False,
+    "BATCH_DIR": "",
+    "BATCH_CONCURRENCY_PER_KEY": 4,
+    "BATCH_MAX_CONCURRENCY": 32,
+    "BATCH_MAX_ATTEMPTS": 5,
+    "BATCH_MAX_FILE_BYTES": 200 * 1024 * 1024,
+    # Admission weight of batch requests against interactive clients (weight 1)
+    "BATCH_ADMISSION_WEIGHT": 0.1,
+    "EMBEDDING_BATCHING_ENABLED": True,
+    "EMBEDDING_BATCH_WINDOW_MS": 5,
+    "EMBEDDING_MAX_BATCH_SIZE": 100,
+    "EMBEDDING_CACHE_MAX_ENTRIES": 10000,
+    "CODEC_OFFLOAD_MIN_BYTES": 256 * 1024,
+    "CODEC_POOL_WORKERS": 2,
+    "IMAGE_NORMALIZE_ENABLED": False,
+    "IMAGE_NORMALIZE_MAX_SIDE": 3072,
+    "IMAGE_NORMALIZE_MAX_BYTES": 4 * 1024 * 1024,
+    "IMAGE_NORMALIZE_QUALITY": 85,
+    # Per-model overrides, e.g. {"flash-lite": {"max_side": 1536, "max_bytes": 2097152}}
+    "IMAGE_NORMALIZE_MODEL_LIMITS": {},
+    "IMAGE_NORMALIZE_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+    "IMAGE_NORMALIZE_WORKERS": 2,
+    "BODY_SPOOL_ENABLED": True,
+    "BODY_SPOOL_MIN_BYTES": 256 * 1024,
+    "BODY_SPOOL_DIR": "",
 }
 
 def __getattr__(name):
@@ -85,7 +159,27 @@ def __getattr__(name):
     
     bool_keys = [
         "HUGGINGFACE", "FAKE_STREAMING_ENABLED", "ROUNDROBIN", 
-        "SAFETY_SCORE", "R2_ENABLED", "AUTO_SWITCH_LOCATION"
+        "SAFETY_SCORE", "R2_ENABLED", "AUTO_SWITCH_LOCATION",
+        "PROMPT_CACHE_ENABLED", "CONTEXT_CACHE_ENABLED", "RESPONSE_CACHE_ENABLED",
+        "COALESCE_ENABLED", "TRACING_ENABLED", "HTTP2_ENABLED",
+        "FANOUT_ENABLED", "BATCH_ENABLED", "EMBEDDING_BATCHING_ENABLED",
+        "IMAGE_NORMALIZE_ENABLED", "BODY_SPOOL_ENABLED",
+    ]
+
+    int_keys = [
+        "PROMPT_CACHE_MAX_ENTRIES", "PROMPT_CACHE_MAX_BYTES",
+        "CONTEXT_CACHE_MIN_TOKENS", "CONTEXT_CACHE_MIN_HITS",
+        "CONTEXT_CACHE_TTL_SECONDS", "CONTEXT_CACHE_MAX_ENTRIES",
+        "RESPONSE_CACHE_TTL_SECONDS", "RESPONSE_CACHE_MAX_ENTRIES",
+        "RESPONSE_CACHE_MAX_BYTES", "RESPONSE_CACHE_DISK_MAX_BYTES",
+        "ADMISSION_MAX_CONCURRENCY", "ADMISSION_MAX_PER_CLIENT", "ADMISSION_MAX_QUEUE",
+        "MODELS_CONFIG_REFRESH_SECONDS", "HTTP_POOL_MAX_CONNECTIONS", "HTTP_POOL_MAX_KEEPALIVE",
+        "FANOUT_MAX_N", "BATCH_CONCURRENCY_PER_KEY", "BATCH_MAX_CONCURRENCY", "BATCH_MAX_ATTEMPTS",
+        "BATCH_MAX_FILE_BYTES", "EMBEDDING_BATCH_WINDOW_MS", "EMBEDDING_MAX_BATCH_SIZE",
+        "EMBEDDING_CACHE_MAX_ENTRIES", "CODEC_OFFLOAD_MIN_BYTES", "CODEC_POOL_WORKERS",
+        "IMAGE_NORMALIZE_MAX_SIDE", "IMAGE_NORMALIZE_MAX_BYTES", "IMAGE_NORMALIZE_QUALITY",
+        "IMAGE_NORMALIZE_CACHE_MAX_BYTES", "IMAGE_NORMALIZE_WORKERS", "BODY_SPOOL_MIN_BYTES",
+        "COALESCE_REPLAY_MAX_BYTES",
     ]
     
     # Mapping from variable name to JSON key (if different)
@@ -99,10 +193,17 @@ def __getattr__(name):
     
     if name in bool_keys or json_key in bool_keys:
         # It's a boolean config
-        return _loader.get_bool(json_key, False)
+        return _loader.get_bool(json_key, DEFAULTS.get(name, False))
+
+    if name in int_keys:
+        return _loader.get_int(json_key, DEFAULTS.get(name, 0))
     
     if name == "FAKE_STREAMING_INTERVAL_SECONDS":
         return _loader.get_float(json_key, 1.0)
+
+    if name in ("ADMISSION_QUEUE_TIMEOUT_SECONDS", "LOG_DEBUG_SAMPLE_RATE", "TRACING_SAMPLE_RATE",
+                "HTTP_POOL_KEEPALIVE_EXPIRY", "BATCH_ADMISSION_WEIGHT"):
+        return _loader.get_float(json_key, DEFAULTS[name])
         
     if name == "MAX_RETRIES_BEFORE_SWITCH":
         return _loader.get_int(json_key, 1)
@@ -0,0 +1,353 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from google.genai import types
+
+import config as app_config
+from app_logging import get_logger
+from prompt_cache import PromptContents
+
+logger = get_logger("context_cache")
+
+# Gemini bills an inline image as a fixed number of tokens regardless of its byte size.
+_IMAGE_TOKEN_ESTIMATE = 258
+_CHARS_PER_TOKEN_ESTIMATE = 4
+# Config keys that Vertex only accepts inside the cached content, never next to it.
+_CACHE_OWNED_CONFIG_KEYS = ("system_instruction", "tools", "tool_config")
+# A cache is not referenced when it expires within this many seconds.
+_EXPIRY_SAFETY_MARGIN_SECONDS = 60
+
+
+class CachedPrefix:
+    """A Vertex cached content holding the first `prefix_length` contents of a prompt."""
+
+    __slots__ = ("name", "scope", "prefix_length", "estimated_tokens", "expire_at", "refreshing")
+
+    def __init__(self, name: str, scope: str, prefix_length: int, estimated_tokens: int, expire_at: float):
+        self.name = name
+        self.scope = scope
+        self.prefix_length = prefix_length
+        self.estimated_tokens = estimated_tokens
+        self.expire_at = expire_at
+        self.refreshing = False
+
+
+def _client_scope(client: Any) -> str:
+    """
+    Identifies the credential/project/location a client talks to. Cached contents belong to
+    a project and location, so they can only be referenced by clients with the same scope.
+    """
+    api_client = getattr(client, "_api_client", None)
+    project = getattr(api_client, "project", None) or ""
+    location = getattr(api_client, "location", None) or ""
+    api_key = getattr(api_client, "api_key", None) or ""
+    base_url = ""
+    http_options = getattr(api_client, "_http_options", None)
+    if http_options is not None:
+        base_url = getattr(http_options, "base_url", None) or ""
+    key_hash = hashlib.blake2b(api_key.encode("utf-8"), digest_size=8).hexdigest() if api_key else ""
+    return f"{project}|{location}|{key_hash}|{base_url}"
+
+
+def _estimate_content_tokens(content: types.Content) -> int:
+    tokens = 0
+    for part in content.parts or []:
+        if part.text:
+            tokens += len(part.text) // _CHARS_PER_TOKEN_ESTIMATE
+        elif part.inline_data is not None or part.file_data is not None:
+            tokens += _IMAGE_TOKEN_ESTIMATE
+        else:
+            tokens += 16
+    return tokens
+
+
+def _serialize_config_value(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, (list, tuple)):
+        return [_serialize_config_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _serialize_config_value(v) for k, v in value.items()}
+    return value
+
+
+def is_cache_miss_error(error: Exception) -> bool:
+    """True when an upstream error says the referenced cached content no longer exists."""
+    err_str = str(error)
+    if "cachedContent" not in err_str and "CachedContent" not in err_str and "cached_content" not in err_str:
+        return False
+    return "404" in err_str or "NOT_FOUND" in err_str or "not found" in err_str.lower() or "expired" in err_str.lower()
+
+
+class ContextCacheManager:
+    """
+    Opt-in automatic Vertex context caching for long, repeated prompt prefixes.
+
+    Every request records the content boundaries of its prompt whose estimated size exceeds
+    CONTEXT_CACHE_MIN_TOKENS. Once a boundary has been seen CONTEXT_CACHE_MIN_HITS times for
+    the same model, credential scope, system instruction and tools, a cached content is
+    created for it in the background. Later requests sharing that prefix send only the
+    remaining contents and reference the cache by name.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, CachedPrefix]" = OrderedDict()
+        self._entry_keys_by_name: Dict[str, str] = {}
+        self._boundary_hits: "OrderedDict[str, int]" = OrderedDict()
+        self._creating: Dict[str, asyncio.Task] = {}
+        self._unsupported_scopes: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return app_config.CONTEXT_CACHE_ENABLED
+
+    @property
+    def min_tokens(self) -> int:
+        return app_config.CONTEXT_CACHE_MIN_TOKENS
+
+    @property
+    def min_hits(self) -> int:
+        return max(1, app_config.CONTEXT_CACHE_MIN_HITS)
+
+    @property
+    def ttl_seconds(self) -> int:
+        return app_config.CONTEXT_CACHE_TTL_SECONDS
+
+    @property
+    def max_entries(self) -> int:
+        return app_config.CONTEXT_CACHE_MAX_ENTRIES
+
+    def _boundary_hashes(self, scope: str, model: str, contents: List[types.Content], gen_config: Dict[str, Any]) -> List[str]:
+        """
+        hashes[i] identifies contents[:i + 1] together with everything the cache would own.
+        Converted prompts carry the prefix hashes computed during conversion, so only plain
+        content lists are serialized here.
+        """
+        seed = {
+            "scope": scope,
+            "model": model,
+            **{key: _serialize_config_value(gen_config.get(key)) for key in _CACHE_OWNED_CONFIG_KEYS},
+        }
+        digest = hashlib.blake2b(json.dumps(seed, sort_keys=True, default=str).encode("utf-8"), digest_size=16).digest()
+        if isinstance(contents, PromptContents) and len(contents.content_hashes) == len(contents):
+            return [
+                hashlib.blake2b(digest + bytes.fromhex(content_hash), digest_size=16).hexdigest()
+                for content_hash in contents.content_hashes
+            ]
+        boundary_hashes = []
+        for content in contents:
+            hasher = hashlib.blake2b(digest, digest_size=16)
+            hasher.update(content.model_dump_json(exclude_none=True).encode("utf-8"))
+            digest = hasher.digest()
+            boundary_hashes.append(digest.hex())
+        return boundary_hashes
+
+    def _get_live_entry(self, key: str) -> Optional[CachedPrefix]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expire_at - _EXPIRY_SAFETY_MARGIN_SECONDS <= time.time():
+            self._remove_entry(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove_entry(self, key: str) -> Optional[CachedPrefix]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entry_keys_by_name.pop(entry.name, None)
+        return entry
+
+    def _record_boundary_hit(self, key: str) -> int:
+        hits = self._boundary_hits.pop(key, 0) + 1
+        self._boundary_hits[key] = hits
+        # Bound the candidate table; only the most recently seen boundaries matter.
+        while len(self._boundary_hits) > self.max_entries * 64:
+            self._boundary_hits.popitem(last=False)
+        return hits
+
+    async def apply(
+        self,
+        client: Any,
+        model: str,
+        contents: List[types.Content],
+        gen_config: Dict[str, Any],
+    ) -> Tuple[List[types.Content], Dict[str, Any], Optional[str]]:
+        """
+        Returns (contents, config, cache_name) to send upstream. When a cached prefix matches,
+        the prefix is dropped from the contents and the config references the cache instead;
+        otherwise the inputs are returned unchanged and cache_name is None.
+        """
+        if not self.enabled or len(contents) < 2:
+            return contents, gen_config, None
+
+        scope = _client_scope(client)
+        if scope in self._unsupported_scopes:
+            return contents, gen_config, None
+
+        try:
+            boundary_hashes = self._boundary_hashes(scope, model, contents, gen_config)
+        except Exception as e:
+            logger.warning("Context cache could not fingerprint prompt: %s", e)
+            return contents, gen_config, None
+
+        # The last content is the new turn and always has to be sent.
+        cumulative_tokens = []
+        running_tokens = 0
+        for content in contents[:-1]:
+            running_tokens += _estimate_content_tokens(content)
+            cumulative_tokens.append(running_tokens)
+
+        active_entry: Optional[CachedPrefix] = None
+        for i in range(len(contents) - 2, -1, -1):
+            active_entry = self._get_live_entry(boundary_hashes[i])
+            if active_entry is not None:
+                break
+
+        self._maybe_create(client, scope, model, contents, gen_config, boundary_hashes, cumulative_tokens, active_entry)
+
+        if active_entry is None:
+            return contents, gen_config, None
+
+        if active_entry.expire_at - time.time() < self.ttl_seconds / 2 and not active_entry.refreshing:
+            active_entry.refreshing = True
+            self._run_in_background(self._extend_ttl(client, active_entry))
+
+        call_config = {k: v for k, v in gen_config.items() if k not in _CACHE_OWNED_CONFIG_KEYS}
+        call_config["cached_content"] = active_entry.name
+        logger.info("Using context cache %s for the first %s contents (~%s tokens).", active_entry.name, active_entry.prefix_length, active_entry.estimated_tokens)
+        return contents[active_entry.prefix_length:], call_config, active_entry.name
+
+    def _run_in_background(self, coroutine):
+        # Referenced until done so the task is not garbage collected mid-flight
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _maybe_create(
+        self,
+        client: Any,
+        scope: str,
+        model: str,
+        contents: List[types.Content],
+        gen_config: Dict[str, Any],
+        boundary_hashes: List[str],
+        cumulative_tokens: List[int],
+        active_entry: Optional[CachedPrefix],
+    ):
+        min_tokens = self.min_tokens
+        min_hits = self.min_hits
+        candidate_index = -1
+        for i, tokens in enumerate(cumulative_tokens):
+            if tokens < min_tokens:
+                continue
+            if self._record_boundary_hit(boundary_hashes[i]) >= min_hits:
+                candidate_index = i
+        if candidate_index == -1:
+            return
+
+        key = boundary_hashes[candidate_index]
+        if key in self._entries or key in self._creating:
+            return
+        # Only replace an active cache when the new prefix adds a worthwhile amount of context.
+        if active_entry is not None and cumulative_tokens[candidate_index] - active_entry.estimated_tokens < min_tokens:
+            return
+
+        prefix = contents[:candidate_index + 1]
+        task = asyncio.create_task(
+            self._create(client, scope, model, prefix, gen_config, key, cumulative_tokens[candidate_index])
+        )
+        self._creating[key] = task
+        task.add_done_callback(lambda _t, k=key: self._creating.pop(k, None))
+
+    async def _create(
+        self,
+        client: Any,
+        scope: str,
+        model: str,
+        prefix: List[types.Content],
+        gen_config: Dict[str, Any],
+        key: str,
+        estimated_tokens: int,
+    ):
+        ttl_seconds = self.ttl_seconds
+        cache_config: Dict[str, Any] = {
+            "contents": prefix,
+            "ttl": f"{ttl_seconds}s",
+            "display_name": f"voutb-prefix-{key[:16]}",
+        }
+        for config_key in _CACHE_OWNED_CONFIG_KEYS:
+            if gen_config.get(config_key) is not None:
+                cache_config[config_key] = gen_config[config_key]
+        try:
+            cached = await client.aio.caches.create(model=model, config=cache_config)
+        except Exception as e:
+            err_str = str(e)
+            logger.warning("Failed to create context cache for model %s: %s", model, err_str[:300])
+            # Permission/feature errors will not go away; stop trying for this credential scope.
+            if any(code in err_str for code in ("400", "403", "404")) and "429" not in err_str:
+                self._unsupported_scopes.add(scope)
+            return
+
+        expire_at = time.time() + ttl_seconds
+        expire_time = getattr(cached, "expire_time", None)
+        if expire_time is not None:
+            expire_at = expire_time.timestamp()
+        usage = getattr(cached, "usage_metadata", None)
+        if usage is not None and getattr(usage, "total_token_count", None):
+            estimated_tokens = usage.total_token_count
+
+        entry = CachedPrefix(cached.name, scope, len(prefix), estimated_tokens, expire_at)
+        self._entries[key] = entry
+        self._entry_keys_by_name[entry.name] = key
+        logger.info("Created context cache %s for model %s (%s contents, ~%s tokens, ttl %ss).", entry.name, model, entry.prefix_length, estimated_tokens, ttl_seconds)
+
+        while len(self._entries) > self.max_entries:
+            evicted_key = next(iter(self._entries))
+            evicted = self._remove_entry(evicted_key)
+            if evicted is not None and evicted.scope == scope:
+                self._run_in_background(self._delete(client, evicted.name))
+            # Caches of other scopes are reclaimed upstream when their TTL runs out.
+
+    async def _extend_ttl(self, client: Any, entry: CachedPrefix):
+        try:
+            ttl_seconds = self.ttl_seconds
+            updated = await client.aio.caches.update(name=entry.name, config={"ttl": f"{ttl_seconds}s"})
+            expire_time = getattr(updated, "expire_time", None)
+            entry.expire_at = expire_time.timestamp() if expire_time is not None else time.time() + ttl_seconds
+        except Exception as e:
+            logger.warning("Failed to extend context cache %s: %s", entry.name, str(e)[:300])
+            if is_cache_miss_error(e):
+                self.invalidate(entry.name)
+        finally:
+            entry.refreshing = False
+
+    async def _delete(self, client: Any, name: str):
+        try:
+            await client.aio.caches.delete(name=name)
+        except Exception as e:
+            logger.warning("Failed to delete evicted context cache %s: %s", name, str(e)[:300])
+
+    def invalidate(self, cache_name: str):
+        """Forgets a cached content that upstream reported as missing or expired."""
+        key = self._entry_keys_by_name.get(cache_name)
+        if key is not None:
+            self._remove_entry(key)
+            logger.info("Context cache %s is no longer available upstream; falling back to full prompts.", cache_name)
+
+
+# Global singleton
+_context_cache_manager_instance: Optional[ContextCacheManager] = None
+
+
+def get_context_cache_manager() -> ContextCacheManager:
+    """Returns the process-wide context cache manager."""
+    global _context_cache_manager_instance
+    if _context_cache_manager_instance is None:
+        _context_cache_manager_instance = ContextCacheManager()
+    return _context_cache_manager_instance
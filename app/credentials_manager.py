@@ -3,9 +3,11 @@ import glob
 import random
 import json
 from typing import List, Dict, Any
-from google.auth.transport.requests import Request as AuthRequest
-from google.oauth2 import service_account
 import config as app_config # Changed from relative
+from shared_state import get_shared_state
+from app_logging import get_logger
+
+logger = get_logger("credentials")
 
 # Helper function to parse multiple JSONs from a string
 def parse_multiple_json_credentials(json_str: str) -> List[Dict[str, Any]]:
@@ -36,37 +38,38 @@ def parse_multiple_json_credentials(json_str: str) -> List[Dict[str, Any]]:
                         required_fields = ["type", "project_id", "private_key_id", "private_key", "client_email"]
                         if all(field in credentials_info for field in required_fields):
                              credentials_list.append(credentials_info)
-                             print(f"DEBUG: Successfully parsed a JSON credential object.")
+                             logger.debug("Successfully parsed a JSON credential object.")
                         else:
-                             print(f"WARNING: Parsed JSON object missing required fields: {json_object_str[:100]}...")
+                             logger.warning("Parsed JSON object missing required fields: %s...", json_object_str[:100])
                     except json.JSONDecodeError as e:
-                        print(f"ERROR: Failed to parse JSON object segment: {json_object_str[:100]}... Error: {e}")
+                        logger.error("Failed to parse JSON object segment: %s... Error: %s", json_object_str[:100], e)
                     current_object_start = -1 # Reset for the next object
             else:
                 # Found a closing brace without a matching open brace in scope, might indicate malformed input
-                 print(f"WARNING: Encountered unexpected '}}' at index {i}. Input might be malformed.")
+                 logger.warning("Encountered unexpected '}' at index %s. Input might be malformed.", i)
 
 
     if nesting_level != 0:
-        print(f"WARNING: JSON string parsing ended with non-zero nesting level ({nesting_level}). Check for unbalanced braces.")
+        logger.warning("JSON string parsing ended with non-zero nesting level (%s). Check for unbalanced braces.", nesting_level)
 
-    print(f"DEBUG: Parsed {len(credentials_list)} credential objects from the input string.")
+    logger.debug("Parsed %s credential objects from the input string.", len(credentials_list))
     return credentials_list
 def _refresh_auth(credentials):
     """Helper function to refresh GCP token."""
     if not credentials:
-        print("ERROR: _refresh_auth called with no credentials.")
+        logger.error("_refresh_auth called with no credentials.")
         return None
     try:
         # Assuming credentials object has a project_id attribute for logging
         project_id_for_log = getattr(credentials, 'project_id', 'Unknown')
-        print(f"INFO: Attempting to refresh token for project: {project_id_for_log}...")
+        logger.info("Attempting to refresh token for project: %s...", project_id_for_log)
+        from google.auth.transport.requests import Request as AuthRequest # Loads `requests`; only needed once SA tokens are used
         credentials.refresh(AuthRequest())
-        print(f"INFO: Token refreshed successfully for project: {project_id_for_log}")
+        logger.info("Token refreshed successfully for project: %s", project_id_for_log)
         return credentials.token
     except Exception as e:
         project_id_for_log = getattr(credentials, 'project_id', 'Unknown')
-        print(f"ERROR: Error refreshing GCP token for project {project_id_for_log}: {e}")
+        logger.error("Error refreshing GCP token for project %s: %s", project_id_for_log, e)
         return None
 
 
@@ -80,8 +83,8 @@ class CredentialManager:
         self.project_id = None
         # New: Store credentials loaded directly from JSON objects
         self.in_memory_credentials: List[Dict[str, Any]] = []
-        # Round-robin index for tracking position
-        self.round_robin_index = 0
+        # The round-robin cursor lives in shared state so all workers rotate together.
+        self._shared_state = get_shared_state()
         self.load_credentials_list() # Load file-based credentials initially
 
     @property
@@ -102,15 +105,16 @@ class CredentialManager:
             # Validate structure again before creating credentials object
             required_fields = ["type", "project_id", "private_key_id", "private_key", "client_email"]
             if not all(field in credentials_info for field in required_fields):
-                 print(f"WARNING: Skipping JSON credential due to missing required fields.")
+                 logger.warning("Skipping JSON credential due to missing required fields.")
                  return False
 
+            from google.oauth2 import service_account # Deferred until SA credentials are present
             credentials = service_account.Credentials.from_service_account_info(
                 credentials_info,
                 scopes=['https://www.googleapis.com/auth/cloud-platform']
             )
             project_id = credentials.project_id
-            print(f"DEBUG: Successfully created credentials object from JSON for project: {project_id}")
+            logger.debug("Successfully created credentials object from JSON for project: %s", project_id)
 
             # Store the credentials object and project ID
             self.in_memory_credentials.append({
@@ -118,10 +122,10 @@ class CredentialManager:
                 'project_id': project_id,
                  'source': 'json_string' # Add source for clarity
             })
-            print(f"INFO: Added credential for project {project_id} from JSON string to Credential Manager.")
+            logger.info("Added credential for project %s from JSON string to Credential Manager.", project_id)
             return True
         except Exception as e:
-            print(f"ERROR: Failed to create credentials from parsed JSON object: {e}")
+            logger.error("Failed to create credentials from parsed JSON object: %s", e)
             return False
 
     def load_credentials_from_json_list(self, json_list: List[Dict[str, Any]]) -> int:
@@ -150,24 +154,25 @@ class CredentialManager:
                      success_count += 1
                      newly_added_projects.add(project_id)
              elif project_id:
-                  print(f"DEBUG: Skipping duplicate credential for project {project_id} from JSON list.")
+                  logger.debug("Skipping duplicate credential for project %s from JSON list.", project_id)
 
 
         if success_count > 0:
-             print(f"INFO: Loaded {success_count} new credentials from JSON list into memory.")
+             logger.info("Loaded %s new credentials from JSON list into memory.", success_count)
         return success_count
 
     def load_credentials_list(self):
         """Load the list of available credential files"""
         # Look for all .json files in the credentials directory
         pattern = os.path.join(self.credentials_dir, "*.json")
-        self.credentials_files = glob.glob(pattern)
+        # Sorted so every worker sees the same order for the shared round-robin cursor
+        self.credentials_files = sorted(glob.glob(pattern))
 
         if not self.credentials_files:
             # print(f"No credential files found in {self.credentials_dir}")
             pass # Don't return False yet, might have in-memory creds
         else:
-             print(f"Found {len(self.credentials_files)} credential files: {[os.path.basename(f) for f in self.credentials_files]}")
+             logger.debug("Found %s credential files: %s", len(self.credentials_files), [os.path.basename(f) for f in self.credentials_files])
 
         # Check total credentials
         return self.get_total_credentials() > 0
@@ -179,11 +184,11 @@ class CredentialManager:
         new_file_count = len(self.credentials_files)
 
         if old_file_count != new_file_count:
-            print(f"Credential files updated: {old_file_count} -> {new_file_count}")
+            logger.debug("Credential files updated: %s -> %s", old_file_count, new_file_count)
 
         # Total credentials = files + in-memory
         total_credentials = self.get_total_credentials()
-        print(f"DEBUG: Refresh check - Total credentials available: {total_credentials}")
+        logger.debug("Refresh check - Total credentials available: %s", total_credentials)
         return total_credentials > 0
 
     def get_total_credentials(self):
@@ -217,19 +222,20 @@ class CredentialManager:
         
         if source_type == 'file':
             file_path = source_info['value']
-            print(f"DEBUG: Attempting to load credential from file: {os.path.basename(file_path)}")
+            logger.debug("Attempting to load credential from file: %s", os.path.basename(file_path))
             try:
+                from google.oauth2 import service_account # Deferred until SA credentials are present
                 credentials = service_account.Credentials.from_service_account_file(
                     file_path,
                     scopes=['https://www.googleapis.com/auth/cloud-platform']
                 )
                 project_id = credentials.project_id
-                print(f"INFO: Successfully loaded credential from file {os.path.basename(file_path)} for project: {project_id}")
+                logger.info("Successfully loaded credential from file %s for project: %s", os.path.basename(file_path), project_id)
                 self.credentials = credentials  # Cache last successfully loaded
                 self.project_id = project_id
                 return credentials, project_id
             except Exception as e:
-                print(f"ERROR: Failed loading credentials file {os.path.basename(file_path)}: {e}")
+                logger.error("Failed loading credentials file %s: %s", os.path.basename(file_path), e)
                 return None, None
         
         elif source_type == 'memory_object':
@@ -238,12 +244,12 @@ class CredentialManager:
             project_id = mem_cred_detail.get('project_id')
             
             if credentials and project_id:
-                print(f"INFO: Using in-memory credential for project: {project_id} (Source: {mem_cred_detail.get('source', 'unknown')})")
+                logger.info("Using in-memory credential for project: %s (Source: %s)", project_id, mem_cred_detail.get('source', 'unknown'))
                 self.credentials = credentials  # Cache last successfully loaded/used
                 self.project_id = project_id
                 return credentials, project_id
             else:
-                print(f"WARNING: In-memory credential entry missing 'credentials' or 'project_id' at original index {source_info.get('original_index', 'N/A')}.")
+                logger.warning("In-memory credential entry missing 'credentials' or 'project_id' at original index %s.", source_info.get('original_index', 'N/A'))
                 return None, None
         
         return None, None
@@ -257,10 +263,10 @@ class CredentialManager:
         all_sources = self._get_all_credential_sources()
         
         if not all_sources:
-            print("WARNING: No credentials available for selection (no files or in-memory).")
+            logger.warning("No credentials available for selection (no files or in-memory).")
             return None, None
         
-        print(f"DEBUG: Using random credential selection strategy.")
+        logger.debug("Using random credential selection strategy.")
         sources_to_try = all_sources.copy()
         random.shuffle(sources_to_try)  # Shuffle to try in a random order
         
@@ -269,7 +275,7 @@ class CredentialManager:
             if credentials and project_id:
                 return credentials, project_id
         
-        print("WARNING: All available credential sources failed to load.")
+        logger.warning("All available credential sources failed to load.")
         return None, None
 
     def get_roundrobin_credentials(self):
@@ -281,20 +287,14 @@ class CredentialManager:
         all_sources = self._get_all_credential_sources()
         
         if not all_sources:
-            print("WARNING: No credentials available for selection (no files or in-memory).")
+            logger.warning("No credentials available for selection (no files or in-memory).")
             return None, None
         
-        print(f"DEBUG: Using round-robin credential selection strategy.")
-        
-        # Ensure round_robin_index is within bounds
-        if self.round_robin_index >= len(all_sources):
-            self.round_robin_index = 0
-        
-        # Create ordered list starting from round_robin_index
-        ordered_sources = all_sources[self.round_robin_index:] + all_sources[:self.round_robin_index]
+        logger.debug("Using round-robin credential selection strategy.")
         
-        # Move to next index for next call
-        self.round_robin_index = (self.round_robin_index + 1) % len(all_sources)
+        # Take the current index (advancing it for the next call) and start the ordered list there
+        start_index = self._shared_state.next_cursor("credentials.cursor", len(all_sources))
+        ordered_sources = all_sources[start_index:] + all_sources[:start_index]
         
         # Try credentials in round-robin order
         for source_info in ordered_sources:
@@ -302,7 +302,7 @@ class CredentialManager:
             if credentials and project_id:
                 return credentials, project_id
         
-        print("WARNING: All available credential sources failed to load.")
+        logger.warning("All available credential sources failed to load.")
         return None, None
 
     def get_credentials(self):
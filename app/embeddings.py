@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("embeddings")
+
+# Vertex caps a text-embedding predict call at 250 instances and 20k input tokens. The
+# character budget keeps a batch of long inputs under the token cap (~4 chars per token).
+_MAX_BATCH_CHARS = 60_000
+# Models whose predict endpoint accepts a single instance per call.
+_SINGLE_INSTANCE_MODEL_PREFIXES = ("gemini-embedding",)
+
+
+class EmbeddingRoute(NamedTuple):
+    """Everything besides the input text that determines an upstream embedding call."""
+    model: str
+    is_express: bool
+    dimensions: Optional[int]
+    task_type: Optional[str]
+
+
+class Embedding(NamedTuple):
+    values: List[float]
+    token_count: int
+
+
+EmbedFunc = Callable[[EmbeddingRoute, List[str]], Awaitable[List[Embedding]]]
+
+
+def max_batch_size(model: str) -> int:
+    if model.startswith(_SINGLE_INSTANCE_MODEL_PREFIXES):
+        return 1
+    return max(1, min(app_config.EMBEDDING_MAX_BATCH_SIZE, 250))
+
+
+class EmbeddingCache:
+    """
+    LRU of computed embeddings keyed by model, output settings and a hash of the text. The
+    backend (Express or SA) is not part of the key; both return the same vectors.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, Embedding]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_entries(self) -> int:
+        return app_config.EMBEDDING_CACHE_MAX_ENTRIES
+
+    @staticmethod
+    def make_key(route: EmbeddingRoute, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{route.model}|{route.dimensions or ''}|{route.task_type or ''}|{text_hash}"
+
+    def get(self, key: str) -> Optional[Embedding]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: Embedding):
+        max_entries = self.max_entries
+        if max_entries <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+
+class _PendingBatch:
+    __slots__ = ("route", "embed", "items", "chars", "timer")
+
+    def __init__(self, route: EmbeddingRoute, embed: EmbedFunc):
+        self.route = route
+        self.embed = embed
+        self.items: List[Tuple[str, str, asyncio.Future]] = []
+        self.chars = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """
+    Collects the inputs of concurrent embedding requests for the same route into one
+    upstream call. A batch is sent EMBEDDING_BATCH_WINDOW_MS after its first input, or as
+    soon as it is full, and the vectors are handed back to each waiting request. Inputs
+    already cached are answered directly, and an input that is already pending or in flight
+    waits for that call instead of being sent twice.
+    """
+
+    def __init__(self):
+        self.cache = EmbeddingCache()
+        self._pending: Dict[EmbeddingRoute, _PendingBatch] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.upstream_calls = 0
+        self.upstream_inputs = 0
+
+    @property
+    def enabled(self) -> bool:
+        return app_config.EMBEDDING_BATCHING_ENABLED
+
+    async def embed(self, route: EmbeddingRoute, texts: List[str], embed: EmbedFunc) -> List[Embedding]:
+        """Returns one embedding per text, in order. Upstream errors are raised to the caller."""
+        results: List[Optional[Embedding]] = [None] * len(texts)
+        waiting: List[Tuple[int, asyncio.Future]] = []
+        for index, text in enumerate(texts):
+            key = self.cache.make_key(route, text)
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[index] = cached
+            else:
+                waiting.append((index, self._enqueue(route, key, text, embed)))
+        if waiting:
+            # Shielded: the futures are shared with other requests, which must not be
+            # cancelled when this client disconnects.
+            outcomes = await asyncio.gather(*(asyncio.shield(future) for _, future in waiting), return_exceptions=True)
+            for (index, _), outcome in zip(waiting, outcomes):
+                if isinstance(outcome, BaseException):
+                    raise outcome
+                results[index] = outcome
+        return results
+
+    def _enqueue(self, route: EmbeddingRoute, key: str, text: str, embed: EmbedFunc) -> asyncio.Future:
+        future = self._in_flight.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._in_flight[key] = future
+
+        batch = self._pending.get(route)
+        if batch is not None and batch.items and batch.chars + len(text) > _MAX_BATCH_CHARS:
+            self._flush(route)
+            batch = None
+        if batch is None:
+            batch = self._pending[route] = _PendingBatch(route, embed)
+            if self.enabled:
+                batch.timer = loop.call_later(app_config.EMBEDDING_BATCH_WINDOW_MS / 1000.0, self._flush, route)
+        batch.items.append((key, text, future))
+        batch.chars += len(text)
+        if not self.enabled or len(batch.items) >= max_batch_size(route.model):
+            self._flush(route)
+        return future
+
+    def _flush(self, route: EmbeddingRoute):
+        batch = self._pending.pop(route, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _PendingBatch):
+        texts = [text for _, text, _ in batch.items]
+        self.upstream_calls += 1
+        self.upstream_inputs += len(texts)
+        try:
+            embeddings = await batch.embed(batch.route, texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Upstream returned {len(embeddings)} embeddings for {len(texts)} inputs.")
+        except asyncio.CancelledError:
+            for key, _, future in batch.items:
+                self._in_flight.pop(key, None)
+                future.cancel()
+            raise
+        except Exception as e:
+            logger.warning("Embedding call for model %s with %d input(s) failed: %s", batch.route.model, len(texts), e)
+            for key, _, future in batch.items:
+                self._in_flight.pop(key, None)
+                if not future.done():
+                    future.set_exception(e)
+                    # Retrieved here so an input nobody waits for any more is not reported
+                    # as an unhandled error.
+                    future.exception()
+            return
+        for (key, _, future), embedding in zip(batch.items, embeddings):
+            self._in_flight.pop(key, None)
+            self.cache.put(key, embedding)
+            if not future.done():
+                future.set_result(embedding)
+        logger.debug("Embedded %d input(s) for model %s in one call", len(texts), batch.route.model)
+
+
+# Global singleton
+_embedding_batcher_instance: Optional[EmbeddingBatcher] = None
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    global _embedding_batcher_instance
+    if _embedding_batcher_instance is None:
+        _embedding_batcher_instance = EmbeddingBatcher()
+    return _embedding_batcher_instance
@@ -1,6 +1,10 @@
 import random
 from typing import List, Optional, Tuple
 import config as app_config
+from shared_state import get_shared_state
+from app_logging import get_logger
+
+logger = get_logger("express_keys")
 
 
 class ExpressKeyManager:
@@ -11,8 +15,9 @@ class ExpressKeyManager:
     
     def __init__(self):
         """Initialize the Express Key Manager."""
-        self.round_robin_index: int = 0
-        
+        # The round-robin cursor lives in shared state so all workers rotate together.
+        self._shared_state = get_shared_state()
+
     @property
     def express_keys(self) -> List[str]:
         """Dynamically get keys from config"""
@@ -29,10 +34,10 @@ class ExpressKeyManager:
         """
         keys = self.express_keys
         if not keys:
-            print("WARNING: No Express API keys available for selection.")
+            logger.warning("No Express API keys available for selection.")
             return None
             
-        print(f"DEBUG: Using random Express API key selection strategy.")
+        logger.debug("Using random Express API key selection strategy.")
         
         # Create list of indexed keys
         indexed_keys = list(enumerate(keys))
@@ -50,21 +55,14 @@ class ExpressKeyManager:
         """
         keys = self.express_keys
         if not keys:
-            print("WARNING: No Express API keys available for selection.")
+            logger.warning("No Express API keys available for selection.")
             return None
             
-        print(f"DEBUG: Using round-robin Express API key selection strategy.")
-        
-        # Ensure round_robin_index is within bounds
-        if self.round_robin_index >= len(keys):
-            self.round_robin_index = 0
-            
-        # Get the key at current index
-        key = keys[self.round_robin_index]
-        original_idx = self.round_robin_index
+        logger.debug("Using round-robin Express API key selection strategy.")
         
-        # Move to next index for next call
-        self.round_robin_index = (self.round_robin_index + 1) % len(keys)
+        # Take the current index and advance it for the next call
+        original_idx = self._shared_state.next_cursor("express_keys.cursor", len(keys))
+        key = keys[original_idx]
         
         return (original_idx, key)
     
@@ -92,4 +90,4 @@ class ExpressKeyManager:
         Legacy method kept for compatibility.
         Keys are now refreshed automatically via property access.
         """
-        print(f"INFO: Express API keys refreshed (auto). Total keys: {self.get_total_keys()}")
\ No newline at end of file
+        logger.info("Express API keys refreshed (auto). Total keys: %s", self.get_total_keys())
\ No newline at end of file
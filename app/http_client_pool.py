@@ -0,0 +1,108 @@
+import importlib.util
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+import httpx
+
+import config as app_config
+from app_logging import get_logger
+
+if TYPE_CHECKING:
+    import openai
+
+logger = get_logger("http_pool")
+
+# Placeholder credential for pooled OpenAI SDK clients. The real token is sent per request
+# in the Authorization header, so one client serves every rotation of a project's token.
+POOLED_CLIENT_API_KEY = "per-request"
+
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _transport_key() -> Tuple[Optional[str], Any]:
+    verify = app_config.SSL_CERT_FILE if app_config.SSL_CERT_FILE else True
+    return app_config.PROXY_URL or None, verify
+
+
+class HttpClientPool:
+    """
+    Long-lived HTTP clients for the OpenAI-direct paths. One httpx client per proxy/TLS
+    setting holds the keep-alive (and, with h2 installed, multiplexed HTTP/2) connections;
+    OpenAI SDK clients are cached per project and location on top of it. Clients carry no
+    credentials; callers pass auth headers on each request.
+    """
+
+    def __init__(self):
+        self._http_clients: Dict[Tuple[Optional[str], Any], httpx.AsyncClient] = {}
+        # Each OpenAI client is stored with the httpx client it wraps, so a replaced httpx
+        # client (closed, or new proxy settings) also replaces the SDK clients on top of it.
+        self._openai_clients: Dict[Tuple[str, str, Optional[str], Any], Tuple["openai.AsyncOpenAI", httpx.AsyncClient]] = {}
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        key = _transport_key()
+        client = self._http_clients.get(key)
+        if client is None or client.is_closed:
+            proxy, verify = key
+            http2 = app_config.HTTP2_ENABLED and _HTTP2_AVAILABLE
+            client = httpx.AsyncClient(
+                proxy=proxy,
+                verify=verify,
+                http2=http2,
+                timeout=300,
+                limits=httpx.Limits(
+                    max_connections=app_config.HTTP_POOL_MAX_CONNECTIONS or None,
+                    max_keepalive_connections=app_config.HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=app_config.HTTP_POOL_KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._http_clients[key] = client
+            logger.info("Opened pooled HTTP client (proxy: %s, http2: %s)", bool(proxy), http2)
+        return client
+
+    def get_openai_client(self, project_id: str, location: str = "global") -> "openai.AsyncOpenAI":
+        import openai # Deferred: only SA OpenAI Direct requests need the SDK
+
+        proxy, verify = _transport_key()
+        key = (project_id, location, proxy, verify)
+        http_client = self.get_http_client()
+        cached = self._openai_clients.get(key)
+        if cached is not None and cached[1] is http_client:
+            return cached[0]
+        endpoint_url = (
+            f"{app_config.UPSTREAM_BASE_URL}/v1beta1/"
+            f"projects/{project_id}/locations/{location}/endpoints/openapi"
+        )
+        client = openai.AsyncOpenAI(
+            base_url=endpoint_url,
+            api_key=POOLED_CLIENT_API_KEY,
+            http_client=http_client,
+        )
+        self._openai_clients[key] = (client, http_client)
+        return client
+
+    async def close(self):
+        clients = list(self._http_clients.values())
+        self._http_clients.clear()
+        self._openai_clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning("Error closing pooled HTTP client: %s", e)
+        if clients:
+            logger.info("Closed %d pooled HTTP client(s)", len(clients))
+
+
+# Global singleton
+_http_client_pool_instance: Optional[HttpClientPool] = None
+
+
+def get_http_client_pool() -> HttpClientPool:
+    global _http_client_pool_instance
+    if _http_client_pool_instance is None:
+        _http_client_pool_instance = HttpClientPool()
+    return _http_client_pool_instance
+
+
+async def close_http_client_pool():
+    if _http_client_pool_instance is not None:
+        await _http_client_pool_instance.close()
@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import hashlib
+import importlib.util
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Tuple
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("images")
+
+# Pillow is optional; without it images are sent as they are.
+_PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# Input formats Pillow can decode and Gemini accepts. Anything else (PDF, HEIC, ...) passes through.
+_NORMALIZABLE_MIME_TYPES = frozenset(("image/png", "image/jpeg", "image/jpg", "image/webp", "image/bmp", "image/gif", "image/tiff"))
+_MIN_QUALITY = 50
+_QUALITY_STEP = 15
+_DOWNSCALE_STEP = 0.75
+_MAX_ENCODE_ATTEMPTS = 8
+
+_current_model: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("voutb_image_model", default=None)
+
+
+class ImageLimits(NamedTuple):
+    max_side: int
+    max_bytes: int
+    quality: int
+
+
+def use_model(model: str):
+    """Selects the per-model limits for images converted in the current request."""
+    _current_model.set(model)
+
+
+def current_limits() -> Optional[ImageLimits]:
+    """
+    Limits for the current request's model, or None when normalisation is off. Entries in
+    IMAGE_NORMALIZE_MODEL_LIMITS are matched as substrings of the model; the longest wins.
+    """
+    if not app_config.IMAGE_NORMALIZE_ENABLED or not _PILLOW_AVAILABLE:
+        return None
+    max_side = app_config.IMAGE_NORMALIZE_MAX_SIDE
+    max_bytes = app_config.IMAGE_NORMALIZE_MAX_BYTES
+    model = _current_model.get() or ""
+    overrides = app_config.IMAGE_NORMALIZE_MODEL_LIMITS or {}
+    for pattern in sorted(overrides, key=len, reverse=True):
+        if pattern in model:
+            override = overrides[pattern] or {}
+            max_side = int(override.get("max_side", max_side))
+            max_bytes = int(override.get("max_bytes", max_bytes))
+            break
+    return ImageLimits(max_side, max_bytes, app_config.IMAGE_NORMALIZE_QUALITY)
+
+
+def cache_namespace() -> str:
+    """Suffix for prompt cache keys, so prompts converted under different limits never mix."""
+    limits = current_limits()
+    return "" if limits is None else f"|images:{limits.max_side}:{limits.max_bytes}:{limits.quality}"
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _normalize_sync(data: bytes, limits: ImageLimits) -> Optional[Tuple[bytes, str]]:
+    """Returns (bytes, mime type) of the re-encoded image, or None to keep the original."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        oversized = max(width, height) > limits.max_side
+        if not oversized and len(data) <= limits.max_bytes:
+            return None
+        if getattr(image, "n_frames", 1) > 1:
+            return None # Animated; re-encoding would keep only the first frame
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+        image = ImageOps.exif_transpose(image).convert("RGBA" if has_alpha else "RGB")
+
+    image.thumbnail((limits.max_side, limits.max_side), Image.LANCZOS)
+    # JPEG for opaque images; WebP keeps transparency at a similar size
+    image_format, mime_type = ("WEBP", "image/webp") if has_alpha else ("JPEG", "image/jpeg")
+    quality = limits.quality
+    for _ in range(_MAX_ENCODE_ATTEMPTS):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+        encoded = buffer.getvalue()
+        if len(encoded) <= limits.max_bytes:
+            break
+        ratio = limits.max_bytes / len(encoded)
+        if quality > _MIN_QUALITY and ratio > 0.5:
+            quality = max(_MIN_QUALITY, quality - _QUALITY_STEP)
+        else:
+            # Encoded size scales roughly with the pixel count, so shrink both sides by sqrt(ratio)
+            scale = min(_DOWNSCALE_STEP, ratio ** 0.5 * 0.9)
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+    if not oversized and len(encoded) >= len(data):
+        return None
+    return encoded, mime_type
+
+
+class ImageNormalizer:
+    """
+    Downscales and re-encodes input images that exceed the longest-side or byte limit before
+    they are sent upstream. Work runs on a bounded thread pool (IMAGE_NORMALIZE_WORKERS),
+    and results are cached by content hash and limits, so an image resent every turn is only
+    processed once.
+    """
+
+    def __init__(self):
+        self._results: "OrderedDict[str, Optional[Tuple[bytes, str]]]" = OrderedDict()
+        self._total_bytes = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._warned_missing_pillow = False
+        self.hits = 0
+        self.misses = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, app_config.IMAGE_NORMALIZE_WORKERS), thread_name_prefix="voutb-images")
+        return self._executor
+
+    def _store(self, key: str, result: Optional[Tuple[bytes, str]]):
+        size = len(result[0]) if result else 0
+        max_bytes = app_config.IMAGE_NORMALIZE_CACHE_MAX_BYTES
+        if max_bytes <= 0 or size > max_bytes:
+            return
+        # Concurrent requests with the same image both miss and both store
+        old_result = self._results.pop(key, None)
+        if old_result is not None:
+            self._total_bytes -= len(old_result[0])
+        self._results[key] = result
+        self._total_bytes += size
+        while self._results and self._total_bytes > max_bytes:
+            _, evicted = self._results.popitem(last=False)
+            self._total_bytes -= len(evicted[0]) if evicted else 0
+
+    async def normalize(self, data: bytes, mime_type: str) -> Tuple[bytes, str]:
+        """Returns the (bytes, mime type) to send upstream for an input image."""
+        if app_config.IMAGE_NORMALIZE_ENABLED and not _PILLOW_AVAILABLE and not self._warned_missing_pillow:
+            logger.warning("IMAGE_NORMALIZE_ENABLED is true but Pillow is not installed; images are sent unchanged.")
+            self._warned_missing_pillow = True
+        limits = current_limits()
+        if limits is None or not data or (mime_type or "").lower() not in _NORMALIZABLE_MIME_TYPES:
+            return data, mime_type
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        key = f"{await loop.run_in_executor(executor, _digest, data)}|{limits.max_side}|{limits.max_bytes}|{limits.quality}"
+        if key in self._results:
+            self._results.move_to_end(key)
+            self.hits += 1
+            result = self._results[key]
+        else:
+            self.misses += 1
+            try:
+                result = await loop.run_in_executor(executor, _normalize_sync, data, limits)
+            except Exception as e:
+                # Corrupt or unsupported data: let upstream decide what to do with the original
+                logger.warning("Could not normalise %s image (%d bytes): %s", mime_type, len(data), e)
+                result = None
+            self._store(key, result)
+            if result is not None:
+                logger.debug("Normalised %s image from %d to %d bytes (%s)", mime_type, len(data), len(result[0]), result[1])
+        return result if result is not None else (data, mime_type)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Global singleton
+_image_normalizer_instance: Optional[ImageNormalizer] = None
+
+
+def get_image_normalizer() -> ImageNormalizer:
+    global _image_normalizer_instance
+    if _image_normalizer_instance is None:
+        _image_normalizer_instance = ImageNormalizer()
+    return _image_normalizer_instance
+
+
+def shutdown_image_normalizer():
+    if _image_normalizer_instance is not None:
+        _image_normalizer_instance.shutdown()
@@ -2,12 +2,20 @@ import json
 import os
 from typing import List, Optional
 import config as app_config
+import metrics
+from shared_state import get_shared_state
+from app_logging import get_logger
+
+logger = get_logger("location")
+
+_LOCATION_STATE_KEY = "location"
 
 class LocationManager:
     def __init__(self):
         self.locations: List[str] = []
-        self.current_location_index: int = 0
-        self.consecutive_429_count: int = 0
+        # The current location and the consecutive 429 count live in shared state, so a
+        # switch made by one worker applies to all of them.
+        self._shared_state = get_shared_state()
         # Remove local caching of config values
         
         self._load_locations()
@@ -32,22 +40,47 @@ class LocationManager:
             if os.path.exists(locations_file):
                 with open(locations_file, 'r', encoding='utf-8') as f:
                     self.locations = json.load(f)
-                print(f"INFO: Loaded {len(self.locations)} locations from {locations_file}")
+                logger.info("Loaded %s locations from %s", len(self.locations), locations_file)
             else:
-                print(f"WARNING: locations.json not found at {locations_file}. Using default location only.")
+                logger.warning("locations.json not found at %s. Using default location only.", locations_file)
                 self.locations = [self.default_location]
         except Exception as e:
-            print(f"ERROR: Failed to load locations.json: {e}. Using default location only.")
+            logger.error("Failed to load locations.json: %s. Using default location only.", e)
             self.locations = [self.default_location]
 
+    def _state(self) -> dict:
+        return self._shared_state.get(_LOCATION_STATE_KEY) or {"index": 0, "consecutive_429": 0}
+
+    @property
+    def current_location_index(self) -> int:
+        index = self._state()["index"]
+        return index if 0 <= index < len(self.locations) else 0
+
+    @current_location_index.setter
+    def current_location_index(self, index: int):
+        self._shared_state.update(_LOCATION_STATE_KEY, lambda state: dict(state or {}, index=index, consecutive_429=0))
+
+    @property
+    def consecutive_429_count(self) -> int:
+        return self._state()["consecutive_429"]
+
     def _set_initial_location(self):
         """Set the initial location index based on DEFAULT_LOCATION"""
         if self.default_location in self.locations:
-            self.current_location_index = self.locations.index(self.default_location)
+            initial_index = self.locations.index(self.default_location)
         else:
-            print(f"WARNING: DEFAULT_LOCATION '{self.default_location}' not found in loaded locations. Using first available location.")
-            self.current_location_index = 0
-        print(f"INFO: Initial location set to: {self.get_current_location()}")
+            logger.warning("DEFAULT_LOCATION '%s' not found in loaded locations. Using first available location.", self.default_location)
+            initial_index = 0
+
+        def _initialize(state):
+            # Workers started later keep the location already chosen by their peers, unless
+            # DEFAULT_LOCATION changed since that state was written.
+            if state and state.get("default") == self.default_location and 0 <= state.get("index", -1) < len(self.locations):
+                return state
+            return {"index": initial_index, "consecutive_429": 0, "default": self.default_location}
+
+        self._shared_state.update(_LOCATION_STATE_KEY, _initialize)
+        logger.info("Initial location set to: %s", self.get_current_location())
 
     def get_current_location(self) -> str:
         """Return the current location string"""
@@ -60,16 +93,33 @@ class LocationManager:
         # Debug print
         # print(f"DEBUG: report_error called with status {status_code}. Auto-switch enabled: {self.auto_switch_enabled}")
 
+        if status_code == 429:
+            metrics.LOCATION_429_TOTAL.inc(self.get_current_location())
+
         if not self.auto_switch_enabled:
             return
 
         if status_code == 429:
-            self.consecutive_429_count += 1
-            print(f"WARNING: Received 429 Too Many Requests. Consecutive count: {self.consecutive_429_count}/{self.max_retries_before_switch}")
+            max_retries = self.max_retries_before_switch
+
+            def _count_429(state):
+                # Pure, as shared state may apply it more than once
+                state = dict(state or {"index": 0, "consecutive_429": 0})
+                state["consecutive_429"] += 1
+                state["switched"] = state["consecutive_429"] >= max_retries and bool(self.locations)
+                if state["switched"]:
+                    state["index"] = (state["index"] + 1) % len(self.locations)
+                    state["consecutive_429"] = 0 # Reset counter after switch
+                return state
+
+            old_location = self.get_current_location()
+            state = self._shared_state.update(_LOCATION_STATE_KEY, _count_429)
+            count_before_switch = max_retries if state["switched"] else state["consecutive_429"]
+            logger.warning("Received 429 Too Many Requests. Consecutive count: %s/%s", count_before_switch, max_retries)
             
-            if self.consecutive_429_count >= self.max_retries_before_switch:
-                print(f"DEBUG: Threshold reached ({self.consecutive_429_count} >= {self.max_retries_before_switch}). triggering switch...")
-                self._switch_to_next_location()
+            if state["switched"]:
+                logger.debug("Threshold reached (%s >= %s). triggering switch...", count_before_switch, max_retries)
+                self._log_switch(old_location)
         else:
             # Optional: Reset on other errors? Or only on success?
             # For now, we only reset on explicit success to be safe, 
@@ -80,20 +130,18 @@ class LocationManager:
     def report_success(self):
         """Report a successful request. Resets the 429 counter."""
         if self.consecutive_429_count > 0:
-            self.consecutive_429_count = 0
+            self._shared_state.update(_LOCATION_STATE_KEY, lambda state: dict(state, consecutive_429=0))
             # print("INFO: Request successful. 429 counter reset.")
 
-    def _switch_to_next_location(self):
-        """Switch to the next available location in the list."""
+    def _log_switch(self, old_location: str):
+        """Records a switch to the next location, which report_error() applied atomically."""
         if not self.locations:
             return
 
-        old_location = self.get_current_location()
-        self.current_location_index = (self.current_location_index + 1) % len(self.locations)
-        self.consecutive_429_count = 0 # Reset counter after switch
         new_location = self.get_current_location()
+        metrics.LOCATION_SWITCHES_TOTAL.inc(old_location, new_location)
         
-        print(f"INFO: ----------------------------------------------------------------")
-        print(f"INFO: AUTO-SWITCHING LOCATION due to excessive 429s.")
-        print(f"INFO: From: {old_location}  -->  To: {new_location}")
-        print(f"INFO: ----------------------------------------------------------------")
+        logger.info("----------------------------------------------------------------")
+        logger.info("AUTO-SWITCHING LOCATION due to excessive 429s.")
+        logger.info("From: %s  -->  To: %s", old_location, new_location)
+        logger.info("----------------------------------------------------------------")
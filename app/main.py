@@ -1,25 +1,25 @@
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import os
+import sqlite3
+import threading
+from functools import partial
 from fastapi import FastAPI, Depends # Depends might be used by root endpoint
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
-import aiohttp
-
-# Monkey patch aiohttp.streams.StreamReader to increase the limit for large lines (e.g. base64 images)
-# The default limit is 64KB, which is too small for 4K image base64 strings.
-# We intercept the __init__ method to force a larger limit.
-if hasattr(aiohttp, 'streams') and hasattr(aiohttp.streams, 'StreamReader'):
-    _original_stream_reader_init = aiohttp.streams.StreamReader.__init__
-
-    def _patched_stream_reader_init(self, protocol, limit, *args, **kwargs):
-        # Force limit to 100MB regardless of what is passed
-        new_limit = 100 * 1024 * 1024
-        _original_stream_reader_init(self, protocol, new_limit, *args, **kwargs)
-
-    aiohttp.streams.StreamReader.__init__ = _patched_stream_reader_init
-    print(f"INFO: Successfully patched aiohttp.streams.StreamReader to enforce 100MB limit.")
-else:
-    print("WARNING: Could not patch aiohttp.streams.StreamReader. Large images might fail.")
 
 # Local module imports
+from app_logging import RequestIdMiddleware, get_logger, setup_logging, shutdown_logging
+from tracing import TracingMiddleware, flush as flush_traces
+from http_client_pool import close_http_client_pool
+from codec import shutdown_codec_pool
+from image_normalizer import shutdown_image_normalizer
+from shared_state import shutdown_shared_state
+from batch_jobs import get_batch_scheduler, get_batch_store, stop_batch_scheduler
+import config as app_config
 from auth import get_api_key # Potentially for root endpoint
 from credentials_manager import CredentialManager
 from express_key_manager import ExpressKeyManager
@@ -30,6 +30,36 @@ from vertex_ai_init import init_vertex_ai
 from routes import models_api
 from routes import chat_api
 from routes import admin_api
+from routes import metrics_api
+from routes import batch_api
+from routes import embeddings_api
+
+logger = get_logger("startup")
+# Startup timings, picked out of the server output by start.py --profile-startup
+profile_logger = get_logger("profile")
+
+# Seconds spent in each startup phase; logged when VOUTB_PROFILE_STARTUP is set
+# (start.py --profile-startup).
+STARTUP_TIMINGS = {"imports": time.perf_counter() - _IMPORT_STARTED}
+
+# Request-path modules whose imports are deferred so the server can accept connections
+# before the SDKs have loaded. They are preloaded in the background after startup.
+_PRELOAD_MODULES = ("api_helpers", "message_processing", "openai_handler", "project_id_discovery")
+
+
+def _preload_request_modules():
+    started = time.perf_counter()
+    for module_name in _PRELOAD_MODULES:
+        try:
+            __import__(module_name)
+        except Exception as e:
+            logger.warning("Failed to preload module '%s': %s", module_name, e)
+    STARTUP_TIMINGS["preload"] = time.perf_counter() - started
+    if os.environ.get("VOUTB_PROFILE_STARTUP"):
+        profile_logger.info("preload of request modules took %.1f ms", STARTUP_TIMINGS["preload"] * 1000)
+
+
+setup_logging()
 
 app = FastAPI(title="OpenAI to Gemini Adapter")
 
@@ -40,6 +70,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TracingMiddleware)
+app.add_middleware(RequestIdMiddleware)
 
 credential_manager = CredentialManager()
 app.state.credential_manager = credential_manager # Store manager on app state
@@ -49,35 +81,69 @@ app.state.express_key_manager = express_key_manager # Store express key manager
 
 location_manager = LocationManager()
 app.state.location_manager = location_manager # Store location manager on app state
+STARTUP_TIMINGS["managers"] = time.perf_counter() - _IMPORT_STARTED - STARTUP_TIMINGS["imports"]
 
 # Include API routers
 app.include_router(models_api.router)
 app.include_router(chat_api.router)
 app.include_router(admin_api.router)
+app.include_router(metrics_api.router)
+app.include_router(batch_api.router)
+app.include_router(embeddings_api.router)
+
+
+def _batch_concurrency() -> int:
+    # Re-evaluated per batch so added keys or credentials take effect without a restart
+    accounts = express_key_manager.get_total_keys() + credential_manager.get_total_credentials()
+    return max(1, min(app_config.BATCH_MAX_CONCURRENCY, accounts * app_config.BATCH_CONCURRENCY_PER_KEY))
 
 @app.on_event("startup")
 async def startup_event():
+    init_started = time.perf_counter()
     # Check SA credentials availability
     sa_credentials_available = await init_vertex_ai(credential_manager, location_manager)
+    STARTUP_TIMINGS["init_vertex_ai"] = time.perf_counter() - init_started
     sa_count = credential_manager.get_total_credentials() if sa_credentials_available else 0
     
     # Check Express API keys availability
     express_keys_count = express_key_manager.get_total_keys()
     
-    # Print detailed status
-    print(f"INFO: SA credentials loaded: {sa_count}")
-    print(f"INFO: Express API keys loaded: {express_keys_count}")
-    print(f"INFO: Total authentication methods available: {(1 if sa_count > 0 else 0) + (1 if express_keys_count > 0 else 0)}")
+    # Log detailed status
+    logger.info("SA credentials loaded: %s", sa_count)
+    logger.info("Express API keys loaded: %s", express_keys_count)
+    logger.info("Total authentication methods available: %s", (1 if sa_count > 0 else 0) + (1 if express_keys_count > 0 else 0))
     
     # Determine overall status
     if sa_count > 0 or express_keys_count > 0:
-        print("INFO: Vertex AI authentication initialization completed successfully. At least one authentication method is available.")
+        logger.info("Vertex AI authentication initialization completed successfully. At least one authentication method is available.")
         if sa_count == 0:
-            print("INFO: No SA credentials found, but Express API keys are available for authentication.")
+            logger.info("No SA credentials found, but Express API keys are available for authentication.")
         elif express_keys_count == 0:
-            print("INFO: No Express API keys found, but SA credentials are available for authentication.")
+            logger.info("No Express API keys found, but SA credentials are available for authentication.")
     else:
-        print("ERROR: Failed to initialize any authentication method. Both SA credentials and Express API keys are missing. API will fail.")
+        logger.error("Failed to initialize any authentication method. Both SA credentials and Express API keys are missing. API will fail.")
+
+    if app_config.BATCH_ENABLED:
+        try:
+            await asyncio.to_thread(get_batch_store)
+            get_batch_scheduler().start(partial(chat_api.run_chat_completion, app), _batch_concurrency)
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Failed to start the batch scheduler: %s. Batch jobs will not run.", e)
+
+    if os.environ.get("VOUTB_PROFILE_STARTUP"):
+        for phase, seconds in STARTUP_TIMINGS.items():
+            profile_logger.info("%s took %.1f ms", phase, seconds * 1000)
+    threading.Thread(target=_preload_request_modules, name="voutb-preload", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_batch_scheduler()
+    await close_http_client_pool()
+    shutdown_codec_pool()
+    shutdown_image_normalizer()
+    shutdown_shared_state()
+    flush_traces()
+    shutdown_logging()
 
 @app.get("/")
 async def root():
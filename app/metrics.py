@@ -0,0 +1,320 @@
+import contextvars
+import re
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi.responses import StreamingResponse
+
+import model_loader
+
+# Buckets in seconds, shared by the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+_STATUS_CODE_RE = re.compile(r"\b([1-5]\d\d)\b")
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *label_values: str):
+        """Returns the child for these label values. Hold on to it on hot paths."""
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._new_child()
+            self._children[label_values] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, child in list(self._children.items()):
+            lines.extend(self._render_child(label_values, child))
+        return lines
+
+    def _render_child(self, label_values, child) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self.labels(*label_values).inc(amount)
+
+    def _render_child(self, label_values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(child.value)}"]
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _render_child(self, label_values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "bucket_counts", "count", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        # One slot per bucket plus the +Inf overflow; cumulated only when rendering.
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect_left(self.upper_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float, *label_values: str):
+        self.labels(*label_values).observe(value)
+
+    def _render_child(self, label_values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), child.bucket_counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(upper_bound)}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le)} {cumulative}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "voutb_requests_total", "Chat completion requests by model route and HTTP status.", ("model", "status")))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "voutb_request_duration_seconds", "Time from request arrival until the response body is complete.", ("model",)))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "voutb_time_to_first_token_seconds", "Time from request arrival until the first content chunk of a stream.", ("model",)))
+TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "voutb_completion_tokens_per_second", "Completion tokens per second of generation.", ("model",), TOKENS_PER_SECOND_BUCKETS))
+IN_FLIGHT_STREAMS = REGISTRY.register(Gauge(
+    "voutb_in_flight_streams", "Streaming responses currently being sent."))
+UPSTREAM_RESPONSES = REGISTRY.register(Counter(
+    "voutb_upstream_responses_total", "Upstream call outcomes by backend, account (Express key index or SA project), location and status code.",
+    ("backend", "account", "location", "code")))
+LOCATION_429_TOTAL = REGISTRY.register(Counter(
+    "voutb_location_429_total", "429 responses reported to the location manager.", ("location",)))
+LOCATION_SWITCHES_TOTAL = REGISTRY.register(Counter(
+    "voutb_location_switches_total", "Automatic location switches.", ("from_location", "to_location")))
+PROMPT_CONVERSION_DURATION = REGISTRY.register(Histogram(
+    "voutb_prompt_conversion_seconds", "Time to convert OpenAI messages into a Gemini prompt.", ("strategy",)))
+IMAGE_DOWNLOAD_DURATION = REGISTRY.register(Histogram(
+    "voutb_image_download_seconds", "Image download latency.", ("outcome",)))
+IMAGE_DOWNLOAD_BYTES = REGISTRY.register(Counter(
+    "voutb_image_download_bytes_total", "Bytes of downloaded images."))
+R2_UPLOAD_DURATION = REGISTRY.register(Histogram(
+    "voutb_r2_upload_seconds", "R2 image upload latency.", ("outcome",)))
+R2_UPLOAD_BYTES = REGISTRY.register(Counter(
+    "voutb_r2_upload_bytes_total", "Bytes uploaded to R2."))
+
+
+class RequestMetrics:
+    """Per-request measurements shared by everything that runs on behalf of one request."""
+
+    __slots__ = ("model", "started_at", "first_token_at", "completion_tokens", "backend", "account", "location")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.completion_tokens = 0
+        self.backend = "unknown"
+        self.account = "unknown"
+        self.location = "unknown"
+
+
+_current_request: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar("voutb_request_metrics", default=None)
+
+
+def model_label(model: str) -> str:
+    """
+    The model label for a requested model id: the id itself if it names a catalog model (or
+    one of its listed variants), otherwise "other", so clients cannot grow the label set.
+    """
+    return model if model_loader.catalog_base_model(model) is not None else "other"
+
+
+def start_request(model: str) -> RequestMetrics:
+    """Starts the metrics of the current request; model is the id the client asked for."""
+    request_metrics = RequestMetrics(model_label(model))
+    _current_request.set(request_metrics)
+    return request_metrics
+
+
+def current_request() -> Optional[RequestMetrics]:
+    return _current_request.get()
+
+
+def set_upstream(backend: str, account: str, location: Optional[str]):
+    """Records which backend/account/location the current request is sent to."""
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.backend = backend
+        request_metrics.account = account
+        request_metrics.location = location or "global"
+
+
+def status_code_from_error(error: BaseException) -> str:
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return str(code)
+    match = _STATUS_CODE_RE.search(str(error)[:200])
+    return match.group(1) if match else "error"
+
+
+def record_upstream_result(code: str):
+    request_metrics = _current_request.get()
+    if request_metrics is None:
+        UPSTREAM_RESPONSES.inc("unknown", "unknown", "unknown", code)
+    else:
+        UPSTREAM_RESPONSES.inc(request_metrics.backend, request_metrics.account, request_metrics.location, code)
+
+
+def note_completion_tokens(tokens: Optional[int]):
+    """Streams report a running total, so the largest value seen wins."""
+    request_metrics = _current_request.get()
+    if request_metrics is not None and tokens and tokens > request_metrics.completion_tokens:
+        request_metrics.completion_tokens = tokens
+
+
+def _is_content_chunk(chunk) -> bool:
+    if isinstance(chunk, (bytes, bytearray)):
+        chunk = chunk.decode("utf-8", "ignore")
+    return '"chatcmpl-keepalive"' not in chunk and '"delta": {"reasoning_content": " "}' not in chunk
+
+
+def finish_request(request_metrics: RequestMetrics, status: int):
+    now = time.perf_counter()
+    REQUESTS_TOTAL.inc(request_metrics.model, str(status))
+    REQUEST_DURATION.observe(now - request_metrics.started_at, request_metrics.model)
+    if request_metrics.completion_tokens:
+        generation_started = request_metrics.first_token_at or request_metrics.started_at
+        elapsed = now - generation_started
+        if elapsed > 0:
+            TOKENS_PER_SECOND.observe(request_metrics.completion_tokens / elapsed, request_metrics.model)
+
+
+def instrument_response(request_metrics: RequestMetrics, response):
+    """
+    Records request metrics once the response is complete: immediately for regular
+    responses, and at the end of the body for streams (with time-to-first-token and the
+    in-flight stream gauge).
+    """
+    if not isinstance(response, StreamingResponse):
+        finish_request(request_metrics, response.status_code)
+        return response
+
+    original_iterator = response.body_iterator
+    in_flight = IN_FLIGHT_STREAMS.labels()
+
+    async def _instrumented():
+        in_flight.inc()
+        try:
+            async for chunk in original_iterator:
+                if request_metrics.first_token_at is None and _is_content_chunk(chunk):
+                    request_metrics.first_token_at = time.perf_counter()
+                    TIME_TO_FIRST_TOKEN.observe(request_metrics.first_token_at - request_metrics.started_at, request_metrics.model)
+                yield chunk
+        finally:
+            in_flight.dec()
+            finish_request(request_metrics, response.status_code)
+
+    response.body_iterator = _instrumented()
+    return response
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
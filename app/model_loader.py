@@ -1,13 +1,61 @@
 import httpx
 import asyncio
 import json
+import os
+import time
 from typing import List, Dict, Optional, Any
 
 # Assuming config.py is in the same directory level for Docker execution
-import config as app_config 
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("models")
+
+# Bundled copy of the model list, served until a remote refresh succeeds. The Docker image
+# places it next to the app modules; in a source checkout it sits at the repository root.
+_BUNDLED_MODELS_CONFIG_PATHS = (
+    os.path.join(app_config.BASE_DIR, "vertexModels.json"),
+    os.path.join(os.path.dirname(app_config.BASE_DIR), "vertexModels.json"),
+)
 
 _model_cache: Optional[Dict[str, List[str]]] = None
 _cache_lock = asyncio.Lock()
+_refresh_task: Optional[asyncio.Task] = None
+_last_refresh_attempt = 0.0
+
+def _parse_models_config(data: Any) -> Optional[Dict[str, List[str]]]:
+    """Returns the model lists from a parsed vertexModels.json, or None if it is malformed."""
+    if isinstance(data, dict) and \
+       "vertex_models" in data and isinstance(data["vertex_models"], list) and \
+       "vertex_express_models" in data and isinstance(data["vertex_express_models"], list):
+        return {
+            "vertex_models": data["vertex_models"],
+            "vertex_express_models": data["vertex_express_models"]
+        }
+    return None
+
+def load_bundled_models_config() -> Optional[Dict[str, List[str]]]:
+    """
+    Reads the model configuration shipped with the app (MODELS_CONFIG_FILE if set, otherwise
+    the bundled vertexModels.json). Returns None if no valid file is found.
+    """
+    paths = (app_config.MODELS_CONFIG_FILE,) if app_config.MODELS_CONFIG_FILE else _BUNDLED_MODELS_CONFIG_PATHS
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                parsed = _parse_models_config(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("Failed to read bundled model configuration %s: %s", path, e)
+            continue
+        if parsed is None:
+            logger.error("Bundled model configuration %s has an invalid structure.", path)
+            continue
+        logger.info("Loaded bundled model configuration from %s.", path)
+        return parsed
+    logger.warning("No bundled model configuration found.")
+    return None
 
 async def fetch_and_parse_models_config() -> Optional[Dict[str, List[str]]]:
     """
@@ -16,63 +64,57 @@ async def fetch_and_parse_models_config() -> Optional[Dict[str, List[str]]]:
     Returns None if fetching or parsing fails.
     """
     if not app_config.MODELS_CONFIG_URL:
-        print("ERROR: MODELS_CONFIG_URL is not set in the environment/config.")
+        logger.error("MODELS_CONFIG_URL is not set in the environment/config.")
         return None
 
-    print(f"Fetching model configuration from: {app_config.MODELS_CONFIG_URL}")
+    logger.info("Fetching model configuration from: %s", app_config.MODELS_CONFIG_URL)
     try:
-        proxies = None
+        client_args = {'timeout': 30.0}
         if app_config.PROXY_URL:
-             # httpx accepts specific dict or string. Logic similar to openai_handler
-             if app_config.PROXY_URL.startswith("socks"):
-                 proxies = {"all://": app_config.PROXY_URL}
-             else:
-                 proxies = {"https://": app_config.PROXY_URL, "http://": app_config.PROXY_URL}
-
-        verify_ssl = app_config.SSL_CERT_FILE if app_config.SSL_CERT_FILE else True
+            # httpx routes both http(s) and socks URLs through a single proxy argument
+            client_args['proxy'] = app_config.PROXY_URL
+        client_args['verify'] = app_config.SSL_CERT_FILE if app_config.SSL_CERT_FILE else True
 
-        async with httpx.AsyncClient(proxies=proxies, verify=verify_ssl, timeout=30.0) as client:
+        async with httpx.AsyncClient(**client_args) as client:
             response = await client.get(app_config.MODELS_CONFIG_URL)
             response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
             data = response.json()
-            
+
             # Basic validation of the fetched data structure
-            if isinstance(data, dict) and \
-               "vertex_models" in data and isinstance(data["vertex_models"], list) and \
-               "vertex_express_models" in data and isinstance(data["vertex_express_models"], list):
-                print("Successfully fetched and parsed model configuration.")
-                
-                # Add [EXPRESS] prefix to express models
-                return {
-                    "vertex_models": data["vertex_models"],
-                    "vertex_express_models": data["vertex_express_models"]
-                }
+            parsed = _parse_models_config(data)
+            if parsed is not None:
+                logger.info("Successfully fetched and parsed model configuration.")
+                return parsed
             else:
-                print(f"ERROR: Fetched model configuration has an invalid structure: {data}")
+                logger.error("Fetched model configuration has an invalid structure: %s", data)
                 return None
-    except httpx.RequestError as e:
-        print(f"ERROR: HTTP request failed while fetching model configuration: {e}")
+    except httpx.HTTPError as e:
+        logger.error("HTTP request failed while fetching model configuration: %s", e)
         return None
     except json.JSONDecodeError as e:
-        print(f"ERROR: Failed to decode JSON from model configuration: {e}")
+        logger.error("Failed to decode JSON from model configuration: %s", e)
         return None
     except Exception as e:
-        print(f"ERROR: An unexpected error occurred while fetching/parsing model configuration: {e}")
+        logger.error("An unexpected error occurred while fetching/parsing model configuration: %s", e)
         return None
 
 async def get_models_config() -> Dict[str, List[str]]:
     """
     Returns the cached model configuration.
-    If not cached, fetches and caches it.
-    Returns a default empty structure if fetching fails.
+    If not cached, loads the bundled copy; the remote fetch is only awaited when no bundled
+    copy exists. Returns a default empty structure if both fail.
     """
     global _model_cache
+    if _model_cache is not None:
+        return _model_cache
     async with _cache_lock:
         if _model_cache is None:
-            print("Model cache is empty. Fetching configuration...")
-            _model_cache = await fetch_and_parse_models_config()
+            logger.info("Model cache is empty. Loading configuration...")
+            _model_cache = load_bundled_models_config()
+            if _model_cache is None:
+                _model_cache = await fetch_and_parse_models_config()
             if _model_cache is None: # If fetching failed, use a default empty structure
-                print("WARNING: Using default empty model configuration due to fetch/parse failure.")
+                logger.warning("Using default empty model configuration due to fetch/parse failure.")
                 _model_cache = {"vertex_models": [], "vertex_express_models": []}
     return _model_cache
 
@@ -84,21 +126,59 @@ async def get_vertex_express_models() -> List[str]:
     config = await get_models_config()
     return config.get("vertex_express_models", [])
 
+# Prefixes and suffixes the /v1/models listing adds to catalog ids (see routes/models_api.py)
+_MODEL_ID_PREFIXES = ("[EXPRESS] ", "[PAY]")
+_MODEL_ID_SUFFIXES = ("-encrypt-full", "-encrypt", "-openaisearch", "-openai", "-search", "-auto", "-nothinking", "-max", "-2k", "-4k")
+
+def catalog_base_model(model_id: str) -> Optional[str]:
+    """
+    Returns the catalog model a requested model id is a variant of, or None if it is not in
+    the currently cached catalog (also before the catalog is first loaded). Never blocks.
+    """
+    config = _model_cache
+    if config is None:
+        return None
+    known = set(config.get("vertex_models", [])) | set(config.get("vertex_express_models", []))
+    for prefix in _MODEL_ID_PREFIXES:
+        if model_id.startswith(prefix):
+            model_id = model_id[len(prefix):]
+            break
+    if model_id in known:
+        return model_id
+    for suffix in _MODEL_ID_SUFFIXES:
+        if model_id.endswith(suffix) and model_id[:-len(suffix)] in known:
+            return model_id[:-len(suffix)]
+    return None
+
 async def refresh_models_config_cache() -> bool:
     """
     Forces a refresh of the model configuration cache.
     Returns True if successful, False otherwise.
     """
     global _model_cache
-    print("Attempting to refresh model configuration cache...")
-    async with _cache_lock:
-        new_config = await fetch_and_parse_models_config()
-        if new_config is not None:
-            _model_cache = new_config
-            print("Model configuration cache refreshed successfully.")
-            return True
-        else:
-            print("ERROR: Failed to refresh model configuration cache.")
-            # Optionally, decide if we want to clear the old cache or keep it
-            # _model_cache = {"vertex_models": [], "vertex_express_models": []} # To clear
-            return False
\ No newline at end of file
+    logger.info("Attempting to refresh model configuration cache...")
+    # Fetch outside the lock so readers keep being served from the current catalog, then
+    # swap in the new one with a single assignment.
+    new_config = await fetch_and_parse_models_config()
+    if new_config is not None:
+        _model_cache = new_config
+        logger.info("Model configuration cache refreshed successfully.")
+        return True
+    else:
+        logger.error("Failed to refresh model configuration cache. Keeping the current model configuration.")
+        return False
+
+def schedule_models_config_refresh(force: bool = False) -> Optional[asyncio.Task]:
+    """
+    Starts a background refresh of the model configuration unless one is already running or
+    the last attempt was less than MODELS_CONFIG_REFRESH_SECONDS ago. Never blocks the caller.
+    """
+    global _refresh_task, _last_refresh_attempt
+    if _refresh_task is not None and not _refresh_task.done():
+        return _refresh_task
+    now = time.monotonic()
+    if not force and _last_refresh_attempt and now - _last_refresh_attempt < app_config.MODELS_CONFIG_REFRESH_SECONDS:
+        return None
+    _last_refresh_attempt = now
+    _refresh_task = asyncio.create_task(refresh_models_config_cache())
+    return _refresh_task
@@ -39,4 +39,20 @@ class OpenAIRequest(BaseModel):
     tool_choice: Optional[Union[str, Dict[str, Any]]] = None
 
     # Allow extra fields to pass through without causing validation errors
-    model_config = ConfigDict(extra='allow')
\ No newline at end of file
+    model_config = ConfigDict(extra='allow')
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    dimensions: Optional[int] = None
+    user: Optional[str] = None
+    task_type: Optional[str] = None  # Vertex extension, e.g. RETRIEVAL_DOCUMENT or RETRIEVAL_QUERY
+
+    model_config = ConfigDict(extra='allow')
@@ -5,14 +5,19 @@ This module encapsulates all OpenAI-specific logic that was previously in chat_a
 import json
 import time
 import httpx
-from typing import Dict, Any, AsyncGenerator
+from typing import TYPE_CHECKING, Dict, Any, AsyncGenerator
 
 from fastapi.responses import JSONResponse, StreamingResponse
-import openai
+
+if TYPE_CHECKING:
+    import openai
 
 from models import OpenAIRequest
 from config import VERTEX_REASONING_TAG
 import config as app_config
+import body_spool
+import metrics
+import tracing
 from api_helpers import (
     create_openai_error_response,
     openai_fake_stream_generator,
@@ -21,6 +26,10 @@ from api_helpers import (
 from message_processing import extract_reasoning_by_tags
 from credentials_manager import _refresh_auth
 from project_id_discovery import discover_project_id
+from http_client_pool import get_http_client_pool
+from app_logging import get_logger
+
+logger = get_logger("openai")
 
 
 # Wrapper classes to mimic OpenAI SDK responses for direct httpx calls
@@ -50,7 +59,7 @@ class ExpressClientWrapper:
         self.project_id = project_id
         self.api_key = api_key
         self.location = location
-        self.base_url = f"https://aiplatform.googleapis.com/v1beta1/projects/{self.project_id}/locations/{self.location}/endpoints/openapi"
+        self.base_url = f"{app_config.UPSTREAM_BASE_URL}/v1beta1/projects/{self.project_id}/locations/{self.location}/endpoints/openapi"
         
         # The 'chat.completions' structure mimics the real OpenAI client
         self.chat = self
@@ -67,36 +76,26 @@ class ExpressClientWrapper:
                     data = json.loads(json_str)
                     yield FakeChatCompletionChunk(data)
                 except json.JSONDecodeError:
-                    print(f"Warning: Could not decode JSON from stream line: {json_str}")
+                    logger.warning("Warning: Could not decode JSON from stream line: %s", json_str)
                     continue
 
-    async def _streaming_create(self, **kwargs) -> AsyncGenerator[FakeChatCompletionChunk, None]:
-        """Handles the creation of a streaming request using httpx."""
+    def _prepare_request(self, kwargs: Dict[str, Any]):
         endpoint = f"{self.base_url}/chat/completions"
-        headers = {"Content-Type": "application/json"}
-        params = {"key": self.api_key}
-        
+        # The key travels in a header so the pooled client stays credential-free
+        headers = {"Content-Type": "application/json", "x-goog-api-key": self.api_key}
         payload = kwargs.copy()
         if 'extra_body' in payload:
             payload.update(payload.pop('extra_body'))
+        return endpoint, headers, payload
 
-        proxies = None
-        if app_config.PROXY_URL:
-            if app_config.PROXY_URL.startswith("socks"):
-                proxies = {"all://": app_config.PROXY_URL}
-            else:
-                proxies = {"https://": app_config.PROXY_URL}
-
-        client_args = {'timeout': 300}
-        if proxies:
-            client_args['proxies'] = proxies
-        if app_config.SSL_CERT_FILE:
-            client_args['verify'] = app_config.SSL_CERT_FILE
-        async with httpx.AsyncClient(**client_args) as client:
-            async with client.stream("POST", endpoint, headers=headers, params=params, json=payload, timeout=None) as response:
-                response.raise_for_status()
-                async for chunk in self._stream_generator(response):
-                    yield chunk
+    async def _streaming_create(self, **kwargs) -> AsyncGenerator[FakeChatCompletionChunk, None]:
+        """Handles the creation of a streaming request using httpx."""
+        endpoint, headers, payload = self._prepare_request(kwargs)
+        client = get_http_client_pool().get_http_client()
+        async with client.stream("POST", endpoint, headers=headers, json=payload, timeout=None) as response:
+            response.raise_for_status()
+            async for chunk in self._stream_generator(response):
+                yield chunk
 
     async def create(self, **kwargs) -> Any:
         """
@@ -110,30 +109,47 @@ class ExpressClientWrapper:
             return self._streaming_create(**kwargs)
         
         # Non-streaming logic
-        endpoint = f"{self.base_url}/chat/completions"
-        headers = {"Content-Type": "application/json"}
-        params = {"key": self.api_key}
-        
-        payload = kwargs.copy()
-        if 'extra_body' in payload:
-            payload.update(payload.pop('extra_body'))
+        endpoint, headers, payload = self._prepare_request(kwargs)
+        client = get_http_client_pool().get_http_client()
+        response = await client.post(endpoint, headers=headers, json=payload, timeout=None)
+        response.raise_for_status()
+        return FakeChatCompletion(response.json())
 
-        proxies = None
-        if app_config.PROXY_URL:
-            if app_config.PROXY_URL.startswith("socks"):
-                proxies = {"all://": app_config.PROXY_URL}
-            else:
-                proxies = {"https://": app_config.PROXY_URL}
-
-        client_args = {'timeout': 300}
-        if proxies:
-            client_args['proxies'] = proxies
-        if app_config.SSL_CERT_FILE:
-            client_args['verify'] = app_config.SSL_CERT_FILE
-        async with httpx.AsyncClient(**client_args) as client:
-            response = await client.post(endpoint, headers=headers, params=params, json=payload, timeout=None)
-            response.raise_for_status()
-            return FakeChatCompletion(response.json())
+
+class AuthorizedOpenAIClient:
+    """
+    Exposes a pooled openai.AsyncOpenAI client through the same 'chat.completions.create'
+    interface, adding this request's OAuth token as the Authorization header.
+    """
+    def __init__(self, client: "openai.AsyncOpenAI", gcp_token: str):
+        self._client = client
+        self._auth_headers = {"Authorization": f"Bearer {gcp_token}"}
+        self.chat = self
+        self.completions = self
+
+    async def create(self, **kwargs) -> Any:
+        extra_headers = {**(kwargs.pop("extra_headers", None) or {}), **self._auth_headers}
+        return await self._client.chat.completions.create(extra_headers=extra_headers, **kwargs)
+
+
+# Built once at import and shared by every handler instance; treat as read-only.
+_SAFETY_THRESHOLD = "BLOCK_NONE"
+OPENAI_DIRECT_SAFETY_SETTINGS = tuple(
+    {"category": category, "threshold": _SAFETY_THRESHOLD}
+    for category in (
+        "HARM_CATEGORY_HARASSMENT",
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_CIVIC_INTEGRITY",
+        "HARM_CATEGORY_UNSPECIFIED",
+        "HARM_CATEGORY_IMAGE_HATE",
+        "HARM_CATEGORY_IMAGE_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_IMAGE_HARASSMENT",
+        "HARM_CATEGORY_IMAGE_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_JAILBREAK",
+    )
+)
 
 
 class OpenAIDirectHandler:
@@ -142,47 +158,12 @@ class OpenAIDirectHandler:
     def __init__(self, credential_manager=None, express_key_manager=None):
         self.credential_manager = credential_manager
         self.express_key_manager = express_key_manager
-        safety_threshold = "BLOCK_NONE"
-        self.safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": safety_threshold},
-            {"category": 'HARM_CATEGORY_CIVIC_INTEGRITY', "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_UNSPECIFIED", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_IMAGE_HATE", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_IMAGE_DANGEROUS_CONTENT", "threshold": safety_threshold},
-            {"category": "HARM_CATEGORY_IMAGE_HARASSMENT", "threshold": safety_threshold},
-            {"category": 'HARM_CATEGORY_IMAGE_SEXUALLY_EXPLICIT', "threshold": safety_threshold},
-            {"category": 'HARM_CATEGORY_JAILBREAK', "threshold": safety_threshold}
-        ]
-
-    def create_openai_client(self, project_id: str, gcp_token: str, location: str = "global") -> openai.AsyncOpenAI:
-        """Create an OpenAI client configured for Vertex AI endpoint."""
-        endpoint_url = (
-            f"https://aiplatform.googleapis.com/v1beta1/"
-            f"projects/{project_id}/locations/{location}/endpoints/openapi"
-        )
-        
-        proxies = None
-        if app_config.PROXY_URL:
-            if app_config.PROXY_URL.startswith("socks"):
-                proxies = {"all://": app_config.PROXY_URL}
-            else:
-                proxies = {"https://": app_config.PROXY_URL}
+        self.safety_settings = OPENAI_DIRECT_SAFETY_SETTINGS
 
-        client_args = {}
-        if proxies:
-            client_args['proxies'] = proxies
-        if app_config.SSL_CERT_FILE:
-            client_args['verify'] = app_config.SSL_CERT_FILE
-        
-        http_client = httpx.AsyncClient(**client_args) if client_args else None
-        return openai.AsyncOpenAI(
-            base_url=endpoint_url,
-            api_key=gcp_token,  # OAuth token
-            http_client=http_client,
-        )
+    def create_openai_client(self, project_id: str, gcp_token: str, location: str = "global") -> AuthorizedOpenAIClient:
+        """Returns the pooled OpenAI client for the Vertex AI endpoint, authorized with gcp_token."""
+        client = get_http_client_pool().get_openai_client(project_id, location)
+        return AuthorizedOpenAIClient(client, gcp_token)
     
     def prepare_openai_params(self, request: OpenAIRequest, model_id: str, is_openai_search: bool = False) -> Dict[str, Any]:
         """
@@ -228,7 +209,7 @@ class OpenAIDirectHandler:
     ) -> StreamingResponse:
         """Handle streaming responses for OpenAI Direct mode."""
         if app_config.FAKE_STREAMING_ENABLED:
-            print(f"INFO: OpenAI Fake Streaming (SSE Simulation) ENABLED for model '{request.model}'.")
+            logger.info("OpenAI Fake Streaming (SSE Simulation) ENABLED for model '%s'.", request.model)
             return StreamingResponse(
                 openai_fake_stream_generator(
                     openai_client=openai_client,
@@ -240,7 +221,7 @@ class OpenAIDirectHandler:
                 media_type="text/event-stream"
             )
         else:
-            print(f"INFO: OpenAI True Streaming ENABLED for model '{request.model}'.")
+            logger.info("OpenAI True Streaming ENABLED for model '%s'.", request.model)
             return StreamingResponse(
                 self._true_stream_generator(openai_client, openai_params, openai_extra_body, request),
                 media_type="text/event-stream"
@@ -254,6 +235,9 @@ class OpenAIDirectHandler:
         request: OpenAIRequest
     ) -> AsyncGenerator[str, None]:
         """Generate true streaming response."""
+        upstream_span = tracing.start_span("upstream.chat_completions_stream", tracing.SPAN_KIND_CLIENT, {
+            "gen_ai.system": "vertex_ai", "gen_ai.request.model": openai_params.get("model", ""),
+        })
         try:
             # Ensure stream=True is explicitly passed for real streaming
             openai_params_for_stream = {**openai_params, "stream": True}
@@ -261,6 +245,7 @@ class OpenAIDirectHandler:
                 **openai_params_for_stream,
                 extra_body=openai_extra_body
             )
+            upstream_span.add_event("gen_ai.response_started")
             
             # Create processor for tag-based extraction across chunks
             reasoning_processor = StreamingReasoningProcessor(VERTEX_REASONING_TAG)
@@ -331,7 +316,7 @@ class OpenAIDirectHandler:
 
                 except Exception as chunk_error:
                     error_msg = f"Error processing OpenAI chunk for {request.model}: {str(chunk_error)}"
-                    print(f"ERROR: {error_msg}")
+                    logger.error(error_msg)
                     if len(error_msg) > 1024:
                         error_msg = error_msg[:1024] + "..."
                     error_response = create_openai_error_response(500, error_msg, "server_error")
@@ -379,14 +364,19 @@ class OpenAIDirectHandler:
             }
             yield f"data: {json.dumps(finish_payload, ensure_ascii=False)}\n\n"
             
+            metrics.record_upstream_result("200")
+            upstream_span.end()
             yield "data: [DONE]\n\n"
             
         except Exception as stream_error:
+            metrics.record_upstream_result(metrics.status_code_from_error(stream_error))
+            upstream_span.record_exception(stream_error)
+            upstream_span.end()
             error_msg = str(stream_error)
             if len(error_msg) > 1024:
                 error_msg = error_msg[:1024] + "..."
             error_msg_full = f"Error during OpenAI streaming for {request.model}: {error_msg}"
-            print(f"ERROR: {error_msg_full}")
+            logger.error(error_msg_full)
             error_response = create_openai_error_response(500, error_msg_full, "server_error")
             yield f"data: {json.dumps(error_response, ensure_ascii=False)}\n\n"
             yield "data: [DONE]\n\n"
@@ -402,11 +392,18 @@ class OpenAIDirectHandler:
         try:
             # Ensure stream=False is explicitly passed
             openai_params_non_stream = {**openai_params, "stream": False}
-            response = await openai_client.chat.completions.create(
-                **openai_params_non_stream,
-                extra_body=openai_extra_body
-            )
+            with tracing.use_span("upstream.chat_completions", tracing.SPAN_KIND_CLIENT, {
+                "gen_ai.system": "vertex_ai", "gen_ai.request.model": openai_params.get("model", ""),
+            }):
+                response = await openai_client.chat.completions.create(
+                    **openai_params_non_stream,
+                    extra_body=openai_extra_body
+                )
+            metrics.record_upstream_result("200")
             response_dict = response.model_dump(exclude_unset=True, exclude_none=True)
+            usage_dict = response_dict.get('usage')
+            if isinstance(usage_dict, dict):
+                metrics.note_completion_tokens(usage_dict.get('completion_tokens'))
             
             try:
                 choices = response_dict.get('choices')
@@ -422,7 +419,7 @@ class OpenAIDirectHandler:
                         actual_content = full_content if isinstance(full_content, str) else ""
                         
                         if actual_content:
-                            print(f"INFO: OpenAI Direct Non-Streaming - Applying tag extraction with fixed marker: '{VERTEX_REASONING_TAG}'")
+                            logger.info("OpenAI Direct Non-Streaming - Applying tag extraction with fixed marker: '%s'", VERTEX_REASONING_TAG)
                             reasoning_text, actual_content = extract_reasoning_by_tags(actual_content, VERTEX_REASONING_TAG)
                             message_dict['content'] = actual_content
                             if reasoning_text:
@@ -431,17 +428,18 @@ class OpenAIDirectHandler:
                             # else:
                             #     print(f"DEBUG: No content found within fixed tag '{VERTEX_REASONING_TAG}'.")
                         else:
-                            print(f"WARNING: OpenAI Direct Non-Streaming - No initial content found in message.")
+                            logger.warning("OpenAI Direct Non-Streaming - No initial content found in message.")
                             message_dict['content'] = ""
                             
             except Exception as e_reasoning:
-                print(f"WARNING: Error during non-streaming reasoning processing for model {request.model}: {e_reasoning}")
+                logger.warning("Error during non-streaming reasoning processing for model %s: %s", request.model, e_reasoning)
             
             return JSONResponse(content=response_dict)
             
         except Exception as e:
+            metrics.record_upstream_result(metrics.status_code_from_error(e))
             error_msg = f"Error calling OpenAI client for {request.model}: {str(e)}"
-            print(f"ERROR: {error_msg}")
+            logger.error(error_msg)
             return JSONResponse(
                 status_code=500, 
                 content=create_openai_error_response(500, error_msg, "server_error")
@@ -449,7 +447,11 @@ class OpenAIDirectHandler:
     
     async def process_request(self, request: OpenAIRequest, base_model_name: str, is_express: bool = False, is_openai_search: bool = False):
         """Main entry point for processing OpenAI Direct mode requests."""
-        print(f"INFO: Using OpenAI Direct Path for model: {request.model} (Express: {is_express})")
+        with tracing.use_span("openai.process_request", attributes={"gen_ai.request.model": base_model_name, "voutb.express": is_express}):
+            return await self._process_request(request, base_model_name, is_express, is_openai_search)
+
+    async def _process_request(self, request: OpenAIRequest, base_model_name: str, is_express: bool, is_openai_search: bool):
+        logger.info("Using OpenAI Direct Path for model: %s (Express: %s)", request.model, is_express)
         
         client: Any = None # Can be openai.AsyncOpenAI or our wrapper
 
@@ -462,11 +464,12 @@ class OpenAIDirectHandler:
                 if not key_tuple:
                     raise Exception("OpenAI Express Mode requires an API key, but none were available.")
                 
-                _, express_api_key = key_tuple
+                express_key_idx, express_api_key = key_tuple
                 project_id = await discover_project_id(express_api_key)
+                metrics.set_upstream("express", f"key-{express_key_idx}", "global")
                 
                 client = ExpressClientWrapper(project_id=project_id, api_key=express_api_key)
-                print(f"INFO: [OpenAI Express Path] Using ExpressClientWrapper for project: {project_id}")
+                logger.info("[OpenAI Express Path] Using ExpressClientWrapper for project: %s", project_id)
 
             else: # Standard SA-based OpenAI SDK Path
                 if not self.credential_manager:
@@ -476,14 +479,18 @@ class OpenAIDirectHandler:
                 if not rotated_credentials or not rotated_project_id:
                     raise Exception("OpenAI Direct Mode requires GCP credentials, but none were available.")
 
-                print(f"INFO: [OpenAI Direct Path] Using credentials for project: {rotated_project_id}")
-                gcp_token = _refresh_auth(rotated_credentials)
+                logger.info("[OpenAI Direct Path] Using credentials for project: %s", rotated_project_id)
+                metrics.set_upstream("sa", rotated_project_id, "global")
+                with tracing.use_span("credentials.token_refresh", attributes={"voutb.account": rotated_project_id}):
+                    gcp_token = _refresh_auth(rotated_credentials)
                 if not gcp_token:
                     raise Exception(f"Failed to obtain valid GCP token for OpenAI client (Project: {rotated_project_id}).")
                 client = self.create_openai_client(rotated_project_id, gcp_token)
 
             model_id = f"google/{base_model_name}"
             openai_params = self.prepare_openai_params(request, model_id, is_openai_search)
+            # This upstream takes the messages as they are, so spooled images go back inline
+            openai_params["messages"] = await body_spool.inline_references(openai_params["messages"])
             openai_extra_body = self.prepare_extra_body()
             
             if request.stream:
@@ -496,5 +503,5 @@ class OpenAIDirectHandler:
                 )
         except Exception as e:
             error_msg = f"Error in process_request for {request.model}: {e}"
-            print(f"ERROR: {error_msg}")
+            logger.error(error_msg)
             return JSONResponse(status_code=500, content=create_openai_error_response(500, error_msg, "server_error"))
@@ -1,13 +1,28 @@
 import aiohttp
+import hashlib
 import json
 import re
 from typing import Dict, Optional
 import config
+from shared_state import get_shared_state
+from app_logging import get_logger
 
-# Global cache for project IDs: {api_key: project_id}
+logger = get_logger("project_id")
+
+# Global cache for project IDs: {api_key: project_id}. Discovered IDs are also written to
+# shared state (under a hash of the key) so other workers skip the probe.
 PROJECT_ID_CACHE: Dict[str, str] = {}
 
 
+def _shared_state_key(api_key: str) -> str:
+    return "project_id:" + hashlib.blake2b(api_key.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _remember_project_id(api_key: str, project_id: str):
+    PROJECT_ID_CACHE[api_key] = project_id
+    get_shared_state().set(_shared_state_key(api_key), project_id)
+
+
 def _get_proxy_url() -> Optional[str]:
     """Get proxy URL from config."""
     return config.PROXY_URL
@@ -29,11 +44,16 @@ async def discover_project_id(api_key: str) -> str:
     """
     # Check cache first
     if api_key in PROJECT_ID_CACHE:
-        print(f"INFO: Using cached project ID: {PROJECT_ID_CACHE[api_key]}")
+        logger.info("Using cached project ID: %s", PROJECT_ID_CACHE[api_key])
         return PROJECT_ID_CACHE[api_key]
+    shared_project_id = get_shared_state().get(_shared_state_key(api_key))
+    if shared_project_id:
+        PROJECT_ID_CACHE[api_key] = shared_project_id
+        logger.info("Using project ID discovered by another worker: %s", shared_project_id)
+        return shared_project_id
     
     # Use a non-existent model to trigger error
-    error_url = f"https://aiplatform.googleapis.com/v1/publishers/google/models/gemini-2.7-pro-preview-05-06:streamGenerateContent?key={api_key}"
+    error_url = f"{config.UPSTREAM_BASE_URL}/v1/publishers/google/models/gemini-2.7-pro-preview-05-06:streamGenerateContent?key={api_key}"
     
     # Create minimal request payload
     payload = {
@@ -61,20 +81,20 @@ async def discover_project_id(api_key: str) -> str:
                         match = re.search(r'projects/(\d+)/locations/', error_message)
                         if match:
                             project_id = match.group(1)
-                            PROJECT_ID_CACHE[api_key] = project_id
-                            print(f"INFO: Discovered project ID: {project_id}")
+                            _remember_project_id(api_key, project_id)
+                            logger.info("Discovered project ID: %s", project_id)
                             return project_id
                 except json.JSONDecodeError:
                     # If not JSON, try to find project ID in raw text
                     match = re.search(r'projects/(\d+)/locations/', response_text)
                     if match:
                         project_id = match.group(1)
-                        PROJECT_ID_CACHE[api_key] = project_id
-                        print(f"INFO: Discovered project ID from raw response: {project_id}")
+                        _remember_project_id(api_key, project_id)
+                        logger.info("Discovered project ID from raw response: %s", project_id)
                         return project_id
                 
                 raise Exception(f"Failed to discover project ID. Status: {response.status}, Response: {response_text[:500]}")
                 
         except Exception as e:
-            print(f"ERROR: Failed to discover project ID: {e}")
+            logger.error("Failed to discover project ID: %s", e)
             raise
\ No newline at end of file
@@ -0,0 +1,181 @@
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+from google.genai import types
+
+from models import OpenAIMessage, ContentPartText, ContentPartImage
+from prompt_ir import PromptMessage
+import config as app_config
+
+
+class PromptContents(list):
+    """
+    Converted Gemini contents of a prompt, with content_hashes[i] identifying contents[:i + 1]
+    (the prefix hash of the message contents[i] was converted from). Lets the context cache
+    fingerprint prompt prefixes without serializing the contents again.
+    """
+
+    def __init__(self, contents: Sequence[types.Content], content_hashes: Sequence[str]):
+        super().__init__(contents)
+        self.content_hashes: Tuple[str, ...] = tuple(content_hashes)
+
+
+class PromptPrefixEntry:
+    """Converted Gemini contents for a message prefix, plus the conversion state at its end."""
+
+    __slots__ = ("contents", "content_hashes", "pending_images", "size_bytes")
+
+    def __init__(self, contents: Sequence[types.Content], content_hashes: Sequence[str], pending_images: Sequence[str]):
+        self.contents: Tuple[types.Content, ...] = tuple(contents)
+        self.content_hashes: Tuple[str, ...] = tuple(content_hashes)
+        # Images generated by a trailing assistant message that still have to be attached
+        # to the next user message.
+        self.pending_images: Tuple[str, ...] = tuple(pending_images)
+        self.size_bytes = _estimate_contents_size(self.contents) + sum(len(url) for url in self.pending_images)
+
+
+def _update_hash(hasher, value):
+    """
+    Feeds a JSON-like value into hasher with type and length markers, so distinct values
+    never hash alike. Strings go in as they are instead of being copied into one serialized
+    document first; large ones are hashed with the GIL released.
+    """
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        hasher.update(b"s%d:" % len(data))
+        hasher.update(data)
+    elif isinstance(value, dict):
+        hasher.update(b"d%d:" % len(value))
+        for key, item in value.items():
+            _update_hash(hasher, key)
+            _update_hash(hasher, item)
+    elif isinstance(value, tuple) and hasattr(value, "_fields"):
+        # NamedTuple: the type name keeps records with the same field values apart
+        hasher.update(b"t%s:%d:" % (type(value).__name__.encode("ascii"), len(value)))
+        for item in value:
+            _update_hash(hasher, item)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"l%d:" % len(value))
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(b"v%s;" % repr(value).encode("utf-8"))
+
+
+def _estimate_contents_size(contents: Sequence[types.Content]) -> int:
+    """Rough memory footprint of converted contents, dominated by inline image bytes."""
+    total = 0
+    for content in contents:
+        for part in content.parts or []:
+            if part.inline_data is not None and part.inline_data.data:
+                total += len(part.inline_data.data)
+            elif part.text:
+                total += len(part.text)
+            else:
+                total += 64
+    return total
+
+
+class PromptPrefixCache:
+    """
+    Bounded LRU cache of converted prompt prefixes.
+
+    Multi-turn clients resend the whole history every turn. Entries are keyed by a rolling
+    hash over the messages of a prefix (namespaced by prompt strategy), so a new turn only
+    converts the messages appended since the longest cached prefix.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, PromptPrefixEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return app_config.PROMPT_CACHE_ENABLED
+
+    @property
+    def max_entries(self) -> int:
+        return app_config.PROMPT_CACHE_MAX_ENTRIES
+
+    @property
+    def max_bytes(self) -> int:
+        return app_config.PROMPT_CACHE_MAX_BYTES
+
+    @staticmethod
+    def compute_prefix_hashes(strategy: str, messages: Sequence[PromptMessage]) -> List[str]:
+        """
+        Returns one hash per prefix: hashes[i] identifies messages[:i + 1] under `strategy`.
+        Each hash chains the previous digest with the parsed message.
+        """
+        prefix_hashes = []
+        digest = hashlib.blake2b(strategy.encode("utf-8"), digest_size=16).digest()
+        for message in messages:
+            hasher = hashlib.blake2b(digest, digest_size=16)
+            _update_hash(hasher, message)
+            digest = hasher.digest()
+            prefix_hashes.append(digest.hex())
+        return prefix_hashes
+
+    @staticmethod
+    def estimate_chars(messages: List[OpenAIMessage]) -> int:
+        """Total length of the message texts and image URLs, without serializing anything."""
+        total = 0
+        for message in messages:
+            content = message.content
+            if isinstance(content, str):
+                total += len(content)
+            elif isinstance(content, list):
+                for part in content:
+                    if isinstance(part, ContentPartText):
+                        total += len(part.text)
+                    elif isinstance(part, ContentPartImage):
+                        total += len(part.image_url.url)
+                    elif isinstance(part, dict):
+                        total += len(part.get("text") or "") + len((part.get("image_url") or {}).get("url") or "")
+        return total
+
+    def find_longest_prefix(self, prefix_hashes: List[str]) -> Tuple[int, Optional[PromptPrefixEntry]]:
+        """Returns (number of messages covered, entry) for the longest cached prefix."""
+        for i in range(len(prefix_hashes) - 1, -1, -1):
+            entry = self._entries.get(prefix_hashes[i])
+            if entry is not None:
+                self._entries.move_to_end(prefix_hashes[i])
+                self.hits += 1
+                return i + 1, entry
+        self.misses += 1
+        return 0, None
+
+    def store(self, prefix_hash: str, entry: PromptPrefixEntry):
+        max_bytes = self.max_bytes
+        if entry.size_bytes > max_bytes:
+            return
+
+        old_entry = self._entries.pop(prefix_hash, None)
+        if old_entry is not None:
+            self._total_bytes -= old_entry.size_bytes
+        self._entries[prefix_hash] = entry
+        self._total_bytes += entry.size_bytes
+
+        max_entries = self.max_entries
+        while self._entries and (len(self._entries) > max_entries or self._total_bytes > max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= evicted.size_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self._total_bytes = 0
+
+
+# Global singleton
+_prompt_prefix_cache_instance: Optional[PromptPrefixCache] = None
+
+
+def get_prompt_prefix_cache() -> PromptPrefixCache:
+    """Returns the process-wide prompt prefix cache."""
+    global _prompt_prefix_cache_instance
+    if _prompt_prefix_cache_instance is None:
+        _prompt_prefix_cache_instance = PromptPrefixCache()
+    return _prompt_prefix_cache_instance
@@ -0,0 +1,172 @@
+"""
+Intermediate representation of an OpenAI prompt, shared by every prompt strategy.
+
+Each message is parsed once into text segments (with the positions of any markdown images
+they contain), image references and tool parts. Strategies rewrite this representation
+instead of copying and re-parsing OpenAIMessage objects, and images are only fetched and
+decoded when the final representation is converted to Gemini contents. Parsing does no
+I/O, so it can run off the event loop for large prompts.
+"""
+import json
+import re
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from models import OpenAIMessage, ContentPartText, ContentPartImage
+from app_logging import get_logger
+
+logger = get_logger("prompt")
+
+# Markdown images with a data URL or an HTTP(S) URL: ![alt](data:image/...;base64,...) or ![alt](http...)
+MARKDOWN_IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\((data:image/[^;]+;base64,[^)]+|https?://[^)]+)\)')
+
+
+class MarkdownImage(NamedTuple):
+    url: str
+    start: int
+    end: int
+
+
+class TextSegment(NamedTuple):
+    text: str
+    images: Tuple[MarkdownImage, ...] = ()
+    # Text parts of list content are sent even when empty
+    keep_empty: bool = False
+
+
+class ImageSegment(NamedTuple):
+    url: str
+
+
+class ToolCallSegment(NamedTuple):
+    name: str
+    args: Any
+
+
+class ToolResultSegment(NamedTuple):
+    name: str
+    response: Any
+
+
+Segment = Union[TextSegment, ImageSegment, ToolCallSegment, ToolResultSegment]
+
+
+class PromptMessage(NamedTuple):
+    role: str
+    segments: Tuple[Segment, ...]
+    # Whether the OpenAI content was a plain string rather than a list of parts
+    string_content: bool = False
+
+    @property
+    def has_tool_parts(self) -> bool:
+        return self.role == "tool" or any(isinstance(segment, ToolCallSegment) for segment in self.segments)
+
+    @property
+    def has_image_parts(self) -> bool:
+        return any(isinstance(segment, ImageSegment) for segment in self.segments)
+
+    @property
+    def plain_text(self) -> Optional[str]:
+        """The message text when the content was a plain string, else None."""
+        if self.string_content and len(self.segments) == 1 and isinstance(self.segments[0], TextSegment):
+            return self.segments[0].text
+        return None
+
+    def image_urls(self) -> Iterable[str]:
+        for segment in self.segments:
+            if isinstance(segment, ImageSegment):
+                yield segment.url
+            elif isinstance(segment, TextSegment):
+                for image in segment.images:
+                    yield image.url
+
+
+def parse_text(text: str, keep_empty: bool = False) -> TextSegment:
+    if "![" not in text:
+        return TextSegment(text, (), keep_empty)
+    return TextSegment(text, tuple(MarkdownImage(match.group(1), *match.span()) for match in MARKDOWN_IMAGE_PATTERN.finditer(text)), keep_empty)
+
+
+def replace_images(segment: TextSegment, replace: Callable[[MarkdownImage], Optional[str]]) -> str:
+    """
+    Returns the segment text with each markdown image replaced by replace(image), or left
+    as it is where that returns None.
+    """
+    if not segment.images:
+        return segment.text
+    pieces, position = [], 0
+    for image in segment.images:
+        replacement = replace(image)
+        if replacement is None:
+            continue
+        pieces.append(segment.text[position:image.start])
+        pieces.append(replacement)
+        position = image.end
+    pieces.append(segment.text[position:])
+    return "".join(pieces)
+
+
+def _image_segment(url: str) -> Optional[ImageSegment]:
+    return ImageSegment(url) if url.startswith('data:') or url.startswith('http') else None
+
+
+def _parse_content(content) -> List[Segment]:
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [parse_text(content)]
+    if not isinstance(content, list):
+        return [TextSegment(str(content))]
+    segments: List[Segment] = []
+    for part_item in content:
+        segment = None
+        if isinstance(part_item, ContentPartText):
+            segment = parse_text(part_item.text, keep_empty=True)
+        elif isinstance(part_item, ContentPartImage):
+            segment = _image_segment(part_item.image_url.url)
+        elif isinstance(part_item, dict):
+            if part_item.get('type') == 'text':
+                segment = parse_text(part_item.get('text', '\n'))
+            elif part_item.get('type') == 'image_url':
+                segment = _image_segment((part_item.get('image_url') or {}).get('url', ''))
+        if segment is not None:
+            segments.append(segment)
+    return segments
+
+
+def _parse_tool_output(content) -> Any:
+    try:
+        if isinstance(content, str):
+            stripped = content.strip()
+            if (stripped.startswith("{") and stripped.endswith("}")) or (stripped.startswith("[") and stripped.endswith("]")):
+                return json.loads(content)
+        return {"result": content}
+    except json.JSONDecodeError:
+        return {"result": str(content)}
+
+
+def parse_message(idx: int, message: OpenAIMessage) -> PromptMessage:
+    if message.role == "tool":
+        if message.name and message.tool_call_id and message.content is not None:
+            return PromptMessage("tool", (ToolResultSegment(message.name, _parse_tool_output(message.content)),))
+        logger.debug("Skipping tool message %s due to missing name, tool_call_id, or content.", idx)
+        return PromptMessage("tool", ())
+
+    segments: List[Segment] = []
+    if message.role == "assistant" and message.tool_calls:
+        for tool_call in message.tool_calls:
+            function_call_data = tool_call.get("function", {})
+            function_name = function_call_data.get("name")
+            arguments_str = function_call_data.get("arguments", "{}")
+            try:
+                parsed_arguments = json.loads(arguments_str)
+            except json.JSONDecodeError:
+                logger.warning("Warning: Could not parse tool call arguments for %s: %s", function_name, arguments_str)
+                parsed_arguments = {}
+            if function_name:
+                segments.append(ToolCallSegment(function_name, parsed_arguments))
+    segments.extend(_parse_content(message.content))
+    return PromptMessage(message.role, tuple(segments), isinstance(message.content, str))
+
+
+def parse_messages(messages: List[OpenAIMessage]) -> List[PromptMessage]:
+    return [parse_message(idx, message) for idx, message in enumerate(messages)]
@@ -1,9 +1,12 @@
-import boto3
 import hashlib
 import time
 from typing import Optional, Tuple
-from botocore.exceptions import ClientError
 import config as app_config
+import metrics
+import tracing
+from app_logging import get_logger
+
+logger = get_logger("r2")
 
 
 class R2Uploader:
@@ -13,7 +16,7 @@ class R2Uploader:
         self.enabled = app_config.R2_ENABLED
         self.client = None
         self.bucket_name = app_config.R2_BUCKET_NAME
-        self.public_url = app_config.R2_PUBLIC_URL.rstrip('/')
+        self.public_url = (app_config.R2_PUBLIC_URL or "").rstrip('/')
         
         if self.enabled:
             if not all([
@@ -23,11 +26,12 @@ class R2Uploader:
                 app_config.R2_BUCKET_NAME,
                 app_config.R2_PUBLIC_URL
             ]):
-                print("WARNING: R2_ENABLED is true but R2 configuration is incomplete. R2 upload will be disabled.")
+                logger.warning("R2_ENABLED is true but R2 configuration is incomplete. R2 upload will be disabled.")
                 self.enabled = False
             else:
                 try:
-                    # 初始化 S3 客户端（R2 兼容 S3 API）
+                    # 初始化 S3 客户端（R2 兼容 S3 API）; boto3 is only imported when R2 is enabled
+                    import boto3
                     from botocore.config import Config
                     self.client = boto3.client(
                         's3',
@@ -37,9 +41,9 @@ class R2Uploader:
                         region_name='auto',  # R2 使用 'auto' 作为区域
                         config=Config(proxies={}) # 强制绕过代理
                     )
-                    print(f"R2 Uploader initialized successfully. Bucket: {self.bucket_name}")
+                    logger.debug("R2 Uploader initialized successfully. Bucket: %s", self.bucket_name)
                 except Exception as e:
-                    print(f"ERROR: Failed to initialize R2 client: {e}")
+                    logger.error("Failed to initialize R2 client: %s", e)
                     self.enabled = False
     
     def _generate_filename(self, image_bytes: bytes, mime_type: str) -> str:
@@ -84,7 +88,10 @@ class R2Uploader:
         """
         if not self.enabled:
             return None
+        from botocore.exceptions import ClientError
         
+        started_at = time.perf_counter()
+        span = tracing.start_span("r2.upload", tracing.SPAN_KIND_CLIENT, {"http.request.body.size": len(image_bytes)})
         try:
             filename = self._generate_filename(image_bytes, mime_type)
             
@@ -100,14 +107,23 @@ class R2Uploader:
             # 生成公开访问 URL
             image_url = f"{self.public_url}/{filename}"
             
-            print(f"Image uploaded to R2: {image_url}")
+            metrics.R2_UPLOAD_DURATION.observe(time.perf_counter() - started_at, "ok")
+            metrics.R2_UPLOAD_BYTES.inc(amount=len(image_bytes))
+            span.end()
+            logger.debug("Image uploaded to R2: %s", image_url)
             return image_url
             
         except ClientError as e:
-            print(f"ERROR: Failed to upload image to R2: {e}")
+            metrics.R2_UPLOAD_DURATION.observe(time.perf_counter() - started_at, "error")
+            span.record_exception(e)
+            span.end()
+            logger.error("Failed to upload image to R2: %s", e)
             return None
         except Exception as e:
-            print(f"ERROR: Unexpected error during R2 upload: {e}")
+            metrics.R2_UPLOAD_DURATION.observe(time.perf_counter() - started_at, "error")
+            span.record_exception(e)
+            span.end()
+            logger.error("Unexpected error during R2 upload: %s", e)
             return None
     
     def is_enabled(self) -> bool:
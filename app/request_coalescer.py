@@ -0,0 +1,186 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("coalescer")
+
+COALESCED_HEADER = "X-Coalesced"
+
+
+class _InFlightRequest:
+    """
+    One upstream call shared by every identical request that arrives while it is running.
+
+    Non-streaming results are shared as a finished body. Streaming results are pumped into a
+    replay buffer once; each subscriber reads it through its own cursor, so a slow client
+    never holds back the upstream read or the other subscribers. Once the buffer exceeds
+    COALESCE_REPLAY_MAX_BYTES no new subscribers can join, and chunks every subscriber has
+    read are dropped.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.status_code = 200
+        self.media_type: Optional[str] = None
+        self.headers: Dict[str, str] = {}
+        self.body: Optional[bytes] = None
+        self.is_stream = False
+        self.chunks: List[Union[str, bytes]] = []
+        self.chunks_offset = 0  # Stream position of chunks[0]
+        self.buffered_bytes = 0
+        self.replay_closed = False
+        self.finished = False
+        self.stream_error: Optional[BaseException] = None
+        self.new_data = asyncio.Condition()
+        self.pump_task: Optional[asyncio.Task] = None
+        # Stream position each subscriber has read up to
+        self.subscribers: Dict[object, int] = {}
+
+    async def pump(self, body_iterator, on_replay_closed: Callable[[], None]):
+        try:
+            async for chunk in body_iterator:
+                async with self.new_data:
+                    self.chunks.append(chunk)
+                    self.buffered_bytes += len(chunk)
+                    if not self.replay_closed and self.buffered_bytes > app_config.COALESCE_REPLAY_MAX_BYTES:
+                        logger.debug("Replay buffer passed %s bytes; no further requests join this stream.", app_config.COALESCE_REPLAY_MAX_BYTES)
+                        self.replay_closed = True
+                        on_replay_closed()
+                    if self.replay_closed:
+                        self._trim()
+                    self.new_data.notify_all()
+        except BaseException as e:
+            self.stream_error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            async with self.new_data:
+                self.finished = True
+                self.new_data.notify_all()
+
+    def _trim(self):
+        """Drops the chunks every subscriber has read."""
+        end = self.chunks_offset + len(self.chunks)
+        drop = min(self.subscribers.values(), default=end) - self.chunks_offset
+        if drop > 0:
+            self.buffered_bytes -= sum(len(chunk) for chunk in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.chunks_offset += drop
+
+    async def subscribe(self, subscriber: object):
+        cursor = self.subscribers.get(subscriber, self.chunks_offset)
+        try:
+            while True:
+                async with self.new_data:
+                    await self.new_data.wait_for(lambda: cursor < self.chunks_offset + len(self.chunks) or self.finished)
+                    batch = self.chunks[cursor - self.chunks_offset:]
+                    finished = self.finished
+                for chunk in batch:
+                    yield chunk
+                cursor += len(batch)
+                if subscriber in self.subscribers:
+                    self.subscribers[subscriber] = cursor
+                if finished and cursor >= self.chunks_offset + len(self.chunks):
+                    if self.stream_error is not None and not isinstance(self.stream_error, asyncio.CancelledError):
+                        raise self.stream_error
+                    return
+        finally:
+            await self.unsubscribe(subscriber)
+
+    async def unsubscribe(self, subscriber: object):
+        """
+        Releases a subscriber. Runs both when its stream ends and as the response's background
+        task, so a client that disconnects before the body is read is released as well.
+        """
+        if self.subscribers.pop(subscriber, None) is None:
+            return
+        # Nobody is listening any more; stop reading upstream.
+        if not self.subscribers and self.pump_task is not None and not self.pump_task.done():
+            self.pump_task.cancel()
+
+    def build_response(self, coalesced: bool) -> Response:
+        headers = dict(self.headers)
+        if coalesced:
+            headers[COALESCED_HEADER] = "true"
+        if self.is_stream:
+            # Registered here rather than on first read so a subscriber whose response has not
+            # started yet still keeps the upstream stream alive.
+            subscriber = object()
+            self.subscribers[subscriber] = self.chunks_offset
+            return StreamingResponse(
+                self.subscribe(subscriber), status_code=self.status_code, media_type=self.media_type, headers=headers,
+                background=BackgroundTask(self.unsubscribe, subscriber),
+            )
+        return Response(content=self.body, status_code=self.status_code, media_type=self.media_type, headers=headers)
+
+
+class RequestCoalescer:
+    """
+    Opt-in coalescing of identical in-flight chat completion requests.
+
+    The first request for a key runs the upstream call; requests with the same key that
+    arrive before it finishes attach to it instead of calling upstream themselves.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, _InFlightRequest] = {}
+        self.coalesced_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return app_config.COALESCE_ENABLED
+
+    async def _lead(self, key: str, flight: _InFlightRequest, call: Callable[[], Awaitable[Response]]):
+        try:
+            response = await call()
+            flight.status_code = response.status_code
+            flight.media_type = response.media_type
+            flight.headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+            if isinstance(response, StreamingResponse):
+                flight.is_stream = True
+                flight.pump_task = asyncio.create_task(flight.pump(response.body_iterator, lambda: self._release(key, flight)))
+                # Late arrivals can still join a running stream: the buffer replays from the start
+                # until it passes COALESCE_REPLAY_MAX_BYTES.
+                flight.pump_task.add_done_callback(lambda _t: self._release(key, flight))
+            else:
+                flight.body = bytes(response.body)
+                self._release(key, flight)
+        except BaseException:
+            self._release(key, flight)
+            raise
+
+    def _release(self, key: str, flight: _InFlightRequest):
+        if self._in_flight.get(key) is flight:
+            del self._in_flight[key]
+
+    async def run(self, key: str, call: Callable[[], Awaitable[Response]]) -> Response:
+        flight = self._in_flight.get(key)
+        coalesced = flight is not None
+        if flight is None:
+            flight = _InFlightRequest()
+            self._in_flight[key] = flight
+            # Run detached so a disconnecting first client does not fail the others.
+            flight.task = asyncio.create_task(self._lead(key, flight, call))
+        else:
+            self.coalesced_count += 1
+            logger.info("Coalescing request into in-flight upstream call (%s in flight).", len(self._in_flight))
+
+        await asyncio.shield(flight.task)
+        return flight.build_response(coalesced)
+
+
+# Global singleton
+_request_coalescer_instance: Optional[RequestCoalescer] = None
+
+
+def get_request_coalescer() -> RequestCoalescer:
+    """Returns the process-wide request coalescer."""
+    global _request_coalescer_instance
+    if _request_coalescer_instance is None:
+        _request_coalescer_instance = RequestCoalescer()
+    return _request_coalescer_instance
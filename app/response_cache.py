@@ -0,0 +1,315 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from models import OpenAIRequest
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("response_cache")
+
+CACHE_STATUS_HEADER = "X-Cache"
+
+# Config switches that change what the proxy returns for the same request.
+_OUTPUT_AFFECTING_CONFIG = ("FAKE_STREAMING_ENABLED", "SAFETY_SCORE", "SAFETY_SCORE_FORMAT", "R2_ENABLED")
+
+
+class CachedResponse:
+    """A completed response body: either a JSON document or the SSE events of a stream."""
+
+    __slots__ = ("kind", "status_code", "body", "events", "created_at", "size_bytes")
+
+    def __init__(self, kind: str, status_code: int, body: Optional[bytes], events: Optional[List[str]], created_at: float):
+        self.kind = kind
+        self.status_code = status_code
+        self.body = body
+        self.events = events
+        self.created_at = created_at
+        if kind == "sse":
+            self.size_bytes = sum(len(event) for event in events or [])
+        else:
+            self.size_bytes = len(body or b"")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "status_code": self.status_code,
+            "body": self.body.decode("utf-8") if self.body is not None else None,
+            "events": self.events,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CachedResponse":
+        body = data.get("body")
+        return cls(
+            data["kind"],
+            data.get("status_code", 200),
+            body.encode("utf-8") if body is not None else None,
+            data.get("events"),
+            data["created_at"],
+        )
+
+
+def compute_request_key(request: OpenAIRequest) -> str:
+    """
+    Normalised hash of everything that determines a chat completion's output: the request
+    (model string including route prefixes/suffixes, messages, generation parameters), the
+    stream flag and the output-affecting config switches.
+    """
+    normalized = {
+        "request": request.model_dump(mode="json", exclude_none=True, exclude={"stream"}),
+        "stream": bool(request.stream),
+        "config": {name: getattr(app_config, name) for name in _OUTPUT_AFFECTING_CONFIG},
+    }
+    payload = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _is_error_event(event: str) -> bool:
+    return event.startswith('data: {"error"')
+
+
+def _is_keep_alive_event(event: str) -> bool:
+    return '"chatcmpl-keepalive"' in event or '"delta": {"reasoning_content": " "}' in event
+
+
+class ResponseCache:
+    """
+    Opt-in cache for deterministic chat completions (temperature 0 or a fixed seed).
+
+    Entries live in a bounded in-memory LRU and, when RESPONSE_CACHE_DIR is set, in a disk
+    tier that survives restarts. Both tiers expire entries after RESPONSE_CACHE_TTL_SECONDS
+    and evict the least recently used ones when over their size budget. Streaming requests
+    are cached as their SSE events and replayed verbatim.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._total_bytes = 0
+        self._disk_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return app_config.RESPONSE_CACHE_ENABLED
+
+    @property
+    def ttl_seconds(self) -> int:
+        return app_config.RESPONSE_CACHE_TTL_SECONDS
+
+    @property
+    def max_entries(self) -> int:
+        return app_config.RESPONSE_CACHE_MAX_ENTRIES
+
+    @property
+    def max_bytes(self) -> int:
+        return app_config.RESPONSE_CACHE_MAX_BYTES
+
+    @property
+    def disk_dir(self) -> Optional[str]:
+        return app_config.RESPONSE_CACHE_DIR or None
+
+    @property
+    def disk_max_bytes(self) -> int:
+        return app_config.RESPONSE_CACHE_DISK_MAX_BYTES
+
+    @staticmethod
+    def is_deterministic(request: OpenAIRequest) -> bool:
+        return request.temperature == 0 or request.seed is not None
+
+    def make_key(self, request: OpenAIRequest) -> Optional[str]:
+        """
+        Returns the cache key for a request, or None when the request must not be cached.
+        The model string carries the route (prefixes and suffixes), so the key covers the
+        resolved route, the prompt and every generation parameter.
+        """
+        if not self.enabled or not self.is_deterministic(request):
+            return None
+        return compute_request_key(request)
+
+    def _is_fresh(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.created_at < self.ttl_seconds
+
+    def _store_memory(self, key: str, entry: CachedResponse):
+        max_bytes = self.max_bytes
+        if entry.size_bytes > max_bytes:
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._total_bytes -= old_entry.size_bytes
+        self._entries[key] = entry
+        self._total_bytes += entry.size_bytes
+
+        max_entries = self.max_entries
+        while self._entries and (len(self._entries) > max_entries or self._total_bytes > max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= evicted.size_bytes
+
+    def _disk_path(self, disk_dir: str, key: str) -> str:
+        return os.path.join(disk_dir, f"{key}.json")
+
+    def _read_disk(self, disk_dir: str, key: str) -> Optional[CachedResponse]:
+        path = self._disk_path(disk_dir, key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = CachedResponse.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Discarding unreadable response cache file %s: %s", path, e)
+            self._remove_file(path)
+            return None
+        if not self._is_fresh(entry):
+            self._remove_file(path)
+            return None
+        # Touch so disk eviction is least-recently-used rather than oldest-written.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def _write_disk(self, disk_dir: str, key: str, entry: CachedResponse):
+        os.makedirs(disk_dir, exist_ok=True)
+        path = self._disk_path(disk_dir, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._evict_disk(disk_dir)
+
+    def _evict_disk(self, disk_dir: str):
+        now = time.time()
+        ttl_seconds = self.ttl_seconds
+        files = []
+        total_bytes = 0
+        for name in os.listdir(disk_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime >= ttl_seconds:
+                self._remove_file(path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+        disk_max_bytes = self.disk_max_bytes
+        if total_bytes <= disk_max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total_bytes <= disk_max_bytes:
+                break
+            self._remove_file(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self._is_fresh(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._entries.pop(key, None)
+            self._total_bytes -= entry.size_bytes
+
+        disk_dir = self.disk_dir
+        if disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, disk_dir, key)
+            if entry is not None:
+                self._store_memory(key, entry)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, entry: CachedResponse):
+        self._store_memory(key, entry)
+        disk_dir = self.disk_dir
+        if disk_dir:
+            try:
+                async with self._disk_lock:
+                    await asyncio.to_thread(self._write_disk, disk_dir, key, entry)
+            except Exception as e:
+                logger.warning("Failed to write response cache entry to disk: %s", e)
+
+    def build_response(self, entry: CachedResponse) -> Response:
+        """Replays a cached entry as a fresh response marked as a cache hit."""
+        headers = {CACHE_STATUS_HEADER: "HIT"}
+        if entry.kind == "sse":
+            async def _replay():
+                for event in entry.events:
+                    yield event
+            return StreamingResponse(_replay(), media_type="text/event-stream", headers=headers)
+        return Response(content=entry.body, status_code=entry.status_code, media_type="application/json", headers=headers)
+
+    def capture(self, key: str, response: Response) -> Response:
+        """
+        Marks a freshly computed response as a cache miss and stores it once complete.
+        Error responses and streams that end without [DONE] or carry an error are not stored.
+        """
+        response.headers[CACHE_STATUS_HEADER] = "MISS"
+
+        if isinstance(response, StreamingResponse):
+            original_iterator = response.body_iterator
+
+            async def _tee():
+                events = []
+                cacheable = True
+                async for chunk in original_iterator:
+                    event = chunk.decode("utf-8") if isinstance(chunk, (bytes, bytearray)) else chunk
+                    if _is_error_event(event):
+                        cacheable = False
+                    elif not _is_keep_alive_event(event):
+                        events.append(event)
+                    yield chunk
+                if cacheable and events and events[-1].strip() == "data: [DONE]":
+                    await self.put(key, CachedResponse("sse", 200, None, events, time.time()))
+
+            response.body_iterator = _tee()
+            return response
+
+        if isinstance(response, JSONResponse) and response.status_code == 200:
+            # Stored in the background so the disk write does not delay the response
+            task = asyncio.create_task(self.put(key, CachedResponse("json", 200, bytes(response.body), None, time.time())))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return response
+
+
+def mark_bypass(response: Response) -> Response:
+    response.headers[CACHE_STATUS_HEADER] = "BYPASS"
+    return response
+
+
+# Global singleton
+_response_cache_instance: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the process-wide response cache."""
+    global _response_cache_instance
+    if _response_cache_instance is None:
+        _response_cache_instance = ResponseCache()
+    return _response_cache_instance
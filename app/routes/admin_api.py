@@ -5,8 +5,11 @@ from fastapi.responses import HTMLResponse, JSONResponse
 from pydantic import BaseModel
 
 import config as app_config
+from admission_control import get_admission_controller
+from app_logging import apply_log_levels, get_logger
 
 router = APIRouter()
+logger = get_logger("admin")
 
 # Path to config files
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -221,6 +224,12 @@ async def get_admin_data(password: str):
         "locations": locations
     })
 
+@router.get("/admin/admission")
+async def get_admission_stats(password: str):
+    if password != app_config.API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API Key")
+    return JSONResponse(get_admission_controller().stats())
+
 @router.post("/admin/config")
 async def update_config(request: Request, data: ConfigUpdate):
     # Auth check
@@ -237,6 +246,8 @@ async def update_config(request: Request, data: ConfigUpdate):
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(new_config, f, indent=4)
         
+        apply_log_levels()
+
         # Hot-reload Location Manager settings if possible
         if hasattr(request.app.state, 'location_manager'):
             lm = request.app.state.location_manager
@@ -253,7 +264,7 @@ async def update_config(request: Request, data: ConfigUpdate):
                     # Only switch if the current location index was pointing to something else
                     # or just force it to the new default.
                     lm.current_location_index = lm.locations.index(new_default)
-                    print(f"INFO: Admin updated location settings. Current location switched to: {new_default}")
+                    logger.info("Admin updated location settings. Current location switched to: %s", new_default)
 
         return {"status": "success", "message": "Config updated. Settings applied immediately."}
     except json.JSONDecodeError:
@@ -0,0 +1,150 @@
+import asyncio
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, File, Form, UploadFile
+from fastapi.responses import FileResponse, JSONResponse
+
+import config as app_config
+from auth import get_api_key
+from batch_jobs import COMPLETION_WINDOWS, SUPPORTED_ENDPOINTS, get_batch_scheduler, get_batch_store
+from models import BatchCreateRequest
+from app_logging import get_logger
+
+logger = get_logger("batch")
+
+router = APIRouter()
+
+_UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+def _error_response(status_code: int, message: str, error_type: str = "invalid_request_error") -> JSONResponse:
+    from api_helpers import create_openai_error_response
+    return JSONResponse(status_code=status_code, content=create_openai_error_response(status_code, message, error_type))
+
+
+def _batches_disabled() -> Optional[JSONResponse]:
+    if not app_config.BATCH_ENABLED:
+        return _error_response(404, "The Batch API is disabled (BATCH_ENABLED=false).")
+    return None
+
+
+@router.post("/v1/files")
+async def upload_file(file: UploadFile = File(...), purpose: str = Form(...), api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    if purpose != "batch":
+        return _error_response(400, f"Unsupported purpose '{purpose}'. Only 'batch' files can be uploaded.")
+    store = await asyncio.to_thread(get_batch_store)
+    file_id = f"file-{os.urandom(12).hex()}"
+    path = store.file_path(file_id)
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            while chunk := await file.read(_UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > app_config.BATCH_MAX_FILE_BYTES:
+                    raise ValueError(f"File exceeds the {app_config.BATCH_MAX_FILE_BYTES} byte limit.")
+                await asyncio.to_thread(f.write, chunk)
+    except ValueError as e:
+        os.remove(path)
+        return _error_response(400, str(e))
+    file_object = await asyncio.to_thread(store.add_file, file_id, file.filename or f"{file_id}.jsonl", purpose, size)
+    logger.info("Stored batch input file %s (%d bytes)", file_id, size)
+    return file_object
+
+
+@router.get("/v1/files")
+async def list_files(purpose: Optional[str] = None, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    return {"object": "list", "data": await asyncio.to_thread(store.list_files, purpose)}
+
+
+@router.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    file_object = await asyncio.to_thread(store.get_file, file_id)
+    if file_object is None:
+        return _error_response(404, f"No such file: {file_id}")
+    return file_object
+
+
+@router.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    file_object = await asyncio.to_thread(store.get_file, file_id)
+    if file_object is None:
+        return _error_response(404, f"No such file: {file_id}")
+    return FileResponse(store.file_path(file_id), media_type="application/jsonl", filename=file_object["filename"])
+
+
+@router.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    if not await asyncio.to_thread(store.delete_file, file_id):
+        return _error_response(404, f"No such file: {file_id}")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@router.post("/v1/batches")
+async def create_batch(request: BatchCreateRequest, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    if request.endpoint not in SUPPORTED_ENDPOINTS:
+        return _error_response(400, f"Unsupported endpoint '{request.endpoint}'. Supported: {', '.join(SUPPORTED_ENDPOINTS)}.")
+    if request.completion_window not in COMPLETION_WINDOWS:
+        return _error_response(400, f"Unsupported completion_window '{request.completion_window}'. Supported: {', '.join(COMPLETION_WINDOWS)}.")
+    store = await asyncio.to_thread(get_batch_store)
+    input_file = await asyncio.to_thread(store.get_file, request.input_file_id)
+    if input_file is None or input_file["purpose"] != "batch":
+        return _error_response(400, f"No batch input file with id '{request.input_file_id}'.")
+    batch = await asyncio.to_thread(store.create_batch, request.input_file_id, request.endpoint, request.completion_window, request.metadata)
+    get_batch_scheduler().wake()
+    logger.info("Created batch %s from %s", batch["id"], request.input_file_id)
+    return batch
+
+
+@router.get("/v1/batches")
+async def list_batches(limit: int = 20, after: Optional[str] = None, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    limit = max(1, min(limit, 100))
+    store = await asyncio.to_thread(get_batch_store)
+    batches = await asyncio.to_thread(store.list_batches, limit + 1, after)
+    data = batches[:limit]
+    return {
+        "object": "list", "data": data,
+        "first_id": data[0]["id"] if data else None, "last_id": data[-1]["id"] if data else None,
+        "has_more": len(batches) > limit,
+    }
+
+
+@router.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    batch = await asyncio.to_thread(store.get_batch, batch_id)
+    if batch is None:
+        return _error_response(404, f"No such batch: {batch_id}")
+    return batch
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, api_key: str = Depends(get_api_key)):
+    if (disabled := _batches_disabled()) is not None:
+        return disabled
+    store = await asyncio.to_thread(get_batch_store)
+    batch = await asyncio.to_thread(store.request_cancel, batch_id)
+    if batch is None:
+        return _error_response(404, f"No such batch: {batch_id}")
+    get_batch_scheduler().wake()
+    return batch
@@ -1,34 +1,264 @@
 import asyncio
 import json
-from fastapi import APIRouter, Depends, Request
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse, StreamingResponse
-
-# Google specific imports
-from google.genai import types
-from google import genai
+from pydantic import ValidationError
+from starlette.background import BackgroundTasks
 
 # Local module imports
 from models import OpenAIRequest
+import config as app_config
 from auth import get_api_key
-from message_processing import (
-    create_gemini_prompt,
-    create_encrypted_gemini_prompt,
-    create_encrypted_full_gemini_prompt,
-    ENCRYPTION_INSTRUCTIONS,
-)
-from api_helpers import (
-    create_generation_config, # Corrected import name
-    create_openai_error_response,
-    execute_gemini_call,
-    get_http_options,
-)
-from openai_handler import OpenAIDirectHandler
-from project_id_discovery import discover_project_id
+from response_cache import compute_request_key, get_response_cache, mark_bypass
+from request_coalescer import get_request_coalescer
+from admission_control import AdmissionRejected, client_id_for, get_admission_controller
+import body_spool
+import image_normalizer
+import metrics
+import tracing
+from app_logging import get_logger
+
+logger = get_logger("chat")
 
 router = APIRouter()
 
+# Admission client of batch jobs; API-key clients are "key-<hash>", so it never collides
+_BATCH_CLIENT_ID = "batch"
+
+
+async def read_chat_request(fastapi_request: Request) -> OpenAIRequest:
+    """
+    Reads the chat request body incrementally (large inline images are spooled to disk,
+    see body_spool) and validates it, failing the way a FastAPI body parameter would.
+    """
+    try:
+        body = await body_spool.read_json_body(fastapi_request.stream())
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        position, reason = (e.pos, e.msg) if isinstance(e, json.JSONDecodeError) else (e.start, e.reason)
+        raise RequestValidationError([{"type": "json_invalid", "loc": ("body", position), "msg": "JSON decode error", "input": {}, "ctx": {"error": reason}}])
+    try:
+        return OpenAIRequest.model_validate(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+
+
 @router.post("/v1/chat/completions")
-async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api_key: str = Depends(get_api_key)):
+async def chat_completions(
+    fastapi_request: Request,
+    api_key: str = Depends(get_api_key),
+    request: OpenAIRequest = Depends(read_chat_request),
+    x_client_id: Optional[str] = Header(None, alias="x-client-id")
+):
+    request_metrics = metrics.start_request(request.model)
+    try:
+        response = await _admitted_chat_completion(fastapi_request, request, api_key, x_client_id)
+    except BaseException:
+        body_spool.close_current()
+        raise
+    return body_spool.close_after(metrics.instrument_response(request_metrics, response))
+
+
+async def _admitted_chat_completion(fastapi_request: Request, request: OpenAIRequest, api_key: str, x_client_id: Optional[str]):
+    admission_controller = get_admission_controller()
+    if not admission_controller.enabled:
+        return await _cached_chat_completion(fastapi_request, request)
+
+    try:
+        ticket = await admission_controller.acquire(client_id_for(api_key, x_client_id))
+    except AdmissionRejected as e:
+        logger.warning("Admission rejected for model '%s': %s (retry after %ss)", request.model, e, e.retry_after)
+        return JSONResponse(
+            status_code=429,
+            content=_error_response(429, str(e), "rate_limit_error"),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+    try:
+        response = await _cached_chat_completion(fastapi_request, request)
+    except BaseException:
+        ticket.release()
+        raise
+    if ticket.wait_seconds > 0:
+        response.headers["X-Queue-Wait-Ms"] = str(int(ticket.wait_seconds * 1000))
+    if isinstance(response, StreamingResponse):
+        # Hold the slot until the stream has been fully sent. The background task covers
+        # responses whose body iterator never starts.
+        original_iterator = response.body_iterator
+
+        async def _release_when_done():
+            try:
+                async for chunk in original_iterator:
+                    yield chunk
+            finally:
+                ticket.release()
+        response.body_iterator = _release_when_done()
+        background = BackgroundTasks()
+        if response.background is not None:
+            background.add_task(response.background)
+        background.add_task(ticket.release)
+        response.background = background
+    else:
+        ticket.release()
+    return response
+
+
+async def run_chat_completion(app, body: dict) -> tuple:
+    """
+    Runs one non-streaming chat completion outside an HTTP request and returns
+    (status_code, response body). The batch scheduler uses it. Requests go through admission
+    control as one background client with BATCH_ADMISSION_WEIGHT, and share the response
+    cache and request coalescing with live traffic.
+    """
+    try:
+        request = OpenAIRequest(**{**body, "stream": False})
+    except ValidationError as e:
+        return 400, _error_response(400, f"Invalid request body: {e}", "invalid_request_error")
+    admission_controller = get_admission_controller()
+    ticket = None
+    if admission_controller.enabled:
+        ticket = await admission_controller.acquire(_BATCH_CLIENT_ID, weight=app_config.BATCH_ADMISSION_WEIGHT, background=True)
+    try:
+        scope = {"type": "http", "app": app, "method": "POST", "path": "/v1/chat/completions", "headers": []}
+        response = await _cached_chat_completion(Request(scope), request)
+        if isinstance(response, StreamingResponse):
+            content = b"".join([chunk if isinstance(chunk, bytes) else chunk.encode("utf-8") async for chunk in response.body_iterator])
+        else:
+            content = response.body
+    finally:
+        if ticket is not None:
+            ticket.release()
+    return response.status_code, json.loads(content)
+
+
+async def _cached_chat_completion(fastapi_request: Request, request: OpenAIRequest):
+    response_cache = get_response_cache()
+    cache_key = response_cache.make_key(request)
+    if cache_key is None:
+        response = await _coalesced_chat_completion(fastapi_request, request)
+        return mark_bypass(response) if response_cache.enabled else response
+
+    cached_entry = await response_cache.get(cache_key)
+    if cached_entry is not None:
+        logger.info("Serving model '%s' from response cache.", request.model)
+        return response_cache.build_response(cached_entry)
+
+    response = await _coalesced_chat_completion(fastapi_request, request, cache_key)
+    return response_cache.capture(cache_key, response)
+
+
+async def _coalesced_chat_completion(fastapi_request: Request, request: OpenAIRequest, request_key: str = None):
+    coalescer = get_request_coalescer()
+    if not coalescer.enabled:
+        return await _process_chat_completion(fastapi_request, request)
+    return await coalescer.run(
+        request_key or compute_request_key(request),
+        lambda: _process_chat_completion(fastapi_request, request)
+    )
+
+
+async def _create_express_client(key_val: str, base_model_name: str, current_location: str):
+    from google import genai
+    from api_helpers import get_http_options
+    from project_id_discovery import discover_project_id
+
+    # Check if model contains "gemini-2.5-pro" or "gemini-2.5-flash" for direct URL approach
+    if "gemini-2.5-pro" in base_model_name or "gemini-2.5-flash" in base_model_name:
+        project_id = await discover_project_id(key_val)
+        base_url = f"{app_config.UPSTREAM_BASE_URL}/v1/projects/{project_id}/locations/{current_location}"
+        client = genai.Client(
+            vertexai=True,
+            api_key=key_val,
+            http_options=get_http_options(custom_base_url=base_url)
+        )
+        client._api_client._http_options.api_version = None
+        return client
+    return genai.Client(vertexai=True, api_key=key_val, http_options=get_http_options())
+
+
+def _create_sa_client(credentials, project_id: str, current_location: str):
+    from google import genai
+    from api_helpers import get_http_options
+
+    return genai.Client(vertexai=True, credentials=credentials, project=project_id, location=current_location, http_options=get_http_options())
+
+
+def _fanout_count(request: OpenAIRequest, accounts: int) -> int:
+    """
+    Number of parallel calls for an n>1 request: one per choice, but no more than the
+    distinct accounts available. 1 sends a single candidate_count call.
+    """
+    n = request.n or 1
+    if n <= 1 or not app_config.FANOUT_ENABLED or n > app_config.FANOUT_MAX_N:
+        return 1
+    return max(1, min(n, accounts))
+
+
+async def _create_fanout_clients(fastapi_request: Request, base_model_name: str, is_express: bool, count: int, used_accounts: set) -> list:
+    """
+    Builds up to count more Gemini clients, each on an Express key or SA project (taken in
+    rotation) not in used_accounts, so no two fan-out calls share an account's quota.
+    """
+    location_manager_instance = fastapi_request.app.state.location_manager
+    express_key_manager_instance = fastapi_request.app.state.express_key_manager
+    credential_manager_instance = fastapi_request.app.state.credential_manager
+    accounts = express_key_manager_instance.get_total_keys() if is_express else credential_manager_instance.get_total_credentials()
+    clients = []
+    # Every draw may return an account already in use; stop after one pass over them
+    for _ in range(accounts):
+        if len(clients) >= count:
+            break
+        current_location = location_manager_instance.get_current_location()
+        try:
+            if is_express:
+                key_tuple = express_key_manager_instance.get_express_api_key()
+                if not key_tuple:
+                    break
+                if key_tuple[1] in used_accounts:
+                    continue
+                used_accounts.add(key_tuple[1])
+                clients.append(await _create_express_client(key_tuple[1], base_model_name, current_location))
+            else:
+                credentials, project_id = credential_manager_instance.get_credentials()
+                if not credentials or not project_id:
+                    break
+                if project_id in used_accounts:
+                    continue
+                used_accounts.add(project_id)
+                clients.append(_create_sa_client(credentials, project_id, current_location))
+        except Exception as e:
+            logger.warning("Fan-out client init failed for model %s: %s", base_model_name, e)
+    return clients
+
+
+def _error_response(status_code: int, message: str, error_type: str) -> dict:
+    from api_helpers import create_openai_error_response
+    return create_openai_error_response(status_code, message, error_type)
+
+
+async def _process_chat_completion(fastapi_request: Request, request: OpenAIRequest):
+    # The SDK-backed modules are imported on first use rather than at startup, so the
+    # server starts accepting requests before google.genai and openai have loaded.
+    from google.genai import types
+    from message_processing import (
+        create_gemini_prompt,
+        create_encrypted_gemini_prompt,
+        create_encrypted_full_gemini_prompt,
+        start_image_scope,
+        ENCRYPTION_INSTRUCTIONS,
+    )
+    from api_helpers import (
+        create_generation_config,
+        create_openai_error_response,
+        execute_gemini_call,
+        execute_gemini_fanout_call,
+    )
+    from openai_handler import OpenAIDirectHandler
+
+    # Images in the prompt are normalised to this model's limits and fetched once for all attempts
+    image_normalizer.use_model(request.model)
+    start_image_scope()
     try:
         credential_manager_instance = fastapi_request.app.state.credential_manager
         location_manager_instance = fastapi_request.app.state.location_manager
@@ -43,6 +273,8 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
         # We still need to fetch vertex_express_model_ids for the Express Mode logic.
         # vertex_express_model_ids = await get_vertex_express_models() # We'll use the prefix now
 
+        route_span = tracing.start_span("route.parse", attributes={"gen_ai.request.model": request.model})
+
         # Updated logic for is_openai_direct_model
         is_openai_direct_model = False
         is_openai_search_model = False
@@ -123,6 +355,11 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
         # if is_max_thinking_model and not (base_model_name.startswith("gemini-2.5-flash") or base_model_name == "gemini-2.5-pro-preview-06-05"):
         #     return JSONResponse(status_code=400, content=create_openai_error_response(400, f"Model '{request.model}' (-max) is only supported for models starting with 'gemini-2.5-flash' or 'gemini-2.5-pro-preview-06-05'.", "invalid_request_error"))
 
+        route_span.set_attribute("voutb.base_model", base_model_name)
+        route_span.set_attribute("voutb.openai_direct", is_openai_direct_model)
+        route_span.set_attribute("voutb.express", is_express_model_request)
+        route_span.end()
+
         # This will now be a dictionary
         gen_config_dict = create_generation_config(request)
 
@@ -135,6 +372,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
             gen_config_dict["thinking_config"]["include_thoughts"] = False
 
         client_to_use = None
+        account_in_use = None
         express_key_manager_instance = fastapi_request.app.state.express_key_manager
 
         # This client initialization logic is for Gemini models (i.e., non-OpenAI Direct models).
@@ -143,66 +381,66 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
         if is_express_model_request: # Changed from elif to if
             if express_key_manager_instance.get_total_keys() == 0:
                 error_msg = f"Model '{request.model}' is an Express model and requires an Express API key, but none are configured."
-                print(f"ERROR: {error_msg}")
+                logger.error(error_msg)
                 return JSONResponse(status_code=401, content=create_openai_error_response(401, error_msg, "authentication_error"))
 
-            print(f"INFO: Attempting voutb Express Mode for model request: {request.model} (base: {base_model_name})")
+            logger.info("Attempting voutb Express Mode for model request: %s (base: %s)", request.model, base_model_name)
             
             # Use the ExpressKeyManager to get keys and handle retries
             total_keys = express_key_manager_instance.get_total_keys()
             for attempt in range(total_keys):
-                key_tuple = express_key_manager_instance.get_express_api_key()
+                with tracing.use_span("credentials.select"):
+                    key_tuple = express_key_manager_instance.get_express_api_key()
                 if key_tuple:
                     original_idx, key_val = key_tuple
+                    client_span = tracing.start_span("client.create", attributes={"voutb.backend": "express", "voutb.account": f"key-{original_idx}"})
                     try:
-                        # Check if model contains "gemini-2.5-pro" or "gemini-2.5-flash" for direct URL approach
-                        if "gemini-2.5-pro" in base_model_name or "gemini-2.5-flash" in base_model_name:
-                            project_id = await discover_project_id(key_val)
-                            current_location = location_manager_instance.get_current_location()
-                            base_url = f"https://aiplatform.googleapis.com/v1/projects/{project_id}/locations/{current_location}"
-                            client_to_use = genai.Client(
-                                vertexai=True,
-                                api_key=key_val,
-                                http_options=get_http_options(custom_base_url=base_url)
-                            )
-                            client_to_use._api_client._http_options.api_version = None
-                            print(f"INFO: Attempt {attempt+1}/{total_keys} - Using voutb Express Mode with custom base URL for model {request.model} (base: {base_model_name}) with API key (original index: {original_idx}).")
-                        else:
-                            client_to_use = genai.Client(vertexai=True, api_key=key_val, http_options=get_http_options())
-                            current_location = location_manager_instance.get_current_location()
-                            print(f"INFO: Attempt {attempt+1}/{total_keys} - Using voutb Express Mode SDK for model {request.model} (base: {base_model_name}) with API key (original index: {original_idx}) in location {current_location}.")
+                        current_location = location_manager_instance.get_current_location()
+                        client_to_use = await _create_express_client(key_val, base_model_name, current_location)
+                        account_in_use = key_val
+                        logger.info("Attempt %s/%s - Using voutb Express Mode for model %s (base: %s) with API key (original index: %s) in location %s.", attempt+1, total_keys, request.model, base_model_name, original_idx, current_location)
+                        metrics.set_upstream("express", f"key-{original_idx}", current_location)
+                        client_span.end()
                         break # Successfully initialized client
                     except Exception as e:
-                        print(f"WARNING: Attempt {attempt+1}/{total_keys} - voutb Express Mode client init failed for API key (original index: {original_idx}) for model {request.model}: {e}. Trying next key.")
+                        client_span.record_exception(e)
+                        client_span.end()
+                        logger.warning("Attempt %s/%s - voutb Express Mode client init failed for API key (original index: %s) for model %s: %s. Trying next key.", attempt+1, total_keys, original_idx, request.model, e)
                         client_to_use = None # Ensure client_to_use is None for this attempt
                 else:
                     # Should not happen if total_keys > 0, but adding a safeguard
-                    print(f"WARNING: Attempt {attempt+1}/{total_keys} - get_express_api_key() returned None unexpectedly.")
+                    logger.warning("Attempt %s/%s - get_express_api_key() returned None unexpectedly.", attempt+1, total_keys)
                     client_to_use = None
                     # Optional: break here if None indicates no more keys are expected
 
             if client_to_use is None: # All configured Express keys failed or none were returned
                 error_msg = f"All {total_keys} configured Express API keys failed to initialize or were unavailable for model '{request.model}'."
-                print(f"ERROR: {error_msg}")
+                logger.error(error_msg)
                 return JSONResponse(status_code=500, content=create_openai_error_response(500, error_msg, "server_error"))
         
         else: # Not an Express model request, therefore an SA credential model request for Gemini
-            print(f"INFO: Model '{request.model}' is an SA credential request for Gemini. Attempting SA credentials.")
+            logger.info("Model '%s' is an SA credential request for Gemini. Attempting SA credentials.", request.model)
+            credentials_span = tracing.start_span("credentials.select")
             rotated_credentials, rotated_project_id = credential_manager_instance.get_credentials()
+            credentials_span.set_attribute("voutb.account", rotated_project_id or "")
+            credentials_span.end()
             
             if rotated_credentials and rotated_project_id:
                 try:
                     current_location = location_manager_instance.get_current_location()
-                    client_to_use = genai.Client(vertexai=True, credentials=rotated_credentials, project=rotated_project_id, location=current_location, http_options=get_http_options())
-                    print(f"INFO: Using SA credential for Gemini model {request.model} (project: {rotated_project_id}, location: {current_location})")
+                    with tracing.use_span("client.create", attributes={"voutb.backend": "sa", "voutb.account": rotated_project_id, "cloud.region": current_location}):
+                        client_to_use = _create_sa_client(rotated_credentials, rotated_project_id, current_location)
+                    account_in_use = rotated_project_id
+                    logger.info("Using SA credential for Gemini model %s (project: %s, location: %s)", request.model, rotated_project_id, current_location)
+                    metrics.set_upstream("sa", rotated_project_id, current_location)
                 except Exception as e:
                     client_to_use = None # Ensure it's None on failure
                     error_msg = f"SA credential client initialization failed for Gemini model '{request.model}': {e}."
-                    print(f"ERROR: {error_msg}")
+                    logger.error(error_msg)
                     return JSONResponse(status_code=500, content=create_openai_error_response(500, error_msg, "server_error"))
             else: # No SA credentials available for an SA model request
                 error_msg = f"Model '{request.model}' requires SA credentials for Gemini, but none are available or loaded."
-                print(f"ERROR: {error_msg}")
+                logger.error(error_msg)
                 return JSONResponse(status_code=401, content=create_openai_error_response(401, error_msg, "authentication_error"))
 
         # If we reach here and client_to_use is still None, it means it's an OpenAI Direct Model,
@@ -212,7 +450,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
              # This case should ideally not be reached if the logic above is correct,
              # as each path (Express/SA for Gemini) should either set client_to_use or return an error.
              # This is a safeguard.
-            print(f"CRITICAL ERROR: Client for Gemini model '{request.model}' was not initialized, and no specific error was returned. This indicates a logic flaw.")
+            logger.error("Client for Gemini model '%s' was not initialized, and no specific error was returned. This indicates a logic flaw.", request.model)
             return JSONResponse(status_code=500, content=create_openai_error_response(500, "Critical internal server error: Gemini client not initialized.", "server_error"))
 
         if is_openai_direct_model:
@@ -224,7 +462,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
                 openai_handler = OpenAIDirectHandler(credential_manager=credential_manager_instance)
                 return await openai_handler.process_request(request, base_model_name, is_openai_search=is_openai_search_model)
         elif is_auto_model:
-            print(f"Processing auto model: {request.model}")
+            logger.debug("Processing auto model: %s", request.model)
             attempts = [
                 {"name": "base", "model": base_model_name, "prompt_func": create_gemini_prompt, "config_modifier": lambda c: c},
                 {"name": "encrypt", "model": base_model_name, "prompt_func": create_encrypted_gemini_prompt, "config_modifier": lambda c: {**c, "system_instruction": ENCRYPTION_INSTRUCTIONS}},
@@ -232,7 +470,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
             ]
             last_err = None
             for attempt in attempts:
-                print(f"Auto-mode attempting: '{attempt['name']}' for model {attempt['model']}")
+                logger.debug("Auto-mode attempting: '%s' for model %s", attempt['name'], attempt['model'])
                 # Apply modifier to the dictionary. Ensure modifier returns a dict.
                 current_gen_config_dict = attempt["config_modifier"](gen_config_dict.copy())
                 try:
@@ -241,10 +479,10 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
                     return result
                 except Exception as e_auto:
                     last_err = e_auto
-                    print(f"Auto-attempt '{attempt['name']}' for model {attempt['model']} failed: {e_auto}")
+                    logger.debug("Auto-attempt '%s' for model %s failed: %s", attempt['name'], attempt['model'], e_auto)
                     await asyncio.sleep(1)
             
-            print(f"All auto attempts failed. Last error: {last_err}")
+            logger.debug("All auto attempts failed. Last error: %s", last_err)
             err_msg = f"All auto-mode attempts failed for model {request.model}. Last error: {str(last_err)}"
             if not request.stream and last_err:
                  return JSONResponse(status_code=500, content=create_openai_error_response(500, err_msg, "server_error"))
@@ -254,7 +492,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
                     err_content = create_openai_error_response(500, err_msg, "server_error")
                     json_payload_final_auto_error = json.dumps(err_content, ensure_ascii=False)
                     # Log the final error being sent to client after all auto-retries failed
-                    print(f"DEBUG: Auto-mode all attempts failed. Yielding final error JSON: {json_payload_final_auto_error}")
+                    logger.debug("Auto-mode all attempts failed. Yielding final error JSON: %s", json_payload_final_auto_error)
                     yield f"data: {json_payload_final_auto_error}\n\n"
                     yield "data: [DONE]\n\n"
                 return StreamingResponse(final_auto_error_stream(), media_type="text/event-stream")
@@ -305,7 +543,16 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
                     gen_config_dict["thinking_config"]["include_thoughts"] = False
 
             try:
-                response = await execute_gemini_call(client_to_use, base_model_name, current_prompt_func, gen_config_dict, request, location_manager=location_manager_instance)
+                accounts = express_key_manager_instance.get_total_keys() if is_express_model_request else credential_manager_instance.get_total_credentials()
+                fanout_count = _fanout_count(request, accounts)
+                fanout_clients = [client_to_use]
+                if fanout_count > 1:
+                    fanout_clients += await _create_fanout_clients(fastapi_request, base_model_name, is_express_model_request, fanout_count - 1, {account_in_use})
+                if len(fanout_clients) > 1:
+                    # Fewer accounts than choices: each call asks for its share of the candidates
+                    response = await execute_gemini_fanout_call(fanout_clients, base_model_name, current_prompt_func, gen_config_dict, request, location_manager=location_manager_instance)
+                else:
+                    response = await execute_gemini_call(client_to_use, base_model_name, current_prompt_func, gen_config_dict, request, location_manager=location_manager_instance)
                 location_manager_instance.report_success()
                 return response
             except Exception as e_call:
@@ -316,7 +563,7 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
                 # we'll look for "429" or "ResourceExhausted" in the string representation.
                 err_str = str(e_call)
                 if "429" in err_str or "ResourceExhausted" in err_str or "Quota exceeded" in err_str:
-                    print(f"DEBUG: Detected 429/Quota error in chat_api: {err_str[:100]}...")
+                    logger.debug("Detected 429/Quota error in chat_api: %s...", err_str[:100])
                     location_manager_instance.report_error(429)
                 raise e_call
 
@@ -327,5 +574,5 @@ async def chat_completions(fastapi_request: Request, request: OpenAIRequest, api
              if 'location_manager_instance' in locals():
                  location_manager_instance.report_error(429)
 
-        print(error_msg)
+        logger.error(error_msg)
         return JSONResponse(status_code=500, content=create_openai_error_response(500, error_msg, "server_error"))
@@ -0,0 +1,131 @@
+import base64
+import struct
+from functools import partial
+from typing import List
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse
+
+from models import EmbeddingRequest
+from auth import get_api_key
+from embeddings import Embedding, EmbeddingRoute, get_embedding_batcher
+import metrics
+from app_logging import get_logger
+
+logger = get_logger("embeddings")
+
+router = APIRouter()
+
+EXPRESS_PREFIX = "[EXPRESS] "
+PAY_PREFIX = "[PAY]"
+
+
+def _error_response(status_code: int, message: str, error_type: str) -> JSONResponse:
+    from api_helpers import create_openai_error_response
+    return JSONResponse(status_code=status_code, content=create_openai_error_response(status_code, message, error_type))
+
+
+def _parse_route(request: EmbeddingRequest) -> EmbeddingRoute:
+    model = request.model
+    is_express = model.startswith(EXPRESS_PREFIX)
+    if is_express:
+        model = model[len(EXPRESS_PREFIX):]
+    if model.startswith(PAY_PREFIX):
+        model = model[len(PAY_PREFIX):]
+    return EmbeddingRoute(model=model, is_express=is_express, dimensions=request.dimensions, task_type=request.task_type)
+
+
+async def _embed_upstream(app, route: EmbeddingRoute, texts: List[str]) -> List[Embedding]:
+    """
+    Sends one predict call for texts on the next Express key or SA credential in rotation.
+    A quota error moves on to the next account; other errors are raised.
+    """
+    from google import genai
+    from google.genai import types
+    from api_helpers import get_http_options
+
+    location_manager = app.state.location_manager
+    if route.is_express:
+        account_count = app.state.express_key_manager.get_total_keys()
+    else:
+        account_count = app.state.credential_manager.get_total_credentials()
+    embed_config = types.EmbedContentConfig(output_dimensionality=route.dimensions, task_type=route.task_type)
+
+    last_error = None
+    for attempt in range(account_count):
+        current_location = location_manager.get_current_location()
+        if route.is_express:
+            key_tuple = app.state.express_key_manager.get_express_api_key()
+            if not key_tuple:
+                break
+            original_idx, key_val = key_tuple
+            client = genai.Client(vertexai=True, api_key=key_val, http_options=get_http_options())
+            metrics.set_upstream("express", f"key-{original_idx}", current_location)
+        else:
+            credentials, project_id = app.state.credential_manager.get_credentials()
+            if not credentials or not project_id:
+                raise ValueError(f"Model '{route.model}' requires SA credentials, but none are available or loaded.")
+            client = genai.Client(vertexai=True, credentials=credentials, project=project_id,
+                                  location=current_location, http_options=get_http_options())
+            metrics.set_upstream("sa", project_id, current_location)
+        try:
+            response = await client.aio.models.embed_content(model=route.model, contents=texts, config=embed_config)
+        except Exception as e:
+            code = metrics.status_code_from_error(e)
+            metrics.record_upstream_result(code)
+            if code != "429":
+                raise
+            location_manager.report_error(429)
+            logger.warning("Attempt %s/%s - embedding call for model %s hit a quota error; trying the next account.", attempt + 1, account_count, route.model)
+            last_error = e
+            continue
+        metrics.record_upstream_result("200")
+        return [
+            Embedding(list(embedding.values or []), int(getattr(embedding.statistics, "token_count", None) or 0))
+            for embedding in response.embeddings or []
+        ]
+    raise last_error or ValueError(f"No account available for embedding model '{route.model}'.")
+
+
+def _encode(values: List[float], encoding_format: str):
+    if encoding_format == "base64":
+        # OpenAI's base64 format: little-endian float32
+        return base64.b64encode(struct.pack(f"<{len(values)}f", *values)).decode("ascii")
+    return values
+
+
+@router.post("/v1/embeddings")
+async def create_embeddings(fastapi_request: Request, request: EmbeddingRequest, api_key: str = Depends(get_api_key)):
+    request_metrics = metrics.start_request(request.model)
+    response = await _process_embeddings(fastapi_request, request)
+    return metrics.instrument_response(request_metrics, response)
+
+
+async def _process_embeddings(fastapi_request: Request, request: EmbeddingRequest):
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts or any(not text for text in texts):
+        return _error_response(400, "'input' must be a non-empty string or a list of non-empty strings.", "invalid_request_error")
+    route = _parse_route(request)
+    if route.is_express and fastapi_request.app.state.express_key_manager.get_total_keys() == 0:
+        return _error_response(401, f"Model '{request.model}' is an Express model and requires an Express API key, but none are configured.", "authentication_error")
+    if not route.is_express and fastapi_request.app.state.credential_manager.get_total_credentials() == 0:
+        return _error_response(401, f"Model '{request.model}' requires SA credentials, but none are available or loaded.", "authentication_error")
+
+    try:
+        embeddings = await get_embedding_batcher().embed(route, texts, partial(_embed_upstream, fastapi_request.app))
+    except Exception as e:
+        code = metrics.status_code_from_error(e)
+        status_code = int(code) if code.isdigit() and 400 <= int(code) < 600 else 500
+        logger.error("Embedding request for model '%s' failed: %s", request.model, e)
+        return _error_response(status_code, f"Embedding request failed: {e}", "api_error" if status_code >= 500 else "invalid_request_error")
+
+    prompt_tokens = sum(embedding.token_count for embedding in embeddings)
+    return JSONResponse(content={
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": _encode(embedding.values, request.encoding_format or "float")}
+            for index, embedding in enumerate(embeddings)
+        ],
+        "model": request.model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    })
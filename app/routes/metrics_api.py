@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from auth import get_api_key
+from metrics import render_metrics
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def get_metrics(api_key: str = Depends(get_api_key)):
+    # Prometheus text exposition format 0.0.4. Scrape with the proxy API key as a bearer token.
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
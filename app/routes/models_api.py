@@ -2,14 +2,15 @@ import time
 from fastapi import APIRouter, Depends, Request
 from typing import List, Dict, Any, Set
 from auth import get_api_key
-from model_loader import get_vertex_models, get_vertex_express_models, refresh_models_config_cache
+from model_loader import get_vertex_models, get_vertex_express_models, schedule_models_config_refresh
 from credentials_manager import CredentialManager
 
 router = APIRouter()
 
 @router.get("/v1/models")
 async def list_models(fastapi_request: Request, api_key: str = Depends(get_api_key)):
-    await refresh_models_config_cache()
+    # Answer from the current catalog; a stale one is refreshed in the background.
+    schedule_models_config_refresh()
     
     PAY_PREFIX = "[PAY]"
     EXPRESS_PREFIX = "[EXPRESS] "
@@ -0,0 +1,258 @@
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import threading
+from typing import Any, Callable, Optional
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("shared_state")
+
+
+class MemoryStateBackend:
+    """Routing state kept in this process; correct for a single worker."""
+
+    name = "memory"
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._values.get(key, default)
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._values[key] = value
+
+    def update(self, key: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        """Atomically replaces the value with func(current) and returns the new value."""
+        with self._lock:
+            value = func(self._values.get(key, default))
+            self._values[key] = value
+            return value
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        return self.update(key, lambda value: value + amount, 0)
+
+    def next_cursor(self, key: str, modulo: int) -> int:
+        """Returns the current round-robin position in [0, modulo) and advances it."""
+        if modulo <= 0:
+            return 0
+        # The stored value is the position handed out next; it is normalized on every read
+        # so a shrinking key list never yields an out-of-range index.
+        position = self.update(key, lambda value: (value % modulo) + 1, 0)
+        return (position - 1) % modulo
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend(MemoryStateBackend):
+    """
+    Routing state shared by every worker on the node through a local SQLite file. Reads and
+    updates are served from an in-process copy, so request handlers never wait on SQLite.
+    A dedicated thread replays each update against the file in a short IMMEDIATE
+    transaction (read-modify-write stays atomic across processes) and then reloads the
+    copy, at least every SYNC_INTERVAL seconds, so other workers' changes show up quickly.
+    Update functions are applied twice (to the copy and to the file) and must be pure.
+
+    Round-robin cursors are not synced, as the copy lags the other workers: each worker
+    claims a slot from the file at startup and walks the list from its own starting point,
+    with the workers' starting points spread evenly over the list.
+    """
+
+    name = "sqlite"
+    SYNC_INTERVAL = 0.5
+    _OWNER_KEY = "deployment.owner"
+    _SLOTS_KEY = "deployment.slots"
+    _STOP = object()
+
+    def __init__(self, path: str, owner: int, workers: int = 1):
+        super().__init__()
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Starting point of this worker's cursors, as a fraction of the list
+        self._cursor_start = _spread(self._claim_slot(owner), workers)
+        self._cursor_counts = {}
+        self._queue: "queue.Queue" = queue.Queue()
+        self._reload()
+        self._thread = threading.Thread(target=self._run, name="shared-state", daemon=True)
+        self._thread.start()
+
+    @contextlib.contextmanager
+    def _immediate(self):
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _claim_slot(self, owner: int) -> int:
+        """
+        Clears state left behind by an earlier run (the workers of one run share an owner)
+        and returns the number of workers of this run that started before this one.
+        """
+        with self._immediate() as connection:
+            row = connection.execute("SELECT value FROM state WHERE key = ?", (self._OWNER_KEY,)).fetchone()
+            if row is None or json.loads(row[0]) != owner:
+                connection.execute("DELETE FROM state")
+                connection.execute("INSERT INTO state (key, value) VALUES (?, ?)", (self._OWNER_KEY, json.dumps(owner)))
+            row = connection.execute("SELECT value FROM state WHERE key = ?", (self._SLOTS_KEY,)).fetchone()
+            slot = json.loads(row[0]) if row else 0
+            connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (self._SLOTS_KEY, json.dumps(slot + 1)))
+        return slot
+
+    def _apply(self, key: str, func: Optional[Callable[[Any], Any]], value: Any):
+        """Writes value, or func applied to the stored value (value being the default)."""
+        with self._immediate() as connection:
+            if func is not None:
+                row = connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                value = func(json.loads(row[0]) if row else value)
+            connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _reload(self):
+        rows = self._connection.execute("SELECT key, value FROM state").fetchall()
+        with self._lock:
+            # Updates queued meanwhile are not in rows yet; the next reload picks them up
+            if self._queue.empty():
+                self._values = {key: json.loads(value) for key, value in rows}
+
+    def _run(self):
+        while True:
+            try:
+                operation = self._queue.get(timeout=self.SYNC_INTERVAL)
+            except queue.Empty:
+                operation = None
+            if operation is self._STOP:
+                return
+            try:
+                if operation is not None:
+                    self._apply(*operation)
+                if self._queue.empty():
+                    self._reload()
+            except Exception as e:
+                logger.warning("Failed to sync shared state with %s: %s", self.path, e)
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._values[key] = value
+            self._queue.put((key, None, value))
+
+    def update(self, key: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        with self._lock:
+            value = func(self._values.get(key, default))
+            self._values[key] = value
+            self._queue.put((key, func, default))
+        return value
+
+    def next_cursor(self, key: str, modulo: int) -> int:
+        if modulo <= 0:
+            return 0
+        with self._lock:
+            count = self._cursor_counts.get(key, 0)
+            self._cursor_counts[key] = count + 1
+        return (int(self._cursor_start * modulo) + count) % modulo
+
+    def close(self):
+        """Writes the queued updates to the file and stops the sync thread."""
+        self._queue.put(self._STOP)
+        self._thread.join(timeout=5.0)
+        self._connection.close()
+
+
+def _spread(slot: int, workers: int) -> float:
+    """Fraction of the list where the cursors of the worker with this slot start."""
+    if workers > 1:
+        # A restarted worker claims a new slot; the modulo reuses the one left behind
+        return (slot % workers) / workers
+    # Worker count unknown: the bit-reversed slot (0, 1/2, 1/4, 3/4, ...) stays evenly spread
+    fraction, scale = 0.0, 0.5
+    while slot:
+        if slot & 1:
+            fraction += scale
+        slot >>= 1
+        scale /= 2
+    return fraction
+
+
+def _configured_workers() -> int:
+    """
+    Worker count of this deployment: VOUTB_WORKERS (set by start.py), WEB_CONCURRENCY
+    (the default of uvicorn's and gunicorn's --workers) or a --workers/-w argument of the
+    server command, which worker processes inherit.
+    """
+    for name in ("VOUTB_WORKERS", "WEB_CONCURRENCY"):
+        value = os.environ.get(name, "").strip()
+        if value.isdigit():
+            return int(value)
+    args = sys.argv[1:]
+    for position, arg in enumerate(args):
+        if arg in ("--workers", "-w") and position + 1 < len(args):
+            value = args[position + 1]
+        elif arg.startswith("--workers="):
+            value = arg.split("=", 1)[1]
+        else:
+            continue
+        if value.isdigit():
+            return int(value)
+    return 1
+
+
+def _default_sqlite_path() -> str:
+    # One file per deployment, so two instances on the node (other config or port) never mix
+    deployment = f"{os.path.abspath(app_config.CONFIG_FILE)}:{os.environ.get('PORT', '')}"
+    digest = hashlib.blake2b(deployment.encode("utf-8"), digest_size=6).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f"voutb-shared-state-{digest}.sqlite3")
+
+
+def _create_backend():
+    backend = str(app_config.SHARED_STATE_BACKEND or "auto").lower()
+    workers = _configured_workers()
+    if backend == "auto":
+        backend = "sqlite" if workers > 1 else "memory"
+    if backend == "sqlite":
+        path = app_config.SHARED_STATE_PATH or _default_sqlite_path()
+        # Workers of one run share their parent, the server's supervisor process
+        owner = os.getppid() if workers > 1 else os.getpid()
+        try:
+            state = SqliteStateBackend(path, owner, workers)
+            logger.info("Sharing routing state across workers via %s", path)
+            return state
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Failed to open shared state at %s: %s. Falling back to per-process state.", path, e)
+    elif backend != "memory":
+        logger.warning("Unknown SHARED_STATE_BACKEND '%s'; using per-process state.", backend)
+    return MemoryStateBackend()
+
+
+# Global singleton
+_shared_state_instance: Optional[MemoryStateBackend] = None
+_shared_state_lock = threading.Lock()
+
+
+def get_shared_state() -> MemoryStateBackend:
+    """Returns the process-wide routing state backend (key cursors, location, project IDs)."""
+    global _shared_state_instance
+    if _shared_state_instance is None:
+        with _shared_state_lock:
+            if _shared_state_instance is None:
+                _shared_state_instance = _create_backend()
+    return _shared_state_instance
+
+
+def shutdown_shared_state():
+    if _shared_state_instance is not None:
+        _shared_state_instance.close()
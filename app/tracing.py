@@ -0,0 +1,318 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import config as app_config
+from app_logging import get_logger
+
+logger = get_logger("tracing")
+
+# OpenTelemetry span kinds as used by OTLP.
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_EXPORT_INTERVAL_SECONDS = 2.0
+_MAX_QUEUED_SPANS = 10000
+
+
+class Span:
+    """A recorded span. Use Span.end() or the use_span() context manager to finish it."""
+
+    __slots__ = ("trace_id", "span_id", "parent_span_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "events", "status_code", "status_message")
+
+    recording = True
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str], kind: int, attributes: Optional[Dict[str, Any]]):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = dict(attributes) if attributes else {}
+        self.events: List[Dict[str, Any]] = []
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes or {}})
+
+    def record_exception(self, error: BaseException):
+        self.status_code = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {str(error)[:256]}"
+        self.add_event("exception", {"exception.type": type(error).__name__, "exception.message": str(error)[:1024]})
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            _processor.on_end(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+class _NonRecordingSpan:
+    """Returned for unsampled requests so instrumentation costs a function call and nothing else."""
+
+    recording = False
+    traceparent = ""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        pass
+
+    def record_exception(self, error: BaseException):
+        pass
+
+    def end(self):
+        pass
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+_current_span: contextvars.ContextVar[Any] = contextvars.ContextVar("voutb_current_span", default=NON_RECORDING_SPAN)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_root_span(name: str, traceparent: Optional[str] = None, kind: int = SPAN_KIND_SERVER, attributes: Optional[Dict[str, Any]] = None):
+    """
+    Starts the span for an incoming request and makes it current. Honors a W3C traceparent:
+    a sampled parent is always recorded, otherwise TRACING_SAMPLE_RATE decides.
+    """
+    if not app_config.TRACING_ENABLED:
+        return NON_RECORDING_SPAN
+    trace_id = None
+    parent_span_id = None
+    sampled = None
+    match = _TRACEPARENT_RE.match(traceparent.strip().lower()) if traceparent else None
+    if match:
+        trace_id, parent_span_id, flags = match.groups()
+        sampled = bool(int(flags, 16) & 1)
+    if sampled is None:
+        sampled = random.random() < app_config.TRACING_SAMPLE_RATE
+    if not sampled:
+        _current_span.set(NON_RECORDING_SPAN)
+        return NON_RECORDING_SPAN
+    span = Span(name, trace_id or f"{random.getrandbits(128):032x}", parent_span_id, kind, attributes)
+    _current_span.set(span)
+    return span
+
+
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+    """
+    Starts a child of the current span without making it current; end it with span.end().
+    Suited to stages inlined in long functions and to spans that outlive the caller
+    (e.g. an upstream stream).
+    """
+    parent = _current_span.get()
+    if not parent.recording:
+        return NON_RECORDING_SPAN
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+@contextmanager
+def use_span(name: str, kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+    """Starts a child span, makes it current for the block, records errors and ends it."""
+    span = start_span(name, kind, attributes)
+    if not span.recording:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_exception(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _attribute_value(value)} for key, value in attributes.items()]
+
+
+def span_to_otlp(span: Span) -> Dict[str, Any]:
+    otlp_span = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": _otlp_attributes(span.attributes),
+        "events": [
+            {"name": event["name"], "timeUnixNano": str(event["time_ns"]), "attributes": _otlp_attributes(event["attributes"])}
+            for event in span.events
+        ],
+        "status": {"code": span.status_code, "message": span.status_message} if span.status_code else {},
+    }
+    if span.parent_span_id:
+        otlp_span["parentSpanId"] = span.parent_span_id
+    return otlp_span
+
+
+class _BatchSpanProcessor:
+    """
+    Hands finished spans to a daemon thread that appends them to TRACING_JSONL_PATH and/or
+    posts them to TRACING_OTLP_ENDPOINT (OTLP/HTTP JSON) every few seconds.
+    """
+
+    def __init__(self):
+        self._queue: "queue.SimpleQueue[Span]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def on_end(self, span: Span):
+        if self._queue.qsize() >= _MAX_QUEUED_SPANS:
+            self.dropped += 1
+            return
+        self._queue.put(span)
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="voutb-trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _drain(self) -> List[Span]:
+        spans = []
+        while True:
+            try:
+                spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                return spans
+
+    def _run(self):
+        while True:
+            time.sleep(_EXPORT_INTERVAL_SECONDS)
+            self.flush()
+
+    def flush(self):
+        spans = self._drain()
+        if not spans:
+            return
+        otlp_spans = [span_to_otlp(span) for span in spans]
+        jsonl_path = app_config.TRACING_JSONL_PATH
+        if jsonl_path:
+            try:
+                with open(jsonl_path, "a", encoding="utf-8") as f:
+                    for otlp_span in otlp_spans:
+                        f.write(json.dumps(otlp_span, ensure_ascii=False) + "\n")
+            except Exception as e:
+                logger.warning("Failed to write spans to %s: %s", jsonl_path, e)
+        otlp_endpoint = app_config.TRACING_OTLP_ENDPOINT
+        if otlp_endpoint:
+            self._export_otlp(otlp_endpoint, otlp_spans)
+
+    def _export_otlp(self, endpoint: str, otlp_spans: List[Dict[str, Any]]):
+        import httpx
+
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({
+                    "service.name": app_config.TRACING_SERVICE_NAME,
+                    "process.pid": os.getpid(),
+                })},
+                "scopeSpans": [{"scope": {"name": "voutb"}, "spans": otlp_spans}],
+            }]
+        }
+        try:
+            response = httpx.post(endpoint, json=payload, timeout=10.0)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning("Failed to export %s spans to %s: %s", len(otlp_spans), endpoint, e)
+
+
+_processor = _BatchSpanProcessor()
+
+
+def flush():
+    """Exports everything queued so far; call on shutdown."""
+    _processor.flush()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that opens the server span for every HTTP request (so auth and routing
+    are inside it) and ends it once the last body chunk has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not app_config.TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        path = scope.get("path", "")
+        span = start_root_span(f"{scope.get('method', 'GET')} {path}", traceparent, attributes={
+            "http.request.method": scope.get("method", ""),
+            "url.path": path,
+        })
+        if not span.recording:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_and_trace(message):
+            if message["type"] == "http.response.start":
+                status = message.get("status", 0)
+                span.set_attribute("http.response.status_code", status)
+                if status >= 500:
+                    span.status_code = STATUS_ERROR
+                message["headers"] = list(message.get("headers", ())) + [(b"traceparent", span.traceparent.encode("latin-1"))]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                span.end()
+
+        try:
+            await self.app(scope, receive, send_and_trace)
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            # Covers disconnects and errors before the final body chunk.
+            span.end()
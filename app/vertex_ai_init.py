@@ -1,11 +1,12 @@
 import json
-from typing import Optional
-from google import genai
+from typing import TYPE_CHECKING, Optional
 from credentials_manager import CredentialManager, parse_multiple_json_credentials
 from location_manager import LocationManager
 import config as app_config
-from google.genai import types
-from model_loader import refresh_models_config_cache # Import new model loader function
+from model_loader import get_models_config, schedule_models_config_refresh # Import new model loader function
+from app_logging import get_logger
+
+logger = get_logger("credentials")
 
 # VERTEX_EXPRESS_MODELS list is now dynamically loaded via model_loader
 # The constant VERTEX_EXPRESS_MODELS previously defined here is removed.
@@ -13,13 +14,24 @@ from model_loader import refresh_models_config_cache # Import new model loader f
 
 # Global 'client' and 'get_vertex_client()' are removed.
 
-def _get_http_options() -> Optional[types.HttpOptions]:
+if TYPE_CHECKING:
+    from google.genai import types
+
+
+def _get_http_options() -> Optional["types.HttpOptions"]:
     """Get http options from config."""
+    from google.genai import types
+    base_url = None
+    if app_config.UPSTREAM_BASE_URL != app_config.DEFAULTS["UPSTREAM_BASE_URL"]:
+        base_url = app_config.UPSTREAM_BASE_URL
     if app_config.PROXY_URL:
         return types.HttpOptions(
+            base_url=base_url,
             client_args={'proxy': app_config.PROXY_URL},
             async_client_args={'proxy': app_config.PROXY_URL},
         )
+    if base_url:
+        return types.HttpOptions(base_url=base_url)
     return None
 
 
@@ -37,20 +49,20 @@ async def init_vertex_ai(credential_manager_instance: CredentialManager, locatio
         env_creds_loaded_into_manager = False
 
         if credentials_json_str:
-            print("INFO: Found GULUGULU_CREDENTIALS_JSON environment variable. Attempting to load into CredentialManager.")
+            logger.info("Found GULUGULU_CREDENTIALS_JSON environment variable. Attempting to load into CredentialManager.")
             try:
                 # Attempt 1: Parse as multiple JSON objects
                 json_objects = parse_multiple_json_credentials(credentials_json_str)
                 if json_objects:
-                    print(f"DEBUG: Parsed {len(json_objects)} potential credential objects from GULUGULU_CREDENTIALS_JSON.")
+                    logger.debug("Parsed %s potential credential objects from GULUGULU_CREDENTIALS_JSON.", len(json_objects))
                     success_count = credential_manager_instance.load_credentials_from_json_list(json_objects)
                     if success_count > 0:
-                        print(f"INFO: Successfully loaded {success_count} credentials from GULUGULU_CREDENTIALS_JSON into manager.")
+                        logger.info("Successfully loaded %s credentials from GULUGULU_CREDENTIALS_JSON into manager.", success_count)
                         env_creds_loaded_into_manager = True
                 
                 # Attempt 2: If multiple parsing/loading didn't add any, try parsing/loading as a single JSON object
                 if not env_creds_loaded_into_manager:
-                    print("DEBUG: Multi-JSON loading from GULUGULU_CREDENTIALS_JSON did not add to manager or was empty. Attempting single JSON load.")
+                    logger.debug("Multi-JSON loading from GULUGULU_CREDENTIALS_JSON did not add to manager or was empty. Attempting single JSON load.")
                     try:
                         credentials_info = json.loads(credentials_json_str)
                         # Basic validation (CredentialManager's add_credential_from_json does more thorough validation)
@@ -58,68 +70,65 @@ async def init_vertex_ai(credential_manager_instance: CredentialManager, locatio
                         if isinstance(credentials_info, dict) and \
                            all(field in credentials_info for field in ["type", "project_id", "private_key_id", "private_key", "client_email"]):
                             if credential_manager_instance.add_credential_from_json(credentials_info):
-                                print("INFO: Successfully loaded single credential from GULUGULU_CREDENTIALS_JSON into manager.")
+                                logger.info("Successfully loaded single credential from GULUGULU_CREDENTIALS_JSON into manager.")
                                 # env_creds_loaded_into_manager = True # Redundant, as this block is conditional on it being False
                             else:
-                                print("WARNING: Single JSON from GULUGULU_CREDENTIALS_JSON failed to load into manager via add_credential_from_json.")
+                                logger.warning("Single JSON from GULUGULU_CREDENTIALS_JSON failed to load into manager via add_credential_from_json.")
                         else:
-                             print("WARNING: Single JSON from GULUGULU_CREDENTIALS_JSON is not a valid dict or missing required fields for basic check.")
+                             logger.warning("Single JSON from GULUGULU_CREDENTIALS_JSON is not a valid dict or missing required fields for basic check.")
                     except json.JSONDecodeError as single_json_err:
-                        print(f"WARNING: GULUGULU_CREDENTIALS_JSON could not be parsed as a single JSON object: {single_json_err}.")
+                        logger.warning("GULUGULU_CREDENTIALS_JSON could not be parsed as a single JSON object: %s.", single_json_err)
                     except Exception as single_load_err:
-                        print(f"WARNING: Error trying to load single JSON from GULUGULU_CREDENTIALS_JSON into manager: {single_load_err}.")
+                        logger.warning("Error trying to load single JSON from GULUGULU_CREDENTIALS_JSON into manager: %s.", single_load_err)
             except Exception as e_json_env:
                 # This catches errors from parse_multiple_json_credentials or load_credentials_from_json_list
-                print(f"WARNING: Error processing GULUGULU_CREDENTIALS_JSON env var: {e_json_env}.")
+                logger.warning("Error processing GULUGULU_CREDENTIALS_JSON env var: %s.", e_json_env)
         else:
-            print("INFO: GULUGULU_CREDENTIALS_JSON environment variable not found.")
+            logger.info("GULUGULU_CREDENTIALS_JSON environment variable not found.")
 
-        # Attempt to pre-warm the model configuration cache
-        print("INFO: Attempting to pre-warm model configuration cache during startup...")
-        models_loaded_successfully = await refresh_models_config_cache()
-        if models_loaded_successfully:
-            print("INFO: Model configuration cache pre-warmed successfully.")
-        else:
-            print("WARNING: Failed to pre-warm model configuration cache during startup. It will be loaded lazily on first request.")
-            # We don't necessarily fail the entire init_vertex_ai if model list fetching fails,
-            # as credential validation might still be important, and model list can be fetched later.
+        # Serve the bundled model configuration immediately and refresh it from
+        # MODELS_CONFIG_URL in the background, so startup never waits on the network.
+        logger.info("Loading model configuration and scheduling a background refresh...")
+        await get_models_config()
+        schedule_models_config_refresh(force=True)
 
         # CredentialManager's __init__ calls load_credentials_list() for files.
         # refresh_credentials_list() re-scans files and combines with in-memory (already includes env creds if loaded above).
         # The return value of refresh_credentials_list indicates if total > 0
         if credential_manager_instance.refresh_credentials_list():
             total_creds = credential_manager_instance.get_total_credentials()
-            print(f"INFO: Credential Manager reports {total_creds} credential(s) available (from files and/or GULUGULU_CREDENTIALS_JSON).")
+            logger.info("Credential Manager reports %s credential(s) available (from files and/or GULUGULU_CREDENTIALS_JSON).", total_creds)
             
             # Optional: Attempt to validate one of the credentials by creating a temporary client.
             # This adds a check that at least one credential is functional.
-            print("INFO: Attempting to validate a credential by creating a temporary client...")
+            logger.info("Attempting to validate a credential by creating a temporary client...")
             temp_creds_val, temp_project_id_val = credential_manager_instance.get_credentials()
             if temp_creds_val and temp_project_id_val:
                 try:
+                    from google import genai
                     http_options = _get_http_options()
                     current_loc = location_manager_instance.get_current_location() if location_manager_instance else "global"
                     if http_options:
                         _ = genai.Client(vertexai=True, credentials=temp_creds_val, project=temp_project_id_val, location=current_loc, http_options=http_options)
                     else:
                         _ = genai.Client(vertexai=True, credentials=temp_creds_val, project=temp_project_id_val, location=current_loc)
-                    print(f"INFO: Successfully validated a credential from Credential Manager (Project: {temp_project_id_val}, Location: {current_loc}). Initialization check passed.")
+                    logger.info("Successfully validated a credential from Credential Manager (Project: %s, Location: %s). Initialization check passed.", temp_project_id_val, current_loc)
                     return True
                 except Exception as e_val:
-                    print(f"WARNING: Failed to validate a random credential from manager by creating a temp client: {e_val}. App may rely on non-validated credentials.")
+                    logger.warning("Failed to validate a random credential from manager by creating a temp client: %s. App may rely on non-validated credentials.", e_val)
                     # Still return True if credentials exist, as the app might still function with other valid credentials.
                     # The per-request client creation will be the ultimate test for a specific credential.
                     return True # Credentials exist, even if one failed validation here.
             elif total_creds > 0 : # Credentials listed but get_random_credentials returned None
-                 print(f"WARNING: {total_creds} credentials reported by manager, but could not retrieve one for validation. Problems might occur.")
+                 logger.warning("%s credentials reported by manager, but could not retrieve one for validation. Problems might occur.", total_creds)
                  return True # Still, credentials are listed.
             else: # No creds from get_random_credentials and total_creds is 0
-                 print("ERROR: No credentials available after attempting to load from all sources.")
+                 logger.error("No credentials available after attempting to load from all sources.")
                  return False # No credentials reported by manager and get_random_credentials gave none.
         else:
-            print("ERROR: Credential Manager reports no available credentials after processing all sources.")
+            logger.error("Credential Manager reports no available credentials after processing all sources.")
             return False
 
     except Exception as e:
-        print(f"CRITICAL ERROR during voutb AI credential setup: {e}")
+        logger.critical("Error during voutb AI credential setup: %s", e)
         return False
\ No newline at end of file
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+End-to-end check of the Batch API against the mock upstream. Uploads a JSONL file of chat
+completion requests, creates a batch, polls it to a terminal status and verifies that
+every custom_id appears exactly once across the output and error files. Reports wall
+time, request throughput and the upstream calls made (including injected 429 retries).
+
+  python bench/batch_e2e.py --requests 500 --rate-429 0.1
+  python bench/batch_e2e.py --requests 300 --restart-after 2   # kill -9 the proxy mid-batch
+
+--restart-after kills the proxy without a clean shutdown and starts a new one, which has
+to reclaim the batch's lease and finish the remaining requests without redoing any.
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from loadgen import API_KEY, LocalStack
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def build_input(args: argparse.Namespace) -> bytes:
+    lines = []
+    for i in range(args.requests):
+        lines.append(json.dumps({
+            "custom_id": f"request-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": args.model, "messages": [{"role": "user", "content": f"Batch request {i}."}]},
+        }))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def _file_lines(client: httpx.AsyncClient, file_id: Optional[str]) -> List[Dict[str, Any]]:
+    if not file_id:
+        return []
+    response = await client.get(f"/v1/files/{file_id}/content")
+    response.raise_for_status()
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    stack = LocalStack(args)
+    extra = json.loads(args.extra_config) if args.extra_config else {}
+    extra.setdefault("BATCH_ENABLED", True)
+    extra.setdefault("BATCH_DIR", str(Path(stack.workdir.name) / "batches"))
+    args.extra_config = json.dumps(extra)
+    await stack.start()
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    restarted = False
+    try:
+        async with httpx.AsyncClient(base_url=stack.proxy_url, headers=headers, timeout=60) as client:
+            upload = await client.post("/v1/files", data={"purpose": "batch"},
+                                       files={"file": ("input.jsonl", build_input(args), "application/jsonl")})
+            upload.raise_for_status()
+            started = time.perf_counter()
+            batch = (await client.post("/v1/batches", json={
+                "input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h",
+            })).json()
+            while batch["status"] not in TERMINAL_STATUSES:
+                await asyncio.sleep(args.poll_interval)
+                elapsed = time.perf_counter() - started
+                if args.restart_after and not restarted and elapsed >= args.restart_after:
+                    print(f"{elapsed:6.1f}s  restarting the proxy", flush=True)
+                    await stack.restart_proxy()
+                    restarted = True
+                batch = (await client.get(f"/v1/batches/{batch['id']}")).json()
+                counts = batch["request_counts"]
+                print(f"{elapsed:6.1f}s  {batch['status']:<12} {counts['completed']}/{counts['total']} completed, "
+                      f"{counts['failed']} failed", flush=True)
+            wall = time.perf_counter() - started
+
+            outputs = await _file_lines(client, batch.get("output_file_id"))
+            errors = await _file_lines(client, batch.get("error_file_id"))
+            upstream_calls = (await client.get(f"{stack.mock_url}/stats")).json()["calls"]
+    finally:
+        stack.stop()
+
+    seen: Dict[str, int] = {}
+    for line in outputs + errors:
+        seen[line["custom_id"]] = seen.get(line["custom_id"], 0) + 1
+    expected = {f"request-{i}" for i in range(args.requests)}
+    report = {
+        "status": batch["status"],
+        "request_counts": batch["request_counts"],
+        "wall_seconds": round(wall, 2),
+        "requests_per_second": round(args.requests / wall, 1) if wall else None,
+        "output_lines": len(outputs),
+        "error_lines": len(errors),
+        "missing": sorted(expected - seen.keys()),
+        "duplicates": sorted(custom_id for custom_id, count in seen.items() if count > 1),
+        "restarted": restarted,
+        "upstream_calls": upstream_calls,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run a batch end to end against the mock upstream.")
+    parser.add_argument("--requests", type=int, default=200, help="Lines in the batch input file.")
+    parser.add_argument("--model", default="[EXPRESS] gemini-2.5-flash")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--restart-after", type=float, default=0.0,
+                        help="Kill and restart the proxy this many seconds into the batch (0 disables).")
+    parser.add_argument("--json", help="Write the report to this file.")
+    # Local stack
+    parser.add_argument("--express-keys", type=int, default=4, help="Number of mock Express keys to configure.")
+    parser.add_argument("--extra-config", help="JSON object merged into the proxy config, e.g. '{\"BATCH_CONCURRENCY_PER_KEY\": 8}'.")
+    parser.add_argument("--verbose", action="store_true", help="Show the proxy's output.")
+    # Mock upstream behavior
+    parser.add_argument("--ttft-ms", type=float, default=100.0)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--output-tokens", type=int, default=32)
+    parser.add_argument("--image-bytes", type=int, default=0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+    if report["status"] != "completed" or report["missing"] or report["duplicates"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Load generator for the proxy. Runs each scenario at a target request rate and concurrency
+and reports throughput, p50/p95/p99 time-to-first-token and total latency, and the
+proxy's CPU and RSS.
+
+By default it starts bench/mock_upstream.py and the app itself (with a throwaway config
+file pointing at the mock), so no real quota is used:
+
+  python bench/loadgen.py --rps 20 --concurrency 50 --duration 30
+  python bench/loadgen.py --scenarios text,stream --ttft-ms 100 --json results.json
+
+To drive an already running proxy instead, pass --proxy-url (and --proxy-pid to sample
+its CPU/RSS). Scenarios that need FAKE_STREAMING then follow that proxy's own config.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+APP_DIR = REPO_DIR / "app"
+API_KEY = "bench-key"
+_KEEPALIVE_MARKERS = ('"chatcmpl-keepalive"', '"delta": {"reasoning_content": " "}')
+
+_WEATHER_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "get_weather",
+        "description": "Returns the weather for a city.",
+        "parameters": {"type": "object", "properties": {"city": {"type": "string"}}, "required": ["city"]},
+    },
+}
+
+
+def _image_data_url(size: int) -> str:
+    return "data:image/png;base64," + base64.b64encode(random.randbytes(size)).decode("ascii")
+
+
+def build_scenarios(args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    """Name -> request body and the FAKE_STREAMING setting it needs."""
+    text_messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Write a short story about a lighthouse keeper. " * 4},
+    ]
+    image_messages = [{"role": "user", "content": [
+        {"type": "text", "text": "Describe this image."},
+        {"type": "image_url", "image_url": {"url": _image_data_url(args.input_image_bytes)}},
+    ]}]
+    model = args.model
+    return {
+        "text": {"body": {"model": model, "messages": text_messages, "stream": False}},
+        "stream": {"body": {"model": model, "messages": text_messages, "stream": True}},
+        "fake-stream": {"body": {"model": model, "messages": text_messages, "stream": True}, "fake_streaming": True},
+        "images": {"body": {"model": model, "messages": image_messages, "stream": True}},
+        "image-output": {"body": {"model": args.image_model, "messages": text_messages, "stream": False}},
+        "tools": {"body": {"model": model, "messages": [{"role": "user", "content": "Weather in Paris?"}],
+                           "tools": [_WEATHER_TOOL], "stream": False}},
+        "openai": {"body": {"model": args.openai_model, "messages": text_messages, "stream": True}},
+    }
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process from /proc (Linux)."""
+
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.peak_rss = 0
+        self._task: Optional[asyncio.Task] = None
+        self._cpu_start = 0.0
+        self._wall_start = 0.0
+
+    def _cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _rss_bytes(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            return None
+        return None
+
+    async def _sample(self):
+        while True:
+            rss = self._rss_bytes()
+            if rss:
+                self.peak_rss = max(self.peak_rss, rss)
+            await asyncio.sleep(0.25)
+
+    def start(self):
+        if self.pid is None:
+            return
+        self.peak_rss = 0
+        self._cpu_start = self._cpu_seconds() or 0.0
+        self._wall_start = time.perf_counter()
+        self._task = asyncio.create_task(self._sample())
+
+    def stop(self) -> Dict[str, Optional[float]]:
+        if self.pid is None or self._task is None:
+            return {"cpu_percent": None, "peak_rss_mb": None, "end_rss_mb": None}
+        self._task.cancel()
+        cpu_end = self._cpu_seconds()
+        wall = time.perf_counter() - self._wall_start
+        end_rss = self._rss_bytes()
+        return {
+            "cpu_percent": round((cpu_end - self._cpu_start) / wall * 100, 1) if cpu_end is not None and wall > 0 else None,
+            "peak_rss_mb": round(self.peak_rss / 1048576, 1) if self.peak_rss else None,
+            "end_rss_mb": round(end_rss / 1048576, 1) if end_rss else None,
+        }
+
+
+async def _one_request(client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    first_token_at = None
+    received = 0
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+            async for line in response.aiter_lines():
+                received += len(line)
+                if first_token_at is None and line.startswith("data:") and not any(m in line for m in _KEEPALIVE_MARKERS):
+                    first_token_at = time.perf_counter()
+            status = response.status_code
+    except httpx.HTTPError as e:
+        return {"status": type(e).__name__, "latency": time.perf_counter() - started, "ttft": None, "bytes": received}
+    finished = time.perf_counter()
+    if not body.get("stream"):
+        first_token_at = finished
+    return {
+        "status": status,
+        "latency": finished - started,
+        "ttft": (first_token_at - started) if first_token_at else None,
+        "bytes": received,
+    }
+
+
+async def run_scenario(client: httpx.AsyncClient, body: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    """Open-loop arrivals at args.rps, with at most args.concurrency requests in flight."""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    total = args.requests or max(1, int(args.rps * args.duration))
+    results: List[Dict[str, Any]] = []
+
+    async def _scheduled(index: int, start: float):
+        delay = start + index / args.rps - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with semaphore:
+            results.append(await _one_request(client, body))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_scheduled(i, started) for i in range(total)))
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+
+    def _ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "statuses": statuses,
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else 0.0,
+        "ttft_ms": {f"p{p}": _ms(percentile(ttfts, p)) for p in (50, 95, 99)},
+        "latency_ms": {f"p{p}": _ms(percentile(latencies, p)) for p in (50, 95, 99)},
+        "mean_response_kb": round(sum(r["bytes"] for r in ok) / len(ok) / 1024, 1) if ok else 0.0,
+    }
+
+
+def _free_port() -> int:
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode} during startup")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+class LocalStack:
+    """The mock upstream plus the proxy, configured through a temporary config file."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.workdir = tempfile.TemporaryDirectory(prefix="voutb-bench-")
+        self.config_path = Path(self.workdir.name) / "config.json"
+        self.mock_port = _free_port()
+        self.proxy_port = _free_port()
+        self.mock_url = f"http://127.0.0.1:{self.mock_port}"
+        self.proxy_url = f"http://127.0.0.1:{self.proxy_port}"
+        self.processes: List[subprocess.Popen] = []
+        self._config_version = 0
+
+    def write_config(self, fake_streaming: bool):
+        config = {
+            "API_KEY": API_KEY,
+            "VERTEX_EXPRESS_API_KEY": ",".join(f"mock-express-key-{i}" for i in range(self.args.express_keys)),
+            "CREDENTIALS_DIR": str(Path(self.workdir.name) / "credentials"),
+            "UPSTREAM_BASE_URL": self.mock_url,
+            "FAKE_STREAMING": fake_streaming,
+            "FAKE_STREAMING_INTERVAL": 1.0,
+            "LOG_LEVEL": "WARNING",
+        }
+        config.update(json.loads(self.args.extra_config) if self.args.extra_config else {})
+        self.config_path.write_text(json.dumps(config), encoding="utf-8")
+        # The app reloads on a newer mtime; force one even within the same second.
+        self._config_version += 1
+        stamp = time.time() + self._config_version
+        os.utime(self.config_path, (stamp, stamp))
+
+    async def start(self):
+        a = self.args
+        self.write_config(fake_streaming=False)
+        mock_cmd = [sys.executable, str(Path(__file__).parent / "mock_upstream.py"), "--port", str(self.mock_port),
+                    "--ttft-ms", str(a.ttft_ms), "--tokens-per-second", str(a.tokens_per_second),
+                    "--output-tokens", str(a.output_tokens), "--image-bytes", str(a.image_bytes),
+                    "--rate-429", str(a.rate_429)]
+        self.processes.append(subprocess.Popen(mock_cmd))
+        await _wait_until_up(f"{self.mock_url}/stats", self.processes[-1])
+
+        await self.start_proxy()
+
+    async def start_proxy(self):
+        env = dict(os.environ, VOUTB_CONFIG_FILE=str(self.config_path))
+        proxy_cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(APP_DIR),
+                     "--host", "127.0.0.1", "--port", str(self.proxy_port), "--log-level", "warning"]
+        stdout = None if self.args.verbose else subprocess.DEVNULL
+        self.processes.append(subprocess.Popen(proxy_cmd, env=env, stdout=stdout, stderr=stdout))
+        await _wait_until_up(f"{self.proxy_url}/", self.processes[-1])
+
+    async def restart_proxy(self):
+        """Kills the proxy without a clean shutdown and starts a new one on the same port."""
+        proxy = self.processes.pop()
+        proxy.kill()
+        proxy.wait()
+        await self.start_proxy()
+
+    @property
+    def proxy_pid(self) -> int:
+        return self.processes[-1].pid
+
+    def stop(self):
+        for process in reversed(self.processes):
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.workdir.cleanup()
+
+
+def _format_row(name: str, result: Dict[str, Any]) -> str:
+    def _v(value):
+        return "-" if value is None else f"{value:g}"
+
+    ttft, latency = result["ttft_ms"], result["latency_ms"]
+    return (f"{name:<13} {result['ok']:>4}/{result['requests']:<4} {result['throughput_rps']:>7.2f} "
+            f"{_v(ttft['p50']):>8} {_v(ttft['p95']):>8} {_v(ttft['p99']):>8} "
+            f"{_v(latency['p50']):>8} {_v(latency['p95']):>8} {_v(latency['p99']):>8} "
+            f"{_v(result.get('cpu_percent')):>6} {_v(result.get('peak_rss_mb')):>8}")
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    scenarios = build_scenarios(args)
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}. Available: {', '.join(scenarios)}")
+
+    stack = None
+    proxy_url, proxy_pid, mock_url = args.proxy_url, args.proxy_pid, None
+    if not proxy_url:
+        stack = LocalStack(args)
+        await stack.start()
+        proxy_url, proxy_pid, mock_url = stack.proxy_url, stack.proxy_pid, stack.mock_url
+
+    sampler = ProcessSampler(proxy_pid)
+    report: Dict[str, Any] = {"settings": {k: v for k, v in vars(args).items() if k != "extra_config"}, "scenarios": {}}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    headers = {"Authorization": f"Bearer {args.api_key or API_KEY}"}
+    print(f"{'scenario':<13} {'ok/total':>9} {'rps':>7} {'ttft50':>8} {'ttft95':>8} {'ttft99':>8} "
+          f"{'lat50':>8} {'lat95':>8} {'lat99':>8} {'cpu%':>6} {'rss_mb':>8}")
+    try:
+        async with httpx.AsyncClient(base_url=proxy_url, headers=headers, limits=limits, timeout=args.timeout) as client:
+            for name in selected:
+                scenario = scenarios[name]
+                if stack:
+                    stack.write_config(fake_streaming=scenario.get("fake_streaming", False))
+                for _ in range(args.warmup):
+                    await _one_request(client, scenario["body"])
+                upstream_before = (await client.get(f"{mock_url}/stats")).json()["calls"] if mock_url else {}
+                sampler.start()
+                result = await run_scenario(client, scenario["body"], args)
+                result.update(sampler.stop())
+                if mock_url:
+                    upstream_after = (await client.get(f"{mock_url}/stats")).json()["calls"]
+                    result["upstream_calls"] = {k: v - upstream_before.get(k, 0) for k, v in upstream_after.items()
+                                                if v - upstream_before.get(k, 0)}
+                report["scenarios"][name] = result
+                print(_format_row(name, result), flush=True)
+    finally:
+        if stack:
+            stack.stop()
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the proxy against the mock upstream.")
+    parser.add_argument("--scenarios", default="text,stream,fake-stream,images,image-output,tools,openai",
+                        help="Comma-separated scenarios to run, in order.")
+    parser.add_argument("--rps", type=float, default=10.0, help="Target arrival rate per scenario.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Maximum requests in flight.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of arrivals per scenario.")
+    parser.add_argument("--requests", type=int, default=0, help="Fixed request count per scenario (overrides --duration).")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests before each scenario.")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--model", default="[EXPRESS] gemini-2.5-flash")
+    parser.add_argument("--image-model", default="[EXPRESS] gemini-2.5-flash-image")
+    parser.add_argument("--openai-model", default="[EXPRESS] gemini-2.5-flash-openai")
+    parser.add_argument("--input-image-bytes", type=int, default=256 * 1024, help="Size of the image sent by the images scenario.")
+    parser.add_argument("--json", help="Write the full report to this file.")
+    # Driving an existing proxy
+    parser.add_argument("--proxy-url", help="Benchmark this running proxy instead of starting one.")
+    parser.add_argument("--proxy-pid", type=int, help="PID of --proxy-url, for CPU/RSS sampling.")
+    parser.add_argument("--api-key", help="API key of --proxy-url.")
+    # Local stack
+    parser.add_argument("--express-keys", type=int, default=4, help="Number of mock Express keys to configure.")
+    parser.add_argument("--extra-config", help="JSON object merged into the proxy config, e.g. '{\"COALESCE_ENABLED\": true}'.")
+    parser.add_argument("--verbose", action="store_true", help="Show the proxy's output.")
+    # Mock upstream behavior
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--output-tokens", type=int, default=256)
+    parser.add_argument("--image-bytes", type=int, default=512 * 1024, help="Size of images returned by the mock.")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the upstream APIs the proxy calls, so throughput and latency can be
+measured without spending quota.
+
+Serves:
+  - {model}:generateContent / {model}:streamGenerateContent (Express, Express with project, SA)
+  - {model}:predict for embedding models (deterministic vectors derived from each input)
+  - .../endpoints/openapi/chat/completions (OpenAI Direct, streaming and not)
+  - the project-ID probe used by project_id_discovery.py
+  - cachedContents create/update/delete (context cache)
+  - POST /token, an OAuth token endpoint for throwaway service-account files
+  - GET /stats, call counters
+
+Usage:
+  python bench/mock_upstream.py --port 9100 --ttft-ms 300 --tokens-per-second 80
+
+Point the proxy at it with "UPSTREAM_BASE_URL": "http://127.0.0.1:9100" in config.json.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Model that project_id_discovery.discover_project_id() uses to provoke an error.
+PROBE_MODEL = "gemini-2.7-pro-preview-05-06"
+MOCK_PROJECT_NUMBER = "123456789012"
+
+_MODEL_CALL_RE = re.compile(r"models/([^/:]+):(generateContent|streamGenerateContent|predict)$")
+_LOCATION_RE = re.compile(r"locations/([^/]+)")
+_WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+          "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore")
+# Smallest valid PNG header, padded with random bytes up to the requested size.
+_PNG_HEADER = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489")
+
+
+class MockSettings:
+    def __init__(self, args: argparse.Namespace):
+        self.ttft_seconds = args.ttft_ms / 1000.0
+        self.tokens_per_second = max(0.0, args.tokens_per_second)
+        self.output_tokens = args.output_tokens
+        self.thinking_tokens = args.thinking_tokens
+        self.chunk_tokens = max(1, args.chunk_tokens)
+        self.image_bytes = args.image_bytes
+        self.rate_429 = args.rate_429
+        self.jitter = args.jitter
+
+
+class MockStats:
+    def __init__(self):
+        self.started_at = time.time()
+        self.calls: Dict[str, int] = {}
+        self.injected_429 = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def count(self, kind: str):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "calls": dict(self.calls),
+            "injected_429": self.injected_429,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+        }
+
+
+def _text(tokens: int, offset: int = 0) -> str:
+    return "".join(_WORDS[(offset + i) % len(_WORDS)] + " " for i in range(tokens))
+
+
+def _image_b64(size: int) -> str:
+    payload = _PNG_HEADER + random.randbytes(max(0, size - len(_PNG_HEADER)))
+    return base64.b64encode(payload).decode("ascii")
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI(title="voutb mock upstream")
+    stats = MockStats()
+    # Encoding a multi-megabyte image per response would measure the mock, not the proxy.
+    image_b64 = _image_b64(settings.image_bytes) if settings.image_bytes > 0 else ""
+
+    def _delay(seconds: float) -> float:
+        if settings.jitter:
+            seconds *= random.uniform(1.0 - settings.jitter, 1.0 + settings.jitter)
+        return max(0.0, seconds)
+
+    def _chunk_delay() -> float:
+        if settings.tokens_per_second <= 0:
+            return 0.0
+        return _delay(settings.chunk_tokens / settings.tokens_per_second)
+
+    def _error(code: int, status: str, message: str) -> JSONResponse:
+        return JSONResponse(status_code=code, content={"error": {"code": code, "message": message, "status": status}})
+
+    def _maybe_429() -> Optional[JSONResponse]:
+        if settings.rate_429 and random.random() < settings.rate_429:
+            stats.injected_429 += 1
+            return _error(429, "RESOURCE_EXHAUSTED", "Resource exhausted. Please try again later.")
+        return None
+
+    # --- Embeddings (predict) ---
+
+    def _embedding(text: str, dimensions: int) -> List[float]:
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        return [(seed[i % len(seed)] - 128) / 128.0 for i in range(dimensions)]
+
+    async def _predict(body: Dict[str, Any]) -> Dict[str, Any]:
+        instances = body.get("instances") or []
+        stats.calls["predict_instances"] = stats.calls.get("predict_instances", 0) + len(instances)
+        dimensions = (body.get("parameters") or {}).get("outputDimensionality") or 768
+        await asyncio.sleep(_delay(settings.ttft_seconds))
+        return {"predictions": [
+            {"embeddings": {"values": _embedding(instance.get("content", ""), dimensions),
+                            "statistics": {"token_count": max(1, len(instance.get("content", "")) // 4), "truncated": False}}}
+            for instance in instances
+        ]}
+
+    # --- Gemini generateContent ---
+
+    def _gemini_plan(body: Dict[str, Any], model: str) -> List[Dict[str, Any]]:
+        """The parts of one response, in the order they would be streamed."""
+        generation_config = body.get("generationConfig") or {}
+        thinking_config = generation_config.get("thinkingConfig") or {}
+        parts: List[Dict[str, Any]] = []
+        if thinking_config.get("includeThoughts") and settings.thinking_tokens:
+            for offset in range(0, settings.thinking_tokens, settings.chunk_tokens):
+                parts.append({"text": _text(min(settings.chunk_tokens, settings.thinking_tokens - offset), offset), "thought": True})
+
+        declarations = [d for tool in body.get("tools") or [] for d in tool.get("functionDeclarations") or []]
+        if declarations:
+            parts.append({"functionCall": {"name": declarations[0].get("name", "tool"), "args": {"query": "mock"}}})
+            return parts
+
+        for offset in range(0, settings.output_tokens, settings.chunk_tokens):
+            parts.append({"text": _text(min(settings.chunk_tokens, settings.output_tokens - offset), offset)})
+        modalities = [m.upper() for m in generation_config.get("responseModalities") or []]
+        if image_b64 and ("IMAGE" in modalities or "image" in model):
+            parts.append({"inlineData": {"mimeType": "image/png", "data": image_b64}})
+        return parts
+
+    def _usage(body: Dict[str, Any]) -> Dict[str, int]:
+        prompt_tokens = max(1, len(json.dumps(body.get("contents") or [])) // 4)
+        return {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": settings.output_tokens,
+            "thoughtsTokenCount": settings.thinking_tokens,
+            "totalTokenCount": prompt_tokens + settings.output_tokens + settings.thinking_tokens,
+        }
+
+    def _candidate_count(body: Dict[str, Any]) -> int:
+        return max(1, int((body.get("generationConfig") or {}).get("candidateCount") or 1))
+
+    def _gemini_response(parts: List[Dict[str, Any]], model: str, usage: Optional[Dict[str, int]], finished: bool,
+                         candidate_count: int = 1) -> Dict[str, Any]:
+        candidates = []
+        for index in range(candidate_count):
+            candidate: Dict[str, Any] = {"content": {"role": "model", "parts": parts}, "index": index}
+            if finished:
+                candidate["finishReason"] = "STOP"
+            candidates.append(candidate)
+        response: Dict[str, Any] = {"candidates": candidates, "modelVersion": model}
+        if usage:
+            response["usageMetadata"] = usage
+        return response
+
+    async def _generate_content(body: Dict[str, Any], model: str) -> JSONResponse:
+        parts = _gemini_plan(body, model)
+        await asyncio.sleep(_delay(settings.ttft_seconds) + _chunk_delay() * max(0, len(parts) - 1))
+        return JSONResponse(_gemini_response(parts, model, _usage(body), True, _candidate_count(body)))
+
+    def _stream_generate_content(body: Dict[str, Any], model: str) -> StreamingResponse:
+        parts = _gemini_plan(body, model)
+        usage = _usage(body)
+
+        async def _events():
+            await asyncio.sleep(_delay(settings.ttft_seconds))
+            for i, part in enumerate(parts):
+                if i:
+                    await asyncio.sleep(_chunk_delay())
+                last = i == len(parts) - 1
+                chunk = _gemini_response([part], model, usage if last else None, last, _candidate_count(body))
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+
+        return StreamingResponse(_tracked(_events()), media_type="text/event-stream")
+
+    # --- OpenAI-compatible endpoint ---
+
+    def _openai_plan(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        tools = body.get("tools") or []
+        if tools:
+            name = (tools[0].get("function") or {}).get("name", "tool")
+            return [{"tool_calls": [{"index": 0, "id": "call_mock", "type": "function",
+                                     "function": {"name": name, "arguments": "{\"query\": \"mock\"}"}}]}]
+        return [{"content": _text(min(settings.chunk_tokens, settings.output_tokens - offset), offset)}
+                for offset in range(0, settings.output_tokens, settings.chunk_tokens)]
+
+    def _openai_usage(body: Dict[str, Any]) -> Dict[str, int]:
+        prompt_tokens = max(1, len(json.dumps(body.get("messages") or [])) // 4)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": settings.output_tokens,
+                "total_tokens": prompt_tokens + settings.output_tokens}
+
+    async def _chat_completions(body: Dict[str, Any]):
+        model = body.get("model", "mock")
+        deltas = _openai_plan(body)
+        created = int(time.time())
+        finish_reason = "tool_calls" if body.get("tools") else "stop"
+
+        if not body.get("stream"):
+            await asyncio.sleep(_delay(settings.ttft_seconds) + _chunk_delay() * max(0, len(deltas) - 1))
+            message: Dict[str, Any] = {"role": "assistant", "content": "".join(d.get("content", "") for d in deltas) or None}
+            if deltas and "tool_calls" in deltas[0]:
+                message["tool_calls"] = [{k: v for k, v in call.items() if k != "index"} for call in deltas[0]["tool_calls"]]
+            return JSONResponse({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": _openai_usage(body),
+            })
+
+        async def _events():
+            await asyncio.sleep(_delay(settings.ttft_seconds))
+            for i, delta in enumerate(deltas):
+                if i:
+                    await asyncio.sleep(_chunk_delay())
+                last = i == len(deltas) - 1
+                chunk: Dict[str, Any] = {
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason if last else None}],
+                }
+                if last:
+                    chunk["usage"] = _openai_usage(body)
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_tracked(_events()), media_type="text/event-stream")
+
+    async def _tracked(events):
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            stats.in_flight -= 1
+
+    # --- Routes ---
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats.as_dict()
+
+    @app.post("/token")
+    async def token():
+        stats.count("token")
+        return {"access_token": "mock-access-token", "expires_in": 3600, "token_type": "Bearer"}
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def upstream(path: str, request: Request):
+        if path.endswith("endpoints/openapi/chat/completions"):
+            stats.count("openai_chat_completions")
+            rejected = _maybe_429()
+            if rejected:
+                return rejected
+            return await _chat_completions(await request.json())
+
+        if "cachedContents" in path:
+            stats.count(f"cached_contents_{request.method.lower()}")
+            if request.method == "DELETE":
+                return {}
+            location = _LOCATION_RE.search(path)
+            name = path if request.method == "PATCH" else (
+                f"projects/{MOCK_PROJECT_NUMBER}/locations/{location.group(1) if location else 'global'}"
+                f"/cachedContents/{random.getrandbits(48)}")
+            expire_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+            return {"name": name[name.find("projects/"):], "expireTime": expire_time}
+
+        match = _MODEL_CALL_RE.search(path)
+        if not match or request.method != "POST":
+            return _error(404, "NOT_FOUND", f"Mock upstream does not serve {request.method} /{path}.")
+        model, method = match.groups()
+
+        if model == PROBE_MODEL:
+            stats.count("project_id_probe")
+            location = _LOCATION_RE.search(path)
+            return _error(404, "NOT_FOUND", (
+                f"Publisher Model `projects/{MOCK_PROJECT_NUMBER}/locations/{location.group(1) if location else 'us-central1'}"
+                f"/publishers/google/models/{model}` was not found or your project does not have access to it."))
+
+        stats.count(method)
+        rejected = _maybe_429()
+        if rejected:
+            return rejected
+        body = await request.json()
+        if method == "predict":
+            return await _predict(body)
+        if method == "generateContent":
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+            try:
+                return await _generate_content(body, model)
+            finally:
+                stats.in_flight -= 1
+        return _stream_generate_content(body, model)
+
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Mock Vertex AI / Express upstream for benchmarking.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="Delay before the first chunk.")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="Generation speed after the first chunk (0 = instant).")
+    parser.add_argument("--output-tokens", type=int, default=256, help="Completion tokens per response.")
+    parser.add_argument("--thinking-tokens", type=int, default=0, help="Thought tokens emitted when the request asks for thoughts.")
+    parser.add_argument("--chunk-tokens", type=int, default=8, help="Tokens per streamed chunk.")
+    parser.add_argument("--image-bytes", type=int, default=0, help="Size of the image returned to image models (0 = none).")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of generation calls answered with 429.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Relative +/- jitter applied to every delay (e.g. 0.2).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    uvicorn.run(create_app(MockSettings(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,16 @@
 """
 启动脚本 - OpenAI to Gemini Adapter
 使用方法: python start.py
+          python start.py --profile-startup   # 打印启动耗时分析
 """
+import json
 import os
+import socket
+import subprocess
 import sys
+import time
+import urllib.error
+import urllib.request
 import uvicorn
 from pathlib import Path
 
@@ -125,8 +132,89 @@ def check_environment():
     print("=" * 60)
     return True
 
+def _startup_timing(line: str):
+    """取出服务日志中 profile 组件记录的启动耗时（支持文本和 JSON 日志格式），其他行返回 None"""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        # 文本格式: "HH:MM:SS INFO: [profile] [request_id] message"
+        marker = " [profile] ["
+        if marker not in line:
+            return None
+        return line.split(marker, 1)[1].split("] ", 1)[-1]
+    if isinstance(record, dict) and record.get("component") == "profile":
+        return record.get("message")
+    return None
+
+def profile_startup(top: int = 15):
+    """打印导入耗时与初始化耗时，并测量从启动到首个请求被处理的时间"""
+    print("=" * 60)
+    print("启动耗时分析 (-X importtime)")
+    print("=" * 60)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=str(app_dir), capture_output=True, text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line.split(":", 1)[1].split("|")
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    # importtime indents nested imports by two spaces per level; list main's direct imports
+    direct_imports = [row for row in rows if len(row[2]) - len(row[2].lstrip()) == 3]
+    for cumulative_us, self_us, module in sorted(direct_imports, reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:9.1f} ms (self {self_us / 1000:7.1f} ms)  {module.strip()}")
+    main_row = next((row for row in rows if row[2].strip() == "main"), None)
+    if main_row:
+        print(f"\n  import main 合计: {main_row[0] / 1000:.1f} ms")
+
+    print("\n" + "=" * 60)
+    print("初始化耗时 / 首个请求")
+    print("=" * 60)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, VOUTB_PROFILE_STARTUP="1")
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(app_dir),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    try:
+        first_response = None
+        while time.perf_counter() - started < 60 and server.poll() is None:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/admin", timeout=1).read()
+                first_response = time.perf_counter() - started
+                break
+            except urllib.error.HTTPError:
+                first_response = time.perf_counter() - started
+                break
+            except OSError:
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        output, _ = server.communicate(timeout=10)
+    for line in output.splitlines():
+        timing = _startup_timing(line)
+        if timing:
+            print(f"  {timing}")
+    if first_response is None:
+        print("\n[ERROR] 服务器未能在 60 秒内响应请求")
+        print(output[-2000:])
+        sys.exit(1)
+    print(f"\n  进程启动到首个请求完成: {first_response * 1000:.1f} ms")
+    print("=" * 60)
+
+
 def main():
     """主函数"""
+    if "--profile-startup" in sys.argv[1:]:
+        profile_startup()
+        return
+
     print("\n[INFO] OpenAI to Gemini Adapter 启动中...\n")
     
     # 检查环境
@@ -136,6 +224,12 @@ def main():
     # 获取配置
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", "8050"))
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers > 1:
+        # Lets SHARED_STATE_BACKEND=auto pick the SQLite store so the workers share
+        # key cursors, the current location and discovered project IDs.
+        os.environ["VOUTB_WORKERS"] = str(workers)
+        print(f"[INFO] 工作进程数: {workers} (共享状态: {app_config.SHARED_STATE_BACKEND})")
     
     print(f"\n启动服务器: http://{host}:{port}")
     print("按 Ctrl+C 停止服务\n")
@@ -144,8 +238,10 @@ def main():
     try:
         uvicorn.run(
             "main:app",
+            app_dir=str(app_dir),
             host=host,
             port=port,
+            workers=workers,
             reload=False,
             log_level="info"
         )